@@ -2,116 +2,293 @@
 import os
 import json
 
+from collections import Counter
+
+import numpy as np
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from top_k import TopK
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+
+# Metadata that is the same in every per-process file
+GLOBAL_KEYS = ["cali.caliper.version", "mpi.world.size", "cali.channel"]
+CALLTYPES = ["kokkos", "mpi_p2p", "mpi_collective", "other"]
+
+# Below this many per-process files, the metadata is aggregated without the worker pool
+PROC_METADATA_BATCH_SIZE = 64
+
+# A rank is imbalanced in a function if it spends more than mean + IMBALANCE_THRESHOLD * std in it
+IMBALANCE_THRESHOLD = 1.5
+
 def read_in_proc_metadata_files(files_dir):
-    metadata_proc_dir = os.path.join(files_dir, "metadata", "procs")
-    all_metadata_files = [os.path.join(metadata_proc_dir, metadata_file) for metadata_file in os.listdir(metadata_proc_dir)]
-    return all_metadata_files
-
-def aggregate_all_proc_metadata(list_of_proc_metadata_files):
-    # Initalize useful variables to loop over
-    global_keys = ["cali.caliper.version", "mpi.world.size", "cali.channel"]
-    calltypes = ["kokkos", "mpi_p2p", "mpi_collective", "other"]
-
-    # Initalize the global data
-    global_metadata = {}
-    global_known_ranks = []
-    global_known_depths = []
-    global_average_counts = {}
-    global_unique_counts = {calltype: 0 for calltype in calltypes}
-    global_total_counts = {calltype: 0 for calltype in calltypes}
-    tmp_global_biggest_calls = {}
-    global_biggest_calls = {}
-    global_start = 100.
-    global_end = 0.
-    global_runtime = 0.
-
-    known_ftn_ids = []
-
-    first_file = True
-
-    for proc_metadata_file in list_of_proc_metadata_files:
-        # Read in the current file
+    """The per-process metadata files, metadata/procs/metadata-<first rank of the process>.json."""
+    return list(read_rank_files(files_dir, os.path.join("metadata", "procs"), "metadata").values())
+
+def empty_metadata_summary():
+    """Summary of no per-process metadata files (see summarize_proc_metadata)."""
+    return {
+        "constants": {key: None for key in GLOBAL_KEYS},
+        "known.ranks": set(),
+        "known.depths": set(),
+        "program.start": None,
+        "program.end": None,
+        "total.counts": Counter(),
+    }
+
+def summarize_proc_metadata(proc_metadata_files):
+    """
+    Partial summary of a batch of per-process metadata files.
+
+    Summaries only hold sets, counters and bounds, so merging two of them does not depend on how many
+    ranks or functions they cover and they can be combined in any grouping (see merge_metadata_summaries).
+    """
+    summary = empty_metadata_summary()
+    for proc_metadata_file in proc_metadata_files:
         with open(proc_metadata_file) as f:
             proc_metadata = json.load(f)
 
-        # Start with all the constant metadata from a single file
-        if first_file:
-            first_file = False
-            for key in global_keys:
-                global_metadata[key] = proc_metadata[key]
-
-        # Add all known ranks and depths
-        for rank in proc_metadata["known.ranks"]:
-            if rank not in global_known_ranks:
-                global_known_ranks.append(rank)
-        for depth in proc_metadata["known.depths"]:
-            if depth not in global_known_depths:
-                global_known_depths.append(depth)
-
-        # Update start and end times
-        if proc_metadata["program.start"] < global_start:
-            global_start = proc_metadata["program.start"]
-        if proc_metadata["program.end"] > global_end:
-            global_end = proc_metadata["program.end"]
-
-        # Update global counts
+        # total.counts holds one entry per rank, plus the average over the ranks of the file
+        total_counts = Counter()
         for key_rank, counts_dict in proc_metadata["total.counts"].items():
-            for calltype in calltypes:
-                global_total_counts[calltype] += counts_dict[calltype]
-
-        # Update unique counts
-        for ftn_id, ftn_type in proc_metadata["unique.ftnids"].items():
-            if ftn_id not in known_ftn_ids:
-                global_unique_counts[ftn_type] += 1
-                known_ftn_ids.append(ftn_id)
-
-        # Update biggest calls
-        for big_call in proc_metadata["biggest.calls"]:
-            ftn_name = big_call["name"]
-            num_ranks = len(big_call["rank_info"])
-            if ftn_name not in tmp_global_biggest_calls:
-                tmp_global_biggest_calls[ftn_name] = {"n_ranks": num_ranks, "dur": big_call["dur"]}
-            else:
-                tmp_global_biggest_calls[ftn_name]["n_ranks"] += num_ranks
-                tmp_global_biggest_calls[ftn_name]["dur"] += big_call["dur"]
+            if key_rank != "average":
+                total_counts.update({calltype: counts_dict[calltype] for calltype in CALLTYPES})
+
+        file_summary = {
+            # Files that are still being written (live ingestion) have no globals yet
+            "constants": {key: proc_metadata.get(key) for key in GLOBAL_KEYS},
+            "known.ranks": set(proc_metadata["known.ranks"]),
+            "known.depths": set(proc_metadata["known.depths"]),
+            "program.start": proc_metadata["program.start"],
+            "program.end": proc_metadata["program.end"],
+            "total.counts": total_counts,
+        }
+        summary = merge_metadata_summaries(summary, file_summary)
+    return summary
 
+def merge_metadata_summaries(left, right):
+    """Combine two partial summaries; the constant metadata is taken from the left one where it is known."""
+    return {
+        "constants": {key: right["constants"][key] if left["constants"][key] is None else left["constants"][key]
+                      for key in GLOBAL_KEYS},
+        "known.ranks": left["known.ranks"] | right["known.ranks"],
+        "known.depths": left["known.depths"] | right["known.depths"],
+        "program.start": min((ts for ts in (left["program.start"], right["program.start"]) if ts is not None),
+                             default=None),
+        "program.end": max((ts for ts in (left["program.end"], right["program.end"]) if ts is not None),
+                           default=None),
+        "total.counts": left["total.counts"] + right["total.counts"],
+    }
 
-    # Update known ranks and depths
-    global_metadata["known.ranks"] = global_known_ranks
-    global_metadata["known.depths"] = global_known_depths
+def tree_reduce(items, merge):
+    """Merge neighbouring items pairwise, level by level, keeping their order; log2(n) levels deep."""
+    while len(items) > 1:
+        merged = [merge(items[i], items[i + 1]) for i in range(0, len(items) - 1, 2)]
+        if len(items) % 2 == 1:
+            merged.append(items[-1])
+        items = merged
+    return items[0]
 
-    # Add aggregated values
-    global_metadata["maximum.depth"] = max(global_known_depths)
-    global_metadata["program.start"] = global_start
-    global_metadata["program.end"] = global_end
-    global_metadata["program.runtime"] = global_end - global_start
+@log_timed()
+def aggregate_all_proc_metadata(list_of_proc_metadata_files, pool=None):
+    """
+    Combine the per-process metadata into the global metadata.
 
-    # Find the biggest calls
-    for ftn_name, big_call in tmp_global_biggest_calls.items():
-        global_biggest_calls[ftn_name] = big_call["dur"] / big_call["n_ranks"]
-    global_metadata["biggest.calls"] = global_biggest_calls
+    Batches of files are summarized in parallel on the given pool, and the partial summaries are then tree
+    reduced in this process (merging summaries is cheap next to reading the files). Without a pool, or
+    with at most PROC_METADATA_BATCH_SIZE files, everything is done in this process.
+    """
+    files = sorted(list_of_proc_metadata_files)
+    if pool is None or len(files) <= PROC_METADATA_BATCH_SIZE:
+        summaries = [summarize_proc_metadata(files)]
+    else:
+        batch_size = max(PROC_METADATA_BATCH_SIZE, -(-len(files) // pool.max_workers))
+        batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+        summaries = pool.map(summarize_proc_metadata, batches)
+    summary = tree_reduce(summaries, merge_metadata_summaries)
 
-    # Get average counts per rank
-    for calltype in calltypes:
-        global_average_counts[calltype] = global_total_counts[calltype] / len(global_known_ranks)
+    global_metadata = dict(summary["constants"])
+    global_metadata["known.ranks"] = sorted(summary["known.ranks"])
+    global_metadata["known.depths"] = sorted(summary["known.depths"])
+    global_metadata["maximum.depth"] = max(summary["known.depths"], default=None)
 
-    # Write out global counts
-    global_metadata["total.counts"] = global_total_counts
-    global_metadata["unique.counts"] = global_unique_counts
-    global_metadata["average.counts"] = global_average_counts
+    # Integer nanoseconds; without any per-process file (nothing converted yet), the program is empty
+    program_start, program_end = summary["program.start"], summary["program.end"]
+    if program_start is None:
+        program_start = program_end = 0
+    global_metadata["program.start"] = program_start
+    global_metadata["program.end"] = program_end
+    global_metadata["program.runtime"] = program_end - program_start
+
+    num_ranks = len(summary["known.ranks"])
+    global_metadata["total.counts"] = {calltype: summary["total.counts"][calltype] for calltype in CALLTYPES}
+    global_metadata["average.counts"] = {calltype: summary["total.counts"][calltype] / max(1, num_ranks)
+                                         for calltype in CALLTYPES}
 
-    # Return the global metadata
     return global_metadata
 
+def aggregate_unique_events(rank_unique_events_files):
+    """
+    Merge the unique events of every rank into one list.
+
+    Each converter numbers functions in the order it meets them, so ftn_ids are not comparable
+    across files; functions are matched by name and path instead.
+
+    Returns:
+        unique_events (list): Merged unique events, sorted by depth
+        flagged_ranks (set):  Ranks whose unique events file carries imbalance from an earlier run
+    """
+    all_unique_events = {}
+    flagged_ranks = set()
+    for rank, rank_file in sorted(rank_unique_events_files.items()):
+        with open(rank_file) as f:
+            rank_unique_events = json.load(f)
+
+        for event in rank_unique_events:
+            key = (event["name"], event["path"])
+            if key not in all_unique_events:
+                merged_event = {k: v for k, v in event.items() if k != "imbalance"}
+                merged_event["rank_info"] = {}
+                all_unique_events[key] = merged_event
+            else:
+                merged_event = all_unique_events[key]
+                merged_event["dur"] += event["dur"]
+                merged_event["count"] += event["count"]
+            merged_event["rank_info"][rank] = {"count": event["count"], "dur": event["dur"]}
+
+            if "imbalance" in event:
+                flagged_ranks.add(rank)
+
+    return sorted(all_unique_events.values(), key=lambda e: e["depth"]), flagged_ranks
+
+def function_statistics(unique_events):
+    """
+    Mean and standard deviation of the duration of every function over the ranks that call it, for all
+    functions at once.
+
+    The (function x rank) duration matrix is built in coordinate form from the rank_info of the merged
+    unique events.
+
+    Returns:
+        rows, ranks, durs (np.ndarray): Function index, rank and duration of every entry of the matrix
+        mean, std (np.ndarray):         Mean and standard deviation of every function
+    """
+    num_ranks = [len(event["rank_info"]) for event in unique_events]
+    total = sum(num_ranks)
+    rows = np.repeat(np.arange(len(unique_events)), num_ranks)
+    ranks = np.fromiter((int(rank) for event in unique_events for rank in event["rank_info"]),
+                        dtype=np.int64, count=total)
+    durs = np.fromiter((info["dur"] for event in unique_events for info in event["rank_info"].values()),
+                       dtype=np.float64, count=total)
+
+    counts = np.maximum(np.bincount(rows, minlength=len(unique_events)), 1)
+    mean = np.bincount(rows, weights=durs, minlength=len(unique_events)) / counts
+    std = np.sqrt(np.bincount(rows, weights=(durs - mean[rows]) ** 2, minlength=len(unique_events)) / counts)
+    return rows, ranks, durs, mean, std
+
+def compute_imbalance(unique_events, threshold=IMBALANCE_THRESHOLD):
+    """
+    Find the ranks that spend much longer than the others in each function (see function_statistics).
+
+    Returns:
+        outliers (list): (function index, rank, percent difference from the mean), ordered by function
+    """
+    rows, ranks, durs, mean, std = function_statistics(unique_events)
+
+    outliers = np.flatnonzero(durs > mean[rows] + threshold * std[rows])
+    pct_diffs = (durs[outliers] - mean[rows[outliers]]) / mean[rows[outliers]]
+
+    return list(zip(rows[outliers].tolist(), ranks[outliers].tolist(), pct_diffs.tolist()))
+
+def count_unique_functions(unique_events):
+    """Number of distinct function names of each call type over all ranks."""
+    names = {calltype: set() for calltype in CALLTYPES}
+    for event in unique_events:
+        names[event["type"]].add(event["name"])
+    return {calltype: len(names[calltype]) for calltype in CALLTYPES}
+
+def find_biggest_calls(unique_events, k=10):
+    """
+    Exact top k functions (by name) over all ranks, both by per-rank mean duration and by total duration.
+
+    Returns:
+        by_mean (dict):  {name: total duration / number of calling ranks}, biggest first
+        by_total (dict): {name: total duration}, biggest first
+    """
+    totals = {}
+    ranks = {}
+    for event in unique_events:
+        name = event["name"]
+        totals[name] = totals.get(name, 0) + event["dur"]
+        ranks.setdefault(name, set()).update(event["rank_info"].keys())
+
+    by_mean = TopK(k)
+    by_total = TopK(k)
+    for name, total in totals.items():
+        by_mean.push(total / len(ranks[name]), name)
+        by_total.push(total, name)
+
+    return {name: score for score, name, _ in by_mean.items()}, {name: score for score, name, _ in by_total.items()}
+
+def apply_imbalance(unique_events, outliers, rank_unique_events_files, flagged_ranks, indent=0):
+    """
+    Record the imbalance on the merged unique events and in the per-rank unique events files.
+
+    Returns:
+        imbalance (list): Average imbalance of every imbalanced function, for the global metadata
+    """
+    rank_outliers = {}
+    function_diffs = {}
+    for row, rank, pct_diff in outliers:
+        event = unique_events[row]
+        event.setdefault("imbalance", []).append({rank: pct_diff})
+        rank_outliers.setdefault(rank, {})[(event["name"], event["path"])] = pct_diff
+        function_diffs.setdefault(row, []).append(pct_diff)
+
+    # Only rewrite the files whose imbalance changes
+    for rank in flagged_ranks | set(rank_outliers.keys()):
+        with open(rank_unique_events_files[rank]) as f:
+            rank_unique_events = json.load(f)
+        for event in rank_unique_events:
+            event.pop("imbalance", None)
+            pct_diff = rank_outliers.get(rank, {}).get((event["name"], event["path"]))
+            if pct_diff is not None:
+                event["imbalance"] = pct_diff
+        write_json(rank_unique_events_files[rank], rank_unique_events, indent=indent)
+
+    return [{"name": unique_events[row]["name"], "ftn_id": unique_events[row]["ftn_id"],
+             "imbalance": sum(diffs) / len(diffs)} for row, diffs in function_diffs.items()]
+
+def write_out_global_unique_events(data, files_dir, indent=0):
+    unique_events_file = os.path.join(files_dir, "unique-events", "unique-events-all.json")
+
+    write_json(unique_events_file, data, indent=indent)
+
 def write_out_global_metadata(data, files_dir, indent=0):
     metadata_dir = os.path.join(files_dir, "metadata")
     metadata_file = os.path.join(metadata_dir, f"metadata.json")
 
-    with open(metadata_file, "w") as global_metadata_output:
-        json.dump(data, global_metadata_output, indent=indent)
+    write_json(metadata_file, data, indent=indent)
 
 def aggregate_metadata(files_dir):
     proc_metadata_files = read_in_proc_metadata_files(files_dir)
-    global_metadata = aggregate_all_proc_metadata(proc_metadata_files)
+    global_metadata = aggregate_all_proc_metadata(proc_metadata_files, pool=get_worker_pool())
+
+    # Offsets and drifts applied by the clock skew correction (if it ran)
+    clock_skew_file = os.path.join(files_dir, "metadata", "clock_skew.json")
+    if os.path.isfile(clock_skew_file):
+        with open(clock_skew_file) as f:
+            global_metadata["clock.skew"] = json.load(f)
+
+    rank_unique_events_files = read_rank_files(files_dir, "unique-events", "unique-events")
+    global_unique_events, flagged_ranks = aggregate_unique_events(rank_unique_events_files)
+    global_metadata["unique.counts"] = count_unique_functions(global_unique_events)
+    global_metadata["biggest.calls"], global_metadata["biggest.calls.total"] = find_biggest_calls(global_unique_events)
+    outliers = compute_imbalance(global_unique_events)
+    global_metadata["imbalance"] = apply_imbalance(global_unique_events, outliers, rank_unique_events_files,
+                                                   flagged_ranks, 4)
+
     write_out_global_metadata(global_metadata, files_dir, 4)
+    write_out_global_unique_events(global_unique_events, files_dir, 4)
 
@@ -0,0 +1,36 @@
+"""
+Atomic writes for the files directory.
+
+Every artifact is written to a temporary file next to it and renamed over the old one once it is
+complete. A rename within a directory is atomic, so a request that reads an artifact while it is
+being regenerated gets either the old or the new version, never a truncated one, and two writers
+of the same file (e.g. the same logical hierarchy) cannot interleave: the last rename wins.
+
+The temporary files are hidden (".<random>.tmp"), so that they do not match the artifact globs
+and file name patterns used by the pipeline.
+"""
+import os
+import json
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(filepath, mode="w", **kwargs):
+    """Like open(filepath, mode), but the file only appears under its name once it is closed."""
+    fd, tmp_filepath = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(filepath) or ".")
+    try:
+        # mkstemp makes the file private; artifacts are as readable as if they were created by open()
+        os.chmod(tmp_filepath, 0o644)
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+
+def write_json(filepath, data, **kwargs):
+    """json.dump data to filepath atomically; keyword arguments are passed to json.dump."""
+    with atomic_open(filepath, "w", encoding="utf-8") as f:
+        json.dump(data, f, **kwargs)
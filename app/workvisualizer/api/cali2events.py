@@ -72,10 +72,19 @@
 
 ###################################################################################
 from logging_utils.logging_utils import log_timed
+from atomic_io import atomic_open, write_json
+from worker_pool import get_worker_pool
 
 import caliperreader
+from caliperreader.caliperstreamreader import _read_cali_record
+from caliperreader.readererror import ReaderError
 
+import copy
 import json
+import array
+import heapq
+import shutil
+import tempfile
 import numpy as np
 import time
 import sys
@@ -94,10 +103,21 @@ all_collectives = ["MPI_Allgather", "MPI_Allgatherv", "MPI_Allreduce", "MPI_Allt
                    "MPI_Op_free", "MPI_Reduce_local", "MPI_Reduce_scatter", "MPI_Scan",
                    "MPI_User_function"]
 
-counts_template_dict = {"kokkos": {"total_count": 0, "unique_count": 0, "time": 0.0},
-                        "mpi_p2p": {"total_count": 0, "unique_count": 0, "time": 0.0},
-                        "mpi_collective": {"total_count": 0, "unique_count": 0, "time": 0.0},
-                        "other": {"total_count": 0, "unique_count": 0, "time": 0.0}}
+# Files smaller than this are not worth splitting across processes
+PARALLEL_PARSE_MIN_BYTES = 64 * 1024 * 1024
+
+# Directories of the per-rank outputs; every converted rank has a <dir>/<dir>-<rank>.json in each of them
+RANK_OUTPUT_DIRS = ["events", "unique-events", "messages", "counters"]
+
+
+def rank_output_files(files_dir, rank):
+    """Paths of the per-rank outputs of one rank."""
+    return [os.path.join(files_dir, output_dir, f"{output_dir}-{rank}.json") for output_dir in RANK_OUTPUT_DIRS]
+
+counts_template_dict = {"kokkos": {"total_count": 0, "unique_count": 0, "time": 0},
+                        "mpi_p2p": {"total_count": 0, "unique_count": 0, "time": 0},
+                        "mpi_collective": {"total_count": 0, "unique_count": 0, "time": 0},
+                        "other": {"total_count": 0, "unique_count": 0, "time": 0}}
 
 
 def _get_first_from_list(rec, attribute_list, fallback=0):
@@ -107,26 +127,211 @@ def _get_first_from_list(rec, attribute_list, fallback=0):
     return fallback
 
 
+# Timestamp attribute -> factor to nanoseconds
+timestamp_attributes = {
+    "cupti.timestamp": 1,
+    "rocm.host.timestamp": 1,
+    "time.offset.ns": 1,
+    "time.offset": 1000,
+    "gputrace.timestamp": 1,
+    "cupti.activity.start": 1,
+    "rocm.starttime": 1
+}
+
+
 def _get_timestamp(rec):
-    """Get timestamp from rec and convert to seconds"""
-
-    timestamp_attributes = {
-        "cupti.timestamp": 1e-9,
-        "rocm.host.timestamp": 1e-9,
-        "time.offset.ns": 1e-9,
-        "time.offset": 1e-6,
-        "gputrace.timestamp": 1e-9,
-        "cupti.activity.start": 1e-9,
-        "rocm.starttime": 1e-9
-    }
+    """Get timestamp from rec as integer nanoseconds"""
 
     for attr, factor in timestamp_attributes.items():
         if attr in rec:
-            return float(rec[attr]) * factor
+            value = rec[attr]
+            try:
+                return int(value) * factor
+            except ValueError:
+                return round(float(value) * factor)
 
     return None
 
 
+def _is_kokkos_fence(rec):
+    kernel_type = rec.get("kernel_type")
+    return kernel_type is not None and "kokkos.fence" in kernel_type
+
+
+def _split_cali_record(line):
+    """
+    Same result as caliperreader's _read_cali_record, but uses str.split when the line has no
+    escaped characters (almost always), instead of walking the line one character at a time.
+    """
+    if "\\" in line:
+        return _read_cali_record(line)
+
+    result = {}
+    entries = line.strip().split(",")
+    for entry in entries[:-1]:
+        elements = entry.split("=")
+        result[elements[0]] = elements[1:]
+
+    # Like _read_cali_record, drop a trailing entry whose last element is empty
+    elements = entries[-1].split("=")
+    if len(elements[-1]) > 0:
+        result[elements[0]] = elements[1:]
+
+    return result
+
+
+class ProjectingStreamReader(caliperreader.CaliperStreamReader):
+    """
+    CaliperStreamReader that only materializes the attributes the converter asks for.
+
+    The projection of every context tree node is computed once and cached, so building a snapshot
+    record costs one small dict update per referenced node. Records matching reject_record (e.g.
+    Kokkos fences) are dropped before they reach the record callback.
+
+    This overrides the private _process of caliperreader and uses its _read_cali_record, so the
+    caliper-reader version is pinned in requirements.txt; check both again before upgrading it.
+    """
+
+    def __init__(self, keep_attribute, reject_record=None):
+        super().__init__()
+        self.keep_attribute = keep_attribute
+        self.reject_record = reject_record
+        self.kept_attributes = {}
+        self.projected_nodes = {}
+        self.immediate_attributes = {}
+
+    def _keeps(self, name):
+        keep = self.kept_attributes.get(name)
+        if keep is None:
+            keep = self.kept_attributes[name] = bool(self.keep_attribute(name))
+        return keep
+
+    def _project_node(self, node_id):
+        projected = self.projected_nodes.get(node_id)
+        if projected is None:
+            expanded = self.db.nodes[node_id].expand()
+            projected = {key: val for key, val in expanded.items() if self._keeps(key)}
+            self.projected_nodes[node_id] = projected
+        return projected
+
+    def _immediate_attribute(self, attr_id):
+        """Name of an immediate (as-value) attribute, or None if it is hidden or not needed."""
+        if attr_id not in self.immediate_attributes:
+            attr = self.db.attributes_by_id[int(attr_id)]
+            keep = not attr.is_hidden() and self._keeps(attr.name())
+            self.immediate_attributes[attr_id] = attr.name() if keep else None
+        return self.immediate_attributes[attr_id]
+
+    def _project_record(self, record):
+        result = {}
+
+        if 'ref' in record:
+            for node_id in record['ref']:
+                result.update(self._project_node(int(node_id)))
+
+        if 'attr' in record and 'data' in record:
+            for attr_id, val in zip(record['attr'], record['data']):
+                name = self._immediate_attribute(attr_id)
+                if name is not None:
+                    result[name] = val
+
+        return result
+
+    def _process(self, line, process_record_fn=None):
+        record = _split_cali_record(line)
+
+        if '__rec' not in record:
+            raise ReaderError('"__rec" missing: ' + line)
+
+        kind = record['__rec'][0]
+
+        if kind == 'node':
+            self._process_node_record(record)
+        elif kind == 'ctx' and process_record_fn is not None:
+            rec = self._project_record(record)
+            if self.reject_record is None or not self.reject_record(rec):
+                process_record_fn(rec)
+        elif kind == 'globals':
+            # Globals are run metadata; keep all of them
+            self.globals = self._expand_record(record)
+
+
+def _scan_cali_file(filename, num_ranges):
+    """
+    First pass over a .cali file for parallel parsing.
+
+    Collects the metadata records (nodes and globals), which are needed to decode snapshot records
+    anywhere in the file, and splits the file into num_ranges line-aligned byte ranges.
+    """
+    metadata_lines = []
+    range_size = os.path.getsize(filename) / num_ranges
+    boundaries = [0]
+    offset = 0
+
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.startswith(b"__rec=node") or line.startswith(b"__rec=globals"):
+                metadata_lines.append(line.decode())
+            offset += len(line)
+            if len(boundaries) < num_ranges and offset >= range_size * len(boundaries):
+                boundaries.append(offset)
+
+    boundaries.append(offset)
+    ranges = [(begin, end) for begin, end in zip(boundaries[:-1], boundaries[1:]) if end > begin]
+    return metadata_lines, ranges
+
+
+def _read_cali_range(cfg, filename, metadata_lines, begin, end):
+    """Decode the snapshot records between two line-aligned byte offsets of a .cali file."""
+    converter = CaliTraceEventConverter(cfg)
+    reader = converter.reader
+    reader.read(metadata_lines)
+
+    def snapshot_lines():
+        with open(filename, "rb") as f:
+            f.seek(begin)
+            position = begin
+            while position < end:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                if line.startswith(b"__rec=ctx"):
+                    yield line.decode()
+
+    records = []
+    reader.read(snapshot_lines(), records.append)
+
+    # Depths seen on the (rejected) fence records are part of the result as well
+    return records, converter.known_depths
+
+
+def _read_spill_run(filename, adjust):
+    """Stream the events of a time-ordered spill run, applying the timestamp adjustment per pid."""
+    with open(filename) as f:
+        for line in f:
+            event = json.loads(line)
+            event["ts"] += adjust.get(event["pid"], 0)
+            yield event
+
+
+def _write_json_list(filename, items, indent=None):
+    """Write an iterable as a JSON list without materializing it."""
+    prefix = "\n" + " " * indent if indent is not None else ""
+    with atomic_open(filename, "w") as output:
+        output.write("[")
+        first = True
+        for item in items:
+            if not first:
+                output.write("," if indent is not None else ", ")
+            first = False
+            text = json.dumps(item, indent=indent)
+            if indent is not None:
+                text = text.replace("\n", prefix)
+            output.write(prefix + text)
+        output.write("\n]" if indent is not None and not first else "]")
+
+
 def _parse_counter_spec(spec):
     """Parse spec strings in the form
         "group=counter1,counter2,..."
@@ -192,6 +397,192 @@ class StackFrames:
         return result
 
 
+class EventBuffer:
+    """
+    Struct-of-arrays storage for the closed events of a converter.
+
+    Numeric fields are kept in typed arrays and strings are interned, so a buffered event costs
+    BYTES_PER_EVENT bytes instead of a dict; dicts are only built when the events are written out.
+    """
+
+    # Field name -> array typecode; -1 in "sf", "comm" and "coll_type" means the event has none
+    COLUMNS = {
+        "pid": "q",
+        "tid": "q",
+        "sf": "q",
+        "name": "i",
+        "eid": "q",
+        "ftn_id": "q",
+        "depth": "i",
+        "type": "i",
+        "ts": "q",
+        "dur": "q",
+        "path": "i",
+        "kernel_type": "i",
+        "rank": "q",
+        "comm": "q",
+        "coll_type": "i",
+    }
+    STRING_COLUMNS = ("name", "type", "path", "kernel_type")
+    BYTES_PER_EVENT = sum(array.array(typecode).itemsize for typecode in COLUMNS.values())
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.clear()
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def nbytes(self):
+        return len(self) * self.BYTES_PER_EVENT
+
+    def clear(self):
+        """Drop the buffered events (the interned strings are kept)."""
+        for column, typecode in self.COLUMNS.items():
+            setattr(self, column, array.array(typecode))
+
+    def intern(self, string):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.string_ids[string] = string_id
+            self.strings.append(string)
+        return string_id
+
+    def append(self, pid, tid, sf, name, eid, ftn_id, depth, type, ts, dur, path, kernel_type, rank, comm=-1,
+               coll_type=-1):
+        """Add an event; returns its index in the buffer."""
+        self.pid.append(pid)
+        self.tid.append(tid)
+        self.sf.append(-1 if sf is None else sf)
+        self.name.append(self.intern(name))
+        self.eid.append(eid)
+        self.ftn_id.append(ftn_id)
+        self.depth.append(depth)
+        self.type.append(self.intern(type))
+        self.ts.append(ts)
+        self.dur.append(dur)
+        self.path.append(self.intern(path))
+        self.kernel_type.append(self.intern(kernel_type))
+        self.rank.append(rank)
+        self.comm.append(comm)
+        self.coll_type.append(coll_type)
+        return len(self.ts) - 1
+
+    def get(self, index):
+        """Materialize one event as a dict (same keys, in the same order, as the trace event records)."""
+        strings = self.strings
+        event = {"pid": self.pid[index], "tid": self.tid[index]}
+        if self.sf[index] >= 0:
+            event["sf"] = self.sf[index]
+        event.update(name=strings[self.name[index]], eid=self.eid[index], ftn_id=self.ftn_id[index],
+                     depth=self.depth[index], type=strings[self.type[index]], ts=self.ts[index],
+                     dur=self.dur[index], path=strings[self.path[index]],
+                     kernel_type=strings[self.kernel_type[index]], rank=self.rank[index])
+        # Communicator of the MPI calls traced with their message information
+        if self.comm[index] >= 0:
+            event["comm"] = self.comm[index]
+        if self.coll_type[index] >= 0:
+            event["coll_type"] = self.coll_type[index]
+        return event
+
+    def adjust_timestamps(self, adjust):
+        """Shift the start time of every event by adjust[pid]."""
+        if len(self) == 0:
+            return
+        ts = np.frombuffer(self.ts, dtype=np.int64)
+        pids = np.frombuffer(self.pid, dtype=np.int64)
+        for pid, offset in adjust.items():
+            ts[pids == pid] += offset
+        # Release the buffer views so that the arrays may grow again
+        del ts, pids
+
+    def sorted_by_rank(self):
+        """Return {rank: index list} with the indices of each rank ordered by start time (stable)."""
+        if len(self) == 0:
+            return {}
+        order = np.argsort(np.frombuffer(self.ts, dtype=np.int64), kind="stable")
+        ranks = np.frombuffer(self.rank, dtype=np.int64)[order]
+        return {int(rank): order[ranks == rank].tolist() for rank in np.unique(ranks)}
+
+    def iter_events(self, indices):
+        for index in indices:
+            yield self.get(index)
+
+
+class MessageTable:
+    """
+    Struct-of-arrays storage for the point-to-point messages of a converter (from Caliper's MPI message
+    tracing), one row per message. A message belongs to the MPI call with the given eid (whose time is
+    split evenly among the messages of the call) and peer is the other end, as a rank of the communicator.
+    """
+
+    COLUMNS = {
+        "rank": "q",
+        "eid": "q",
+        "send": "b",
+        "peer": "q",
+        "tag": "q",
+        "size": "q",
+        "comm": "q",
+        "world": "b",
+        "dur": "q",
+    }
+
+    def __init__(self):
+        for column, typecode in self.COLUMNS.items():
+            setattr(self, column, array.array(typecode))
+
+    def __len__(self):
+        return len(self.eid)
+
+    def append(self, rank, eid, send, peer, tag, size, comm, world, dur):
+        for column, value in zip(self.COLUMNS, (rank, eid, send, peer, tag, size, comm, world, dur)):
+            getattr(self, column).append(value)
+
+    def rank_table(self, rank):
+        """The messages of one rank, as {column: list} (without the rank column)."""
+        rows = np.flatnonzero(np.frombuffer(self.rank, dtype=np.int64) == rank) if len(self) > 0 else []
+        return {column: [getattr(self, column)[row] for row in rows] for column in self.COLUMNS if column != "rank"}
+
+
+class CounterSamples:
+    """
+    Samples of hardware (e.g. PAPI) and other counters, as one (ts, value) pair of arrays per rank and
+    counter, instead of one trace record per sample.
+    """
+
+    def __init__(self):
+        self.series = {}
+
+    def __len__(self):
+        return sum(len(ts) for ts, _ in self.series.values())
+
+    def append(self, rank, counter, ts, value):
+        series = self.series.get((rank, counter))
+        if series is None:
+            series = self.series[(rank, counter)] = (array.array("q"), array.array("d"))
+        series[0].append(ts)
+        series[1].append(value)
+
+    def adjust_timestamps(self, adjust):
+        """Shift the samples of every rank by adjust[rank]."""
+        for (rank, _), (ts, _) in self.series.items():
+            offset = adjust.get(rank, 0)
+            if offset != 0:
+                shifted = np.frombuffer(ts, dtype=np.int64)
+                shifted += offset
+                # Release the buffer view so that the array may grow again
+                del shifted
+
+    def rank_series(self, rank):
+        """{counter: {"ts": [...], "value": [...]}} of one rank."""
+        return {counter: {"ts": ts.tolist(), "value": values.tolist()}
+                for (series_rank, counter), (ts, values) in sorted(self.series.items()) if series_rank == rank}
+
+
 class CaliTraceEventConverter:
     BUILTIN_PID_ATTRIBUTES = [
         'mpi.rank',
@@ -202,12 +593,52 @@ class CaliTraceEventConverter:
         'pthread.id',
     ]
 
+    # Attributes read by the record handlers below; everything else is projected away while reading
+    RECORD_ATTRIBUTES = [
+        'path',
+        'kernel_type',
+        'ts.sync',
+        'cpuinfo.cpu',
+        'source.function#cali.sampler.pc',
+        'source.function#callpath.address',
+        'mpi.comm',
+        'mpi.comm.is_world',
+        'mpi.coll.type',
+        'mpi.msg.src',
+        'mpi.msg.dst',
+        'mpi.msg.tag',
+        'mpi.msg.size',
+    ] + list(timestamp_attributes.keys())
+
+    # Keys of an event that describe the call, not the function; unique events do not have them
+    PER_CALL_KEYS = ("rank", "eid", "comm", "coll_type")
+
+    RECORD_ATTRIBUTE_PREFIXES = (
+        'event.begin#',
+        'event.end#',
+        'cupti.',
+        'rocm.',
+        'umpire.',
+        'gputrace.',
+        'papi.',
+    )
+
+    # Attributes that are counters even if they are not configured (cfg["counters"])
+    COUNTER_ATTRIBUTE_PREFIXES = (
+        'papi.',
+    )
+
     def __init__(self, cfg):
         self.cfg = cfg
 
+        # Closed events; other trace records (counters, samples, GPU activities) stay as dicts
+        self.events = EventBuffer()
         self.records = []
-        self.reader = caliperreader.CaliperStreamReader()
         self.rstack = {}
+        # eid -> (communicator, collective type) and messages of the MPI calls in progress
+        self.mpi_info = {}
+        self.mpi_messages = {}
+        self.messages = MessageTable()
 
         self.stackframes = StackFrames()
         self.samples = []
@@ -219,9 +650,25 @@ class CaliTraceEventConverter:
         self.pid_attributes = self.cfg["pid_attributes"] + self.BUILTIN_PID_ATTRIBUTES
         self.tid_attributes = self.cfg["tid_attributes"] + self.BUILTIN_TID_ATTRIBUTES
 
+        self.counter_attributes = set(counter for counters in self.counters.values() for counter in counters)
+        self.counter_samples = CounterSamples()
+
+        self.record_attributes = set(self.RECORD_ATTRIBUTES + self.pid_attributes + self.tid_attributes)
+        self.record_attributes.update(self.counter_attributes)
+        self.reader = self.create_reader()
+
         self.skipped = 0
         self.written = 0
 
+        # Out-of-core mode: closed events are flushed to time-ordered per-rank runs in spill_dir
+        # whenever the buffer exceeds the memory budget, and merged back when writing.
+        self.spill_dir = self.cfg.get("spill_dir")
+        self.max_buffered_events = None
+        if self.spill_dir is not None:
+            self.max_buffered_events = max(1, self.cfg.get("memory_budget", 0) // EventBuffer.BYTES_PER_EVENT)
+        self.spill_runs = {}
+        self.ts_adjust = {}
+
         # These keep track of metadata
         # TODO: there must be a cleaner way to do this
         self.event_id_iterator = 0
@@ -230,14 +677,38 @@ class CaliTraceEventConverter:
         self.unique_functions = []
         self.known_ftns = []
         self.ftn_ids = {}
-        self.earliest_start = 0.
-        self.latest_end = 0.
+        # Times are in integer nanoseconds
+        self.earliest_start = 0
+        self.latest_end = 0
         self.known_ranks = []
         self.known_depths = []
         self.rank_unique_events_dict = {}
         self.unique_events_dict = {}
         self.max_depth = 0
 
+    def keep_attribute(self, name):
+        return name in self.record_attributes or name.startswith(self.RECORD_ATTRIBUTE_PREFIXES)
+
+    def reject_record(self, rec):
+        """Kokkos fences are not converted, but the depth of their begin events is still recorded."""
+        if not _is_kokkos_fence(rec):
+            return False
+
+        for key in rec:
+            if key.startswith("event.begin#"):
+                self._add_known_depth(len(rec.get("path", [])))
+                break
+
+        return True
+
+    def create_reader(self):
+        """A stream reader that only decodes what _process_record needs and drops Kokkos fences."""
+        return ProjectingStreamReader(self.keep_attribute, reject_record=self.reject_record)
+
+    def _add_known_depth(self, depth):
+        if depth not in self.known_depths and depth > 0:
+            self.known_depths.append(depth)
+
     @log_timed()
     def read(self, filename_or_stream):
         self.reader.read(filename_or_stream, self._process_record)
@@ -265,32 +736,78 @@ class CaliTraceEventConverter:
             self._process_record(rec[1])
         self.end_timing(ts)
 
+    @log_timed()
+    def read_parallel(self, filename, num_ranges, sort=True):
+        """
+        Parse one .cali file on the shared worker pool.
+
+        The file is split into num_ranges line-aligned byte ranges that are decoded in parallel; the
+        records are then processed in file order (or in timestamp order if sort is True, like
+        read_and_sort). This must not run in a pool worker, which would start a pool of its own.
+        """
+        metadata_lines, ranges = _scan_cali_file(filename, num_ranges)
+
+        # The metadata tree and the globals are needed here as well
+        self.reader.read(metadata_lines)
+
+        pool = get_worker_pool()
+        futures = [pool.submit(_read_cali_range, self.cfg, filename, metadata_lines, begin, end)
+                   for begin, end in ranges]
+
+        if not sort:
+            for future in futures:
+                records, known_depths = future.result()
+                for depth in known_depths:
+                    self._add_known_depth(depth)
+                for rec in records:
+                    self._process_record(rec)
+            return
+
+        trace = []
+        for future in futures:
+            records, known_depths = future.result()
+            for depth in known_depths:
+                self._add_known_depth(depth)
+            for rec in records:
+                ts = _get_timestamp(rec)
+                if ts is not None:
+                    trace.append((ts, rec))
+
+        trace.sort(key=lambda e: e[0])
+        for rec in trace:
+            self._process_record(rec[1])
+
     @log_timed()
     def write(self, files_dir):
 
-        proc_ids = ''.join(map(str, self.known_ranks[:3]))
+        # Named after the first rank, which no other process has, so that the names of two processes never
+        # collide (see aggregateMetadata.read_in_proc_metadata_files)
+        proc_id = self.known_ranks[0] if len(self.known_ranks) > 0 else ""
 
-        event_output_files = {rank: os.path.join(files_dir, "events", f"events-{rank}.json") for rank in
-                              self.known_ranks}
-        unique_events_output_files = {
-            rank: os.path.join(files_dir, "unique-events", f"unique-events-{rank}.json") for rank in
-            self.known_ranks}
-        metadata_proc_output_file = os.path.join(files_dir, "metadata", "procs", f"metadata-{proc_ids}.json")
-        unique_events_output_file = os.path.join(files_dir, "unique-events", f"unique-events-all.json")
+        rank_outputs = {rank: rank_output_files(files_dir, rank) for rank in self.known_ranks}
+        event_output_files, unique_events_output_files, messages_output_files, counters_output_files = \
+            ({rank: rank_outputs[rank][i] for rank in self.known_ranks} for i in range(len(RANK_OUTPUT_DIRS)))
+        metadata_proc_output_file = os.path.join(files_dir, "metadata", "procs", f"metadata-{proc_id}.json")
 
         # if len(self.stackframes.nodes) > 0:
         #     result["stackFrames"] = self.stackframes.get_stackframes()
         # if len(self.samples) > 0:
         #     result["samples"] = self.samples
 
-        events_result = sorted(self.records, key=lambda event: event["ts"])
-        # Separate into rank specific lists
-        events_per_rank = {rank: [] for rank in self.known_ranks}
-        for event in events_result:
-            events_per_rank[event["rank"]].append(event)
-        # TODO: look in every rank for biggest events (not just 0)
-        biggest_events = sorted(list(self.unique_events_dict.values()), key=lambda event: event["dur"], reverse=True)[
-                         :10]
+        # Separate into rank specific, time-ordered streams; events are only turned into dicts here
+        buffered = self.events.sorted_by_rank()
+        other_records = {rank: [] for rank in self.known_ranks}
+        for record in sorted(self.records, key=lambda event: event["ts"]):
+            other_records[record["rank"]].append(record)
+        events_per_rank = {}
+        for rank in self.known_ranks:
+            # Anything that was spilled to disk comes first (each run is already sorted)
+            streams = [_read_spill_run(run, self.ts_adjust) for run in self.spill_runs.get(rank, [])]
+            streams.append(self.events.iter_events(buffered.get(rank, [])))
+            if other_records[rank]:
+                streams.append(other_records[rank])
+            events_per_rank[rank] = heapq.merge(*streams, key=lambda event: event["ts"]) if len(streams) > 1 \
+                else streams[0]
         metadata_result = self.reader.globals
         metadata_result["known.ranks"] = self.known_ranks
         metadata_result["known.depths"] = self.known_depths
@@ -325,53 +842,49 @@ class CaliTraceEventConverter:
 
         metadata_result["unique.counts"].update({"global": self.unique_event_counters})
         metadata_result["total.counts"].update(avg_total_counts)
-        program_runtime = events_result[-1]["ts"] + events_result[-1]["dur"] - events_result[0]["ts"]
-        metadata_result["program.runtime"] = program_runtime
-        metadata_result["biggest.calls"] = biggest_events
-        metadata_result["imbalance"] = []
 
         indent = 4 if self.cfg["pretty_print"] else None
 
-        # Look for outlier ranks in the unique events
-        for event in self.unique_events_dict.values():
-            ftn_id = event["ftn_id"]
-            all_rank_times = {rank: rank_info["dur"] for rank, rank_info in event["rank_info"].items()}
-            average_time = np.mean(list(all_rank_times.values()))
-            std_dev = np.std(list(all_rank_times.values()))
-            diffs = []
-            for rank, time in all_rank_times.items():
+        # Track the first and the last event (by start time) to find the runtime while streaming
+        first_event = None
+        last_event = None
 
-                if time > average_time + (1.5 * std_dev):  # This one will yield some imbalance (good for testing)
-                    # if np.abs(average_time - time) > 2 * std_dev:   # This one is probably a better metric, but on ExaMiniMD will not yield any imbalance
+        def track_bounds(events):
+            nonlocal first_event, last_event
+            for event in events:
+                if first_event is None or event["ts"] < first_event["ts"]:
+                    first_event = event
+                if last_event is None or event["ts"] >= last_event["ts"]:
+                    last_event = event
+                yield event
 
-                    # Calculate percent difference
-                    pct_diff = (time - average_time) / average_time
+        for rank in self.known_ranks:
+            _write_json_list(event_output_files[rank], track_bounds(events_per_rank[rank]), indent=indent)
+            write_json(unique_events_output_files[rank],
+                       sorted(list((self.rank_unique_events_dict[rank].values())), key=lambda e: e["depth"]),
+                       indent=indent)
+            write_json(messages_output_files[rank], self.messages.rank_table(rank))
+            write_json(counters_output_files[rank], self.counter_samples.rank_series(rank))
+        program_runtime = last_event["ts"] + last_event["dur"] - first_event["ts"]
+        metadata_result["program.runtime"] = program_runtime
 
-                    if "imbalance" not in self.unique_events_dict[ftn_id]:
-                        self.unique_events_dict[ftn_id]["imbalance"] = []
-                    self.unique_events_dict[ftn_id]["imbalance"].append({rank: pct_diff})
+        write_json(metadata_proc_output_file, metadata_result, indent=indent)
 
-                    self.rank_unique_events_dict[rank][ftn_id]["imbalance"] = pct_diff
-                    diffs.append(pct_diff)
+        self.written += len(self.events) + len(self.records) + len(self.samples) + len(self.counter_samples)
 
-            # TODO: Improve metric for imbalance here (this is only recording pct_diff for one rank)
-            if len(diffs) > 0:
-                metadata_result["imbalance"].append(
-                    {"name": event["name"], "ftn_id": ftn_id, "imbalance": sum(diffs) / len(diffs)})
+        return [output for outputs in rank_outputs.values() for output in outputs] + [metadata_proc_output_file]
 
-        for rank in self.known_ranks:
-            with open(event_output_files[rank], "w") as event_output:
-                json.dump(events_per_rank[rank], event_output, indent=indent)
-            with open(unique_events_output_files[rank], "w") as unique_events_output:
-                json.dump(sorted(list((self.rank_unique_events_dict[rank].values())), key=lambda e: e["depth"]),
-                          unique_events_output, indent=indent)
-        with open(unique_events_output_file, "w") as unique_events_output_all:
-            json.dump(sorted(list((self.unique_events_dict.values())), key=lambda e: e["depth"]),
-                      unique_events_output_all, indent=indent)
-        with open(metadata_proc_output_file, "w") as metadata_proc_output:
-            json.dump(metadata_result, metadata_proc_output, indent=indent)
-
-        self.written += len(self.records) + len(self.samples)
+    def spill(self):
+        """Write the buffered events to one time-ordered run file per rank and empty the buffer."""
+        for rank, indices in self.events.sorted_by_rank().items():
+            run_file = os.path.join(self.spill_dir, f"events-{rank}-run-{len(self.spill_runs.get(rank, []))}.jsonl")
+            self.spill_runs.setdefault(rank, []).append(run_file)
+            with open(run_file, "w") as run:
+                for event in self.events.iter_events(indices):
+                    run.write(json.dumps(event) + "\n")
+
+        self.written += len(self.events)
+        self.events.clear()
 
     @log_timed()
     def sync_timestamps(self):
@@ -381,10 +894,15 @@ class CaliTraceEventConverter:
         maxts = max(self.tsync.values())
         adjust = {pid: maxts - ts for pid, ts in self.tsync.items()}
 
+        # Spilled events are adjusted when they are read back
+        self.ts_adjust = adjust
+
+        self.events.adjust_timestamps(adjust)
         for rec in self.records:
-            rec["ts"] += adjust.get(rec["pid"], 0.0)
+            rec["ts"] += adjust.get(rec["pid"], 0)
         for rec in self.samples:
-            rec["ts"] += adjust.get(rec["pid"], 0.0)
+            rec["ts"] += adjust.get(rec["pid"], 0)
+        self.counter_samples.adjust_timestamps(adjust)
 
     def start_timing(self, name):
         if self.cfg["verbose"]:
@@ -410,24 +928,13 @@ class CaliTraceEventConverter:
         else:
             return "other"
 
-    def filter_rec(self, key, rec):
-        keys = list(rec.keys())
-        kernel_type_filter = "kernel_type" in keys and "kokkos.fence" in rec["kernel_type"]
-
-        if key.startswith("event.begin#"):
-            depth = len(rec.get("path", []))
-            if depth not in self.known_depths and depth > 0:
-                self.known_depths.append(depth)
-
-        return kernel_type_filter
-
     def _process_record(self, rec):
         pid = int(_get_first_from_list(rec, self.pid_attributes))
         tid = int(_get_first_from_list(rec, self.tid_attributes))
 
         trec = dict(pid=pid, tid=tid)
 
-        self._process_counters(rec, (pid, tid))
+        self._process_counters(rec, pid)
 
         if "cupti.activity.kind" in rec:
             self._process_cupti_activity_rec(rec, trec)
@@ -446,11 +953,12 @@ class CaliTraceEventConverter:
         elif "ts.sync" in rec:
             self._process_timesync_rec(rec, pid)
             return
+        elif "mpi.comm" in rec:
+            self._process_mpi_rec(rec, (pid, tid))
+            return
         else:
-            keys = list(rec.keys())
-            for key in keys:
-                if self.filter_rec(key, rec):
-                    continue
+            # Kokkos fences were already dropped by the reader
+            for key in rec:
                 if key.startswith("event.begin#"):
                     self._process_event_begin_rec(rec, (pid, tid), key)
                     return
@@ -466,7 +974,7 @@ class CaliTraceEventConverter:
     def _process_gputrace_begin(self, rec, pid):
         block = rec.get("gputrace.block")
         skey = ((pid, int(block)), "gputrace")
-        tst = float(rec["gputrace.timestamp"]) * 1e-3
+        tst = int(rec["gputrace.timestamp"])
 
         if skey in self.rstack:
             self.rstack[skey].append(tst)
@@ -477,7 +985,7 @@ class CaliTraceEventConverter:
         block = rec.get("gputrace.block")
         skey = ((pid, int(block)), "gputrace")
         btst = self.rstack[skey].pop()
-        tst = float(rec["gputrace.timestamp"]) * 1e-3
+        tst = int(rec["gputrace.timestamp"])
 
         name = rec.get("gputrace.region")
         if isinstance(name, list):
@@ -488,6 +996,23 @@ class CaliTraceEventConverter:
     def _process_timesync_rec(self, rec, pid):
         self.tsync[pid] = _get_timestamp(rec)
 
+    def _process_mpi_rec(self, rec, loc):
+        """Message information of the MPI call in progress, recorded between its begin and end records."""
+        stack = self.rstack.get((loc, "mpi.function"))
+        if not stack:
+            return
+        eid = stack[-1][4]
+        comm = int(rec["mpi.comm"])
+        self.mpi_info[eid] = (comm, int(rec.get("mpi.coll.type", -1)))
+
+        # Point-to-point messages; a call may send and receive (MPI_Sendrecv) or complete several messages
+        world = rec.get("mpi.comm.is_world") == "true"
+        for peer_attribute, send in [("mpi.msg.dst", True), ("mpi.msg.src", False)]:
+            if peer_attribute in rec and "mpi.coll.type" not in rec:
+                self.mpi_messages.setdefault(eid, []).append(
+                    (send, int(rec[peer_attribute]), int(rec.get("mpi.msg.tag", -1)), int(rec.get("mpi.msg.size", 0)),
+                     comm, world))
+
     def _process_event_begin_rec(self, rec, loc, key):
         attr = key[len("event.begin#"):]
         tst = _get_timestamp(rec)
@@ -510,13 +1035,15 @@ class CaliTraceEventConverter:
 
         depth = len(raw_path)
 
+        self._add_known_depth(depth)
+
         if depth > self.max_depth:
             self.max_depth = depth
 
         rank = int(rec.get("mpi.rank"))
         if rank not in self.known_ranks:
             self.known_ranks.append(rank)
-            self.rank_event_counters[rank] = counts_template_dict
+            self.rank_event_counters[rank] = copy.deepcopy(counts_template_dict)
 
         skey = (loc, attr)
 
@@ -545,9 +1072,14 @@ class CaliTraceEventConverter:
         if btst + dur > self.latest_end:
             self.latest_end = btst + dur
 
-        # Removed from trec: {ph="X", cat=attr}
-        trec.update(name=name, eid=eid, ftn_id=ftn_id, depth=depth, type=type, ts=btst, dur=dur, path=path,
-                    kernel_type=kernel_type, rank=rank)
+        comm, coll_type = self.mpi_info.pop(eid, (-1, -1))
+        messages = self.mpi_messages.pop(eid, [])
+        for message in messages:
+            self.messages.append(rank, eid, *message, dur // len(messages))
+
+        # Removed from the trace event: {ph="X", cat=attr}
+        index = self.events.append(trec["pid"], trec["tid"], trec.get("sf"), name, eid, ftn_id, depth, type, btst,
+                                   dur, path, kernel_type, rank, comm, coll_type)
 
         if name not in self.unique_functions:
             self.rank_event_counters[rank][type]["unique_count"] += 1
@@ -561,11 +1093,11 @@ class CaliTraceEventConverter:
             self.ftn_ids[ftn_id] = type
 
         if ftn_id not in self.unique_events_dict:
-            self.unique_events_dict[ftn_id] = trec.copy()
+            self.unique_events_dict[ftn_id] = self.events.get(index)
             self.unique_events_dict[ftn_id]["count"] = 1
             self.unique_events_dict[ftn_id]["rank_info"] = {rank: {"count": 1, "dur": dur}}
-            del self.unique_events_dict[ftn_id]["rank"]
-            del self.unique_events_dict[ftn_id]["eid"]
+            for key in self.PER_CALL_KEYS:
+                self.unique_events_dict[ftn_id].pop(key, None)
         else:
             self.unique_events_dict[ftn_id]["dur"] += dur
             self.unique_events_dict[ftn_id]["count"] += 1
@@ -579,26 +1111,29 @@ class CaliTraceEventConverter:
             self.rank_unique_events_dict[rank] = {}
 
         if ftn_id not in self.rank_unique_events_dict[rank]:
-            self.rank_unique_events_dict[rank][ftn_id] = trec.copy()
+            self.rank_unique_events_dict[rank][ftn_id] = self.events.get(index)
             self.rank_unique_events_dict[rank][ftn_id]["count"] = 1
-            del self.rank_unique_events_dict[rank][ftn_id]["rank"]
-            del self.rank_unique_events_dict[rank][ftn_id]["eid"]
+            for key in self.PER_CALL_KEYS:
+                self.rank_unique_events_dict[rank][ftn_id].pop(key, None)
         else:
             self.rank_unique_events_dict[rank][ftn_id]["dur"] += dur
             self.rank_unique_events_dict[rank][ftn_id]["count"] += 1
 
+        if self.max_buffered_events is not None and len(self.events) >= self.max_buffered_events:
+            self.spill()
+
     def _process_cupti_activity_rec(self, rec, trec):
         cat = rec["cupti.activity.kind"]
-        tst = float(rec["cupti.activity.start"]) * 1e-3
-        dur = float(rec["cupti.activity.duration"]) * 1e-3
+        tst = int(rec["cupti.activity.start"])
+        dur = int(rec["cupti.activity.duration"])
         name = rec.get("cupti.kernel.name", cat)
 
         trec.update(ph="X", name=name, cat=cat, ts=tst, dur=dur, tid="cuda")
 
     def _process_roctracer_activity_rec(self, rec, trec):
         cat = rec["rocm.activity"]
-        tst = float(rec["rocm.starttime"]) * 1e-3
-        dur = float(rec["rocm.activity.duration"]) * 1e-3
+        tst = int(rec["rocm.starttime"])
+        dur = int(rec["rocm.activity.duration"])
         name = rec.get("rocm.kernel.name", cat)
 
         trec.update(ph="X", name=name, cat=cat, ts=tst, dur=dur, tid="rocm")
@@ -612,16 +1147,13 @@ class CaliTraceEventConverter:
         self._get_stackframe(rec, trec)
         self.samples.append(trec)
 
-    def _process_counters(self, rec, loc):
-        for grp, counters in self.counters.items():
-            args = {}
-            for counter in counters:
-                if counter in rec:
-                    args[counter] = float(rec[counter])
-            if len(args) > 0:
-                ts = _get_timestamp(rec)
-                trec = dict(ph="C", name=grp, pid=loc[0], tid=loc[1], ts=ts, args=args)
-                self.records.append(trec)
+    def _process_counters(self, rec, pid):
+        ts = None
+        for key in rec:
+            if key in self.counter_attributes or key.startswith(self.COUNTER_ATTRIBUTE_PREFIXES):
+                if ts is None:
+                    ts = _get_timestamp(rec)
+                self.counter_samples.append(pid, key, ts, float(rec[key]))
 
     def _process_umpire_rec(self, rec, trec):
         name = "Alloc " + rec["umpire.alloc.name"]
@@ -640,7 +1172,20 @@ class CaliTraceEventConverter:
 
 
 @log_timed()
-def convert_cali_to_json(input_files: list, files_dir: str):
+def convert_cali_to_json(input_files: list, files_dir: str, memory_budget: int = None, parse_workers: int = 1):
+    """
+    Convert the given .cali files and write the per-rank outputs to files_dir.
+
+    If memory_budget (in bytes) is given, the records are streamed instead of being read and sorted
+    in memory, and closed events are spilled to disk once the budget is reached.
+
+    Files larger than PARALLEL_PARSE_MIN_BYTES are split into parse_workers ranges that are decoded on the
+    shared worker pool (so this must then be called outside of the pool, see read_parallel).
+
+    Returns:
+        ranks (list):   Ranks found in the input files
+        outputs (list): Paths of the files that were written
+    """
     cfg = {
         "pretty_print": True,
         "sync_timestamps": True,
@@ -650,26 +1195,44 @@ def convert_cali_to_json(input_files: list, files_dir: str):
         "verbose": False
     }
 
-    converter = CaliTraceEventConverter(cfg)
+    if memory_budget is not None:
+        cfg["spill_dir"] = tempfile.mkdtemp(prefix="spill-", dir=files_dir)
+        cfg["memory_budget"] = memory_budget
 
     begin = time.perf_counter()
 
-    for file in input_files:
-        with open(file) as input:
-            converter.read_and_sort(input)
+    # The spilled runs are only needed until the events are written; a failed conversion must not
+    # leave them behind either
+    try:
+        converter = CaliTraceEventConverter(cfg)
+
+        for file in input_files:
+            if parse_workers > 1 and os.path.getsize(file) >= PARALLEL_PARSE_MIN_BYTES:
+                converter.read_parallel(file, parse_workers, sort=converter.spill_dir is None)
+                continue
+            with open(file) as input:
+                if converter.spill_dir is None:
+                    converter.read_and_sort(input)
+                else:
+                    converter.read(input)
 
-    if cfg["sync_timestamps"]:
-        ts = converter.start_timing("Syncing ...")
-        converter.sync_timestamps()
-        converter.end_timing(ts)
+        if cfg["sync_timestamps"]:
+            ts = converter.start_timing("Syncing ...")
+            converter.sync_timestamps()
+            converter.end_timing(ts)
 
-    ts = converter.start_timing("Writing ...")
+        ts = converter.start_timing("Writing ...")
 
-    converter.write(files_dir)
-    converter.end_timing(ts)
+        outputs = converter.write(files_dir)
+        converter.end_timing(ts)
+    finally:
+        if "spill_dir" in cfg:
+            shutil.rmtree(cfg["spill_dir"], ignore_errors=True)
 
     end = time.perf_counter()
     tot = end - begin
     wrt = converter.written
 
     print(f"Done. {wrt} records written. Total {tot:.2f}s.", file=sys.stderr)
+
+    return converter.known_ranks, outputs
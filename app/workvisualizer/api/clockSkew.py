@@ -0,0 +1,238 @@
+import os
+import json
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+
+"""
+Estimate and remove the clock skew between ranks.
+
+Every rank leaves a blocking collective (MPI_Barrier, MPI_Allreduce) at about the same moment, so the
+k-th exit of such a collective on a rank should line up with the k-th exit on the reference rank.
+The differences are fit per rank by least squares, either as a constant offset or as offset + drift:
+
+    reference_exit[k] - exit[rank, k] ~= offset[rank] + drift[rank] * exit[rank, k]
+
+and ts' = ts + offset + drift * ts is then applied to the start and end of every event (and unique event)
+of that rank, so that durations are scaled by the drift as well.
+
+Output:
+
+    files/metadata/clock_skew.json: the reference rank, the number of aligned collectives, the total
+        offset (in ns) and drift (ns/ns) applied to each rank, and the signature of each events file
+        once it was corrected
+"""
+
+SYNC_COLLECTIVES = ("MPI_Barrier", "MPI_Allreduce")
+
+# Corrections that would move no timestamp by more than this (in ns) are not applied
+SKEW_TOLERANCE_NS = 100
+
+
+def collective_exit_times(filepath):
+    """
+    Exit times (ts + dur) of the synchronizing collectives in one events file, per collective name, and
+    the (first start, last end) of its events.
+    """
+    with open(filepath, "rb") as f:
+        events = orjson.loads(f.read())
+
+    exits = {name: [] for name in SYNC_COLLECTIVES}
+    for event in events:
+        if event["name"] in exits:
+            exits[event["name"]].append(event["ts"] + event["dur"])
+    bounds = (min(event["ts"] for event in events), max(event["ts"] + event["dur"] for event in events)) \
+        if len(events) > 0 else (0, 0)
+    return {name: np.array(times, dtype=np.int64) for name, times in exits.items()}, bounds
+
+
+def align_collectives(rank_exits):
+    """
+    Inputs:
+        rank_exits (dict): {rank: {collective name: exit times}} as returned by collective_exit_times
+
+    The k-th call of each collective is matched across ranks; calls that not every rank made are dropped.
+
+    Returns:
+        ranks (list):        Ranks in row order
+        exits (np.ndarray):  (ranks x aligned collectives) matrix of exit times
+    """
+    ranks = sorted(rank_exits.keys())
+    columns = []
+    for name in SYNC_COLLECTIVES:
+        num_calls = min(len(rank_exits[rank][name]) for rank in ranks)
+        if num_calls > 0:
+            columns.append(np.stack([rank_exits[rank][name][:num_calls] for rank in ranks]))
+    if len(columns) == 0:
+        return ranks, np.empty((len(ranks), 0), dtype=np.int64)
+    return ranks, np.concatenate(columns, axis=1)
+
+
+def fit_clock_skew(exits, reference_row=0, fit_drift=True, pin_reference=False, bounds=None):
+    """
+    Least squares fit of every rank's clock against the reference row, for all ranks at once.
+
+    Clocks are then moved forward so that no timestamp becomes negative, which makes the earliest clock
+    the reference; with pin_reference, the reference clock is only moved if another clock is behind it.
+    bounds ((ranks x 2) array) are the first and last timestamps of every rank (by default 0 and its
+    last exit): with a drift, the lowest corrected timestamp of a rank is at one of them.
+
+    Returns:
+        offsets (np.ndarray): Offset (ns) to add to each rank's timestamps
+        drifts (np.ndarray):  Drift (ns per ns) to scale each rank's timestamps by
+    """
+    t = exits.astype(np.float64)
+    d = t[reference_row] - t
+
+    t_mean = t.mean(axis=1, keepdims=True)
+    d_mean = d.mean(axis=1, keepdims=True)
+    t_var = ((t - t_mean) ** 2).sum(axis=1)
+
+    drifts = np.zeros(len(exits))
+    if fit_drift and exits.shape[1] > 1:
+        covariance = ((t - t_mean) * (d - d_mean)).sum(axis=1)
+        np.divide(covariance, t_var, out=drifts, where=t_var > 0)
+    offsets = d_mean[:, 0] - drifts * t_mean[:, 0]
+
+    # Like sync_timestamps, move every clock forward so that no timestamp becomes negative
+    if not pin_reference or offsets.min() < -SKEW_TOLERANCE_NS:
+        offsets -= offsets.min()
+    if bounds is None:
+        bounds = np.stack([np.zeros(len(exits)), t.max(axis=1, initial=0)], axis=1)
+    bounds = np.asarray(bounds, dtype=np.float64)
+    lowest = (bounds + offsets[:, None] + drifts[:, None] * bounds).min(initial=0)
+    if lowest < 0:
+        offsets -= np.floor(lowest)
+
+    return offsets, drifts
+
+
+def correct_times(times, offset, drift):
+    """times' = times + offset + drift * times, rounded to ns."""
+    times = np.asarray(times, dtype=np.int64)
+    return times + np.rint(offset + drift * times.astype(np.float64)).astype(np.int64)
+
+
+def correct_events_file(filepath, offset, drift):
+    """
+    Moves the start and end of every event of an events (or unique events) file to the common timeline;
+    returns the new (first ts, last end).
+    """
+    with open(filepath, "rb") as f:
+        events = orjson.loads(f.read())
+    if len(events) == 0:
+        return None
+
+    ts = np.array([event["ts"] for event in events], dtype=np.int64)
+    ends = ts + np.array([event.get("dur", 0) for event in events], dtype=np.int64)
+    corrected_ts = correct_times(ts, offset, drift)
+    corrected_ends = correct_times(ends, offset, drift)
+    for event, new_ts, new_end in zip(events, corrected_ts.tolist(), corrected_ends.tolist()):
+        event["ts"] = new_ts
+        if "dur" in event:
+            event["dur"] = new_end - new_ts
+
+    write_json(filepath, events, indent=4)
+
+    return int(corrected_ts.min()), int(corrected_ends.max())
+
+
+def update_proc_metadata(files_dir, bounds):
+    """Moves the program start, end and runtime of the per-process metadata files to the corrected timeline."""
+    for filepath in read_rank_files(files_dir, os.path.join("metadata", "procs"), "metadata").values():
+        with open(filepath) as f:
+            proc_metadata = json.load(f)
+
+        rank_bounds = [bounds[rank] for rank in proc_metadata["known.ranks"] if bounds.get(rank) is not None]
+        if len(rank_bounds) == 0:
+            continue
+        first_ts = min(first for first, _ in rank_bounds)
+        last_end = max(end for _, end in rank_bounds)
+        if len(rank_bounds) < len(proc_metadata["known.ranks"]):
+            # Some of the ranks of this file were not moved
+            first_ts = min(first_ts, proc_metadata["program.start"])
+            last_end = max(last_end, proc_metadata["program.end"])
+        proc_metadata["program.start"] = first_ts
+        proc_metadata["program.end"] = last_end
+        proc_metadata["program.runtime"] = last_end - first_ts
+
+        write_json(filepath, proc_metadata, indent=4)
+
+
+def get_file_signature(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+@log_timed()
+def correct_clock_skew(files_dir, fit_drift=True):
+    """
+    Fits the clock of every rank to a reference rank and rewrites the events on the common timeline.
+
+    Ranks whose events file did not change since an earlier correction are already on the common
+    timeline. The reference is kept, their fit comes out as (almost) the identity and their files are
+    left alone, so adding or replacing a rank only rewrites that rank.
+    """
+    events_files = read_rank_files(files_dir, "events", "events")
+    skew_file = os.path.join(files_dir, "metadata", "clock_skew.json")
+
+    previous = {}
+    if os.path.isfile(skew_file):
+        with open(skew_file) as f:
+            previous = json.load(f)
+    corrected = {rank for rank, filepath in events_files.items()
+                 if previous.get("signatures", {}).get(str(rank)) == get_file_signature(filepath)}
+
+    skew = {"reference.rank": None, "aligned.collectives": 0, "offsets": {}, "drifts": {}}
+
+    if len(events_files) > 1:
+        ranks = sorted(events_files.keys())
+        exit_times, event_bounds = zip(*get_worker_pool().map(collective_exit_times,
+                                                               [events_files[rank] for rank in ranks]))
+        ranks, exits = align_collectives(dict(zip(ranks, exit_times)))
+
+        if exits.shape[1] > 0:
+            reference = previous.get("reference.rank")
+            pin_reference = reference in corrected
+            if not pin_reference:
+                reference = ranks[0]
+            offsets, drifts = fit_clock_skew(exits, reference_row=ranks.index(reference), fit_drift=fit_drift,
+                                             pin_reference=pin_reference, bounds=event_bounds)
+
+            # Skip the ranks whose correction is within the tolerance (e.g. the ones corrected before)
+            horizon = exits.max()
+            moved = [i for i in range(len(ranks)) if abs(offsets[i]) + abs(drifts[i]) * horizon >= SKEW_TOLERANCE_NS]
+            bounds = get_worker_pool().starmap(
+                correct_events_file,
+                [(events_files[ranks[i]], offsets[i], drifts[i]) for i in moved]
+            )
+            # The unique events keep the time of their first call
+            unique_events_files = [(os.path.join(files_dir, "unique-events", f"unique-events-{ranks[i]}.json"),
+                                    offsets[i], drifts[i]) for i in moved]
+            get_worker_pool().starmap(correct_events_file, [args for args in unique_events_files
+                                                            if os.path.isfile(args[0])])
+            update_proc_metadata(files_dir, {ranks[i]: bound for i, bound in zip(moved, bounds)})
+
+            skew["reference.rank"] = reference
+            skew["aligned.collectives"] = exits.shape[1]
+            for i, rank in enumerate(ranks):
+                offset, drift = (offsets[i], drifts[i]) if i in moved else (0.0, 0.0)
+                if rank in corrected:
+                    # Compose with the correction that was applied before (none if it could not align the rank)
+                    previous_offset = previous.get("offsets", {}).get(str(rank), 0.0)
+                    previous_drift = previous.get("drifts", {}).get(str(rank), 0.0)
+                    offset, drift = previous_offset + offset + drift * previous_offset, \
+                        previous_drift + drift + previous_drift * drift
+                skew["offsets"][rank] = offset
+                skew["drifts"][rank] = drift
+
+    skew["signatures"] = {rank: get_file_signature(filepath) for rank, filepath in events_files.items()}
+
+    write_json(skew_file, skew, indent=4)
+
+    return skew
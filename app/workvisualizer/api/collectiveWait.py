@@ -0,0 +1,177 @@
+import os
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from rank_files import read_rank_files
+from worker_pool import get_worker_pool
+
+"""
+Wait time of every rank in every instance of an MPI collective.
+
+Every rank of a communicator calls its collectives in the same order, so the k-th collective call of each
+rank on a communicator is the same instance. Instances are numbered per communicator (by sequence number)
+and every call is mapped to its instance, which makes a (rank x instance) matrix of arrival (ts) and exit
+(ts + dur) times. Nothing can leave a synchronizing collective before the last rank has arrived, so the
+wait of a rank in an instance is the time from its arrival to the last arrival (at most its duration),
+and the last rank to arrive is the one the others waited for.
+
+Everything is a linear pass over the calls with numpy (np.maximum.at, np.bincount), so this scales with
+the total number of collective calls, not with ranks x instances.
+
+Communicators are told apart by the mpi.comm attribute of Caliper's MPI message tracing (ids assigned in
+the order in which the communicators are created, which is the same on every rank of a communicator).
+Collectives traced without it are all taken to be on a single communicator (-1).
+
+Output:
+
+    files/analysis/collectives.json: the ranks and their total wait; per instance, its communicator,
+        sequence number, collective, number of participants, first and last arrival, last arriver, total
+        and maximum wait; and every call (rank, instance, arrival, exit), ordered by instance
+"""
+
+UNKNOWN_COMM = -1
+
+
+def read_rank_collectives(filepath):
+    """Communicator, name, arrival and exit of the collective calls of one events file, in call order."""
+    with open(filepath, "rb") as f:
+        events = orjson.loads(f.read())
+    calls = sorted((event["ts"], event["dur"], event.get("comm", UNKNOWN_COMM), event["name"]) for event in events
+                   if event["type"] == "mpi_collective")
+
+    ts = np.array([call[0] for call in calls], dtype=np.int64)
+    return {
+        "comm": np.array([call[2] for call in calls], dtype=np.int64),
+        "name": [call[3] for call in calls],
+        "arrival": ts,
+        "exit": ts + np.array([call[1] for call in calls], dtype=np.int64),
+    }
+
+
+def sequence_numbers(comms):
+    """For each call, how many calls on the same communicator came before it."""
+    order = np.argsort(comms, kind="stable")
+    sorted_comms = comms[order]
+    group_starts = np.flatnonzero(np.concatenate(([True], sorted_comms[1:] != sorted_comms[:-1])))
+    group_sizes = np.diff(np.append(group_starts, len(comms)))
+    sequence = np.empty(len(comms), dtype=np.int64)
+    sequence[order] = np.arange(len(comms)) - np.repeat(group_starts, group_sizes)
+    return sequence
+
+
+def align_collectives(rank_collectives):
+    """
+    Inputs:
+        rank_collectives (dict):    {rank: read_rank_collectives(...)} of at least one rank
+
+    Returns:
+        collectives (dict):         Content of collectives.json
+    """
+    ranks = sorted(rank_collectives.keys())
+    rank_ids = np.concatenate([np.full(len(rank_collectives[rank]["arrival"]), rank, dtype=np.int64)
+                               for rank in ranks])
+    comms = np.concatenate([rank_collectives[rank]["comm"] for rank in ranks])
+    sequence = np.concatenate([sequence_numbers(rank_collectives[rank]["comm"]) for rank in ranks])
+    arrivals = np.concatenate([rank_collectives[rank]["arrival"] for rank in ranks])
+    exits = np.concatenate([rank_collectives[rank]["exit"] for rank in ranks])
+    names = [name for rank in ranks for name in rank_collectives[rank]["name"]]
+
+    # Instances of a communicator are numbered after those of the communicators before it
+    comm_ids = np.unique(np.array([comm for rank in ranks for comm in set(rank_collectives[rank]["comm"].tolist())],
+                                  dtype=np.int64))
+    comm_index = np.searchsorted(comm_ids, comms)
+    comm_instances = np.zeros(len(comm_ids), dtype=np.int64)
+    np.maximum.at(comm_instances, comm_index, sequence + 1)
+    offsets = np.cumsum(comm_instances) - comm_instances
+    instance = offsets[comm_index] + sequence
+    num_instances = int(comm_instances.sum())
+
+    first_arrival = np.full(num_instances, np.iinfo(np.int64).max, dtype=np.int64)
+    last_arrival = np.full(num_instances, np.iinfo(np.int64).min, dtype=np.int64)
+    np.minimum.at(first_arrival, instance, arrivals)
+    np.maximum.at(last_arrival, instance, arrivals)
+
+    wait = np.clip(last_arrival[instance] - arrivals, 0, exits - arrivals)
+    max_wait = np.zeros(num_instances, dtype=np.int64)
+    np.maximum.at(max_wait, instance, wait)
+    last_arriver = np.zeros(num_instances, dtype=np.int64)
+    latest = np.flatnonzero(arrivals == last_arrival[instance])
+    last_arriver[instance[latest]] = rank_ids[latest]
+    instance_names = [""] * num_instances
+    for call, call_instance in enumerate(instance.tolist()):
+        instance_names[call_instance] = names[call]
+
+    rank_wait = np.bincount(np.searchsorted(ranks, rank_ids), weights=wait, minlength=len(ranks))
+    by_instance = np.argsort(instance, kind="stable")
+    return {
+        "ranks": ranks,
+        "rank.wait": rank_wait.astype(np.int64).tolist(),
+        "instances": {
+            "comm": np.repeat(comm_ids, comm_instances).tolist(),
+            "sequence": (np.arange(num_instances) - np.repeat(offsets, comm_instances)).tolist(),
+            "name": instance_names,
+            "participants": np.bincount(instance, minlength=num_instances).tolist(),
+            "first.arrival": first_arrival.tolist(),
+            "last.arrival": last_arrival.tolist(),
+            "last.arriver": last_arriver.tolist(),
+            "wait": np.bincount(instance, weights=wait, minlength=num_instances).astype(np.int64).tolist(),
+            "max.wait": max_wait.tolist(),
+        },
+        "calls": {
+            "rank": rank_ids[by_instance].tolist(),
+            "instance": instance[by_instance].tolist(),
+            "arrival": arrivals[by_instance].tolist(),
+            "exit": exits[by_instance].tolist(),
+        }
+    }
+
+
+def collective_matrices(collectives, start=0, count=None):
+    """
+    Arrival and exit matrices (rank x instance) of the instances start to start + count, relative to the
+    first arrival of each instance (None where a rank is not part of an instance), with the statistics of
+    those instances.
+    """
+    instances = collectives["instances"]
+    num_instances = len(instances["comm"])
+    end = num_instances if count is None else min(num_instances, start + count)
+    start = min(start, end)
+
+    calls = collectives["calls"]
+    call_instances = np.array(calls["instance"], dtype=np.int64)
+    first, last = np.searchsorted(call_instances, [start, end])
+    rows = np.searchsorted(collectives["ranks"], np.array(calls["rank"][first:last], dtype=np.int64))
+    columns = call_instances[first:last] - start
+    first_arrival = np.array(instances["first.arrival"][start:end], dtype=np.int64)
+
+    def matrix(times):
+        values = np.full((len(collectives["ranks"]), end - start), np.nan)
+        values[rows, columns] = np.array(times[first:last], dtype=np.int64) - first_arrival[columns]
+        return [[None if np.isnan(value) else int(value) for value in row] for row in values]
+
+    return {
+        "ranks": collectives["ranks"],
+        "rank.wait": collectives["rank.wait"],
+        "start": start,
+        "total.instances": num_instances,
+        "instances": {key: values[start:end] for key, values in instances.items()},
+        "arrival": matrix(calls["arrival"]),
+        "exit": matrix(calls["exit"]),
+    }
+
+
+@log_timed()
+def analyze_collective_wait(files_dir):
+    files = read_rank_files(files_dir, "events", "events")
+    ranks = sorted(files.keys())
+    rank_collectives = dict(zip(ranks, get_worker_pool().map(read_rank_collectives, [files[rank] for rank in ranks])))
+
+    collectives = align_collectives(rank_collectives)
+
+    analysis_dir = os.path.join(files_dir, "analysis")
+    os.makedirs(analysis_dir, exist_ok=True)
+    write_json(os.path.join(analysis_dir, "collectives.json"), collectives)
+    return collectives
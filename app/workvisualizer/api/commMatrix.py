@@ -0,0 +1,118 @@
+import os
+import re
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+
+"""
+Point-to-point communication matrix, from the messages traced by Caliper (CALI_MPI_MSG_TRACING).
+
+The converter writes the messages of every rank to a table (see cali2events.MessageTable). A message is
+counted once, from its sender: the bytes and the number of messages go to (sender, receiver). The time
+spent in the calls that sent or received it goes to the same pair, as send and receive time.
+
+The matrix is sparse: every rank is reduced to its (src, dst) pairs in the worker pool, and those are
+merged, so memory grows with the number of pairs that communicate, not with ranks squared. Only messages
+on communicators that span all ranks (MPI_COMM_WORLD and its duplicates) have peers that are world ranks;
+the others, and messages whose peer is not a rank (e.g. MPI_PROC_NULL), are counted as unmapped.
+
+Output:
+
+    files/analysis/comm_matrix.json: the number of ranks, the number of unmapped messages and, for every
+        (src, dst) pair that communicates, the bytes, messages, send time and receive time (in ns)
+"""
+
+VALUES = ("bytes", "count", "send.time", "recv.time")
+
+
+def aggregate_pairs(src, dst, values):
+    """Sums values ({name: array}) over the entries of each (src, dst) pair; returns src, dst, values."""
+    if len(src) == 0:
+        return src, dst, values
+    width = int(max(src.max(), dst.max())) + 1
+    pairs, entries = np.unique(src * width + dst, return_inverse=True)
+    sums = {name: np.bincount(entries, weights=value, minlength=len(pairs)).astype(np.int64)
+            for name, value in values.items()}
+    return pairs // width, pairs % width, sums
+
+
+def read_rank_messages(filepath):
+    """(src, dst) pairs and values of the messages of one rank, and how many could not be mapped."""
+    rank = int(re.search(r'messages-(\d+).json', filepath).group(1))
+    with open(filepath, "rb") as f:
+        table = orjson.loads(f.read())
+
+    columns = {column: np.array(table[column], dtype=np.int64) for column in
+               ["send", "peer", "size", "world", "dur"]}
+    # Peers that are not a world rank (e.g. MPI_ANY_SOURCE or MPI_PROC_NULL) cannot be placed either
+    world = (columns["world"] == 1) & (columns["peer"] >= 0)
+    send = columns["send"][world] == 1
+    peer, size, dur = columns["peer"][world], columns["size"][world], columns["dur"][world]
+
+    src = np.where(send, rank, peer)
+    dst = np.where(send, peer, rank)
+    values = {
+        "bytes": np.where(send, size, 0),
+        "count": send.astype(np.int64),
+        "send.time": np.where(send, dur, 0),
+        "recv.time": np.where(send, 0, dur),
+    }
+    return aggregate_pairs(src, dst, values), int(np.count_nonzero(~world))
+
+
+def merge_rank_messages(rank_messages):
+    """Merges the pairs of every rank (from read_rank_messages) into one sparse matrix."""
+    src = np.concatenate([np.zeros(0, dtype=np.int64)] + [pairs[0] for pairs, _ in rank_messages])
+    dst = np.concatenate([np.zeros(0, dtype=np.int64)] + [pairs[1] for pairs, _ in rank_messages])
+    values = {name: np.concatenate([np.zeros(0, dtype=np.int64)] + [pairs[2][name] for pairs, _ in rank_messages])
+              for name in VALUES}
+    return aggregate_pairs(src, dst, values), sum(unmapped for _, unmapped in rank_messages)
+
+
+def block_matrix(matrix, block_size):
+    """Sums the matrix over blocks of block_size consecutive ranks (rows and columns)."""
+    if block_size <= 1:
+        return matrix
+    src, dst, values = aggregate_pairs(np.array(matrix["src"], dtype=np.int64) // block_size,
+                                       np.array(matrix["dst"], dtype=np.int64) // block_size,
+                                       {name: np.array(matrix[name], dtype=np.int64) for name in VALUES})
+    blocked = {
+        "ranks": matrix["ranks"],
+        "block.size": block_size,
+        "blocks": -(-matrix["ranks"] // block_size),
+        "unmapped": matrix["unmapped"],
+        "src": src.tolist(),
+        "dst": dst.tolist(),
+    }
+    blocked.update({name: value.tolist() for name, value in values.items()})
+    return blocked
+
+
+@log_timed()
+def build_comm_matrix(files_dir):
+    files = read_rank_files(files_dir, "messages", "messages")
+
+    ranks = sorted(files.keys())
+    (src, dst, values), unmapped = merge_rank_messages(get_worker_pool().map(read_rank_messages,
+                                                                               [files[rank] for rank in ranks]))
+    num_ranks = max([rank + 1 for rank in ranks] + [int(src.max()) + 1 if len(src) > 0 else 0,
+                                                     int(dst.max()) + 1 if len(dst) > 0 else 0])
+    matrix = {
+        "ranks": num_ranks,
+        "block.size": 1,
+        "blocks": num_ranks,
+        "unmapped": unmapped,
+        "src": src.tolist(),
+        "dst": dst.tolist(),
+    }
+    matrix.update({name: value.tolist() for name, value in values.items()})
+
+    analysis_dir = os.path.join(files_dir, "analysis")
+    os.makedirs(analysis_dir, exist_ok=True)
+    write_json(os.path.join(analysis_dir, "comm_matrix.json"), matrix)
+    return matrix
@@ -0,0 +1,135 @@
+import os
+import json
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+from clockSkew import correct_times
+
+"""
+Time series of the counters (e.g. PAPI hardware counters) of every rank, at every level of detail.
+
+The converter keeps the samples of each counter of a rank as a pair of arrays (see
+cali2events.CounterSamples). Here they are moved to the common timeline (with the clock skew correction
+of the events) and reduced to a pyramid: level 0 is the samples themselves, and every level above merges
+PYRAMID_FACTOR consecutive entries of the one below into their first timestamp and their minimum and
+maximum, until a level has at most MIN_LEVEL_POINTS entries. Keeping both the minimum and the maximum
+means that a spike still shows when a long run is drawn in a few hundred pixels.
+
+A window of a series is served from the finest level that has at most the requested number of points in
+it, so the cost of a request depends on the size of the plot, not on the number of samples.
+
+Output:
+
+    files/analysis/counters/counters-<rank>.json: per counter of the rank, the levels of its pyramid,
+        each with the timestamps (in ns), minimums and maximums of its entries
+    files/analysis/counters.json: per counter, the ranks that have it, its number of samples and its
+        minimum and maximum over all ranks
+"""
+
+PYRAMID_FACTOR = 4
+
+# Levels are added until one has at most this many entries
+MIN_LEVEL_POINTS = 256
+
+
+def build_pyramid(ts, values):
+    """
+    Inputs:
+        ts (np.ndarray):        Sorted timestamps of the samples
+        values (np.ndarray):    Values of the samples
+
+    Returns:
+        levels (list):          {"ts", "min", "max"} arrays of every level, finest (the samples) first
+    """
+    levels = [{"ts": ts, "min": values, "max": values}]
+    while len(levels[-1]["ts"]) > MIN_LEVEL_POINTS:
+        below = levels[-1]
+        groups = np.arange(0, len(below["ts"]), PYRAMID_FACTOR)
+        levels.append({
+            "ts": below["ts"][groups],
+            "min": np.minimum.reduceat(below["min"], groups),
+            "max": np.maximum.reduceat(below["max"], groups),
+        })
+    return levels
+
+
+def select_window(levels, start=None, end=None, max_points=1000):
+    """
+    The entries of the finest level with at most max_points entries between start and end (or the coarsest
+    level), as (level, {"ts", "min", "max"}). The entry that covers start is included.
+    """
+    for level, entries in enumerate(levels):
+        ts = np.asarray(entries["ts"])
+        first = 0 if start is None else max(0, int(np.searchsorted(ts, start, side="right")) - 1)
+        last = len(ts) if end is None else int(np.searchsorted(ts, end, side="right"))
+        if last - first <= max_points or level == len(levels) - 1:
+            return level, {key: values[first:last] for key, values in entries.items()}
+
+
+def build_rank_pyramids(filepath, offset, drift, output_filepath):
+    """
+    Moves the counters of one counters file to the common timeline, writes their pyramids and returns
+    {counter: (samples, minimum, maximum)}.
+    """
+    with open(filepath, "rb") as f:
+        series = orjson.loads(f.read())
+
+    summary = {}
+    pyramids = {}
+    for counter, samples in series.items():
+        ts = np.array(samples["ts"], dtype=np.int64)
+        values = np.array(samples["value"], dtype=np.float64)
+        if len(ts) == 0:
+            continue
+        ts = correct_times(ts, offset, drift)
+        order = np.argsort(ts, kind="stable")
+        levels = build_pyramid(ts[order], values[order])
+        pyramids[counter] = {"levels": [{key: values.tolist() for key, values in level.items()} for level in levels]}
+        summary[counter] = (len(ts), float(values.min()), float(values.max()))
+
+    write_json(output_filepath, pyramids)
+    return summary
+
+
+@log_timed()
+def build_counter_series(files_dir):
+    files = read_rank_files(files_dir, "counters", "counters")
+
+    skew = {"offsets": {}, "drifts": {}}
+    clock_skew_file = os.path.join(files_dir, "metadata", "clock_skew.json")
+    if os.path.isfile(clock_skew_file):
+        with open(clock_skew_file) as f:
+            skew = json.load(f)
+
+    output_dir = os.path.join(files_dir, "analysis", "counters")
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = {rank: os.path.join(output_dir, f"counters-{rank}.json") for rank in files}
+    # Ranks that are gone take their pyramids with them
+    for filename in os.listdir(output_dir):
+        if os.path.join(output_dir, filename) not in output_files.values():
+            os.remove(os.path.join(output_dir, filename))
+
+    ranks = sorted(files.keys())
+    summaries = get_worker_pool().starmap(
+        build_rank_pyramids,
+        [(files[rank], skew["offsets"].get(str(rank), 0.0), skew["drifts"].get(str(rank), 0.0), output_files[rank])
+         for rank in ranks]
+    )
+
+    counters = {}
+    for rank, summary in zip(ranks, summaries):
+        for counter, (samples, minimum, maximum) in summary.items():
+            entry = counters.setdefault(counter, {"ranks": [], "samples": 0, "min": minimum, "max": maximum})
+            entry["ranks"].append(rank)
+            entry["samples"] += samples
+            entry["min"] = min(entry["min"], minimum)
+            entry["max"] = max(entry["max"], maximum)
+
+    index = {"pyramid.factor": PYRAMID_FACTOR, "counters": dict(sorted(counters.items()))}
+    write_json(os.path.join(files_dir, "analysis", "counters.json"), index, indent=4)
+    return index
@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+
+"""
+Load imbalance of every rank in every iteration, all at once.
+
+The busy time of a rank is the time it spends in calls other than MPI calls (the time in any call, minus the
+time in MPI calls). Both are unions of intervals, so the busy time up to any instant is a cumulative sum over
+the intervals found with np.searchsorted; the busy time of every iteration is the difference of its value
+at the end and at the start of the iteration. Calls that cross an iteration boundary are split at it.
+
+The imbalance of an iteration is max / mean - 1 of the busy times of the ranks (0 when all ranks are equally
+busy); the rank with the maximum is the one the others wait for.
+
+The iterations are either the time slices (the same for every rank) or the iterations found by
+tandemRepeats (each rank's own; only as many as every rank has).
+
+Output:
+
+    files/analysis/imbalance.json: for each kind of iterations, the ranks, the span of every iteration, the
+        (rank x iteration) matrix of busy times and, per iteration, the imbalance and the slowest rank
+"""
+
+MPI_TYPES = ("mpi_collective", "mpi_p2p")
+
+
+def merge_intervals(starts, ends):
+    """Union of the intervals [starts[i], ends[i]), as sorted disjoint (starts, ends)."""
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    # A new interval begins wherever a start is past everything before it
+    first = np.concatenate(([True], starts[1:] > reach[:-1]))
+    groups = np.flatnonzero(first)
+    return starts[groups], np.maximum.reduceat(ends, groups)
+
+
+def covered_time(starts, ends, times):
+    """For each of times, the total length of the sorted disjoint intervals (starts, ends) before it."""
+    times = np.asarray(times, dtype=np.int64)
+    if len(starts) == 0:
+        return np.zeros(len(times), dtype=np.int64)
+    lengths = ends - starts
+    cumulative = np.concatenate(([0], np.cumsum(lengths)))
+    last = np.searchsorted(starts, times, side="right") - 1
+    inside = np.clip(times - starts[np.maximum(last, 0)], 0, lengths[np.maximum(last, 0)])
+    return np.where(last >= 0, cumulative[np.maximum(last, 0)] + inside, 0)
+
+
+def rank_busy_times(filepath, starts, ends):
+    """Busy time (ns) of the rank of an events file in each interval [starts[i], ends[i])."""
+    with open(filepath, "rb") as f:
+        events = orjson.loads(f.read())
+    ts = np.fromiter((event["ts"] for event in events), dtype=np.int64, count=len(events))
+    dur = np.fromiter((event.get("dur", 0) for event in events), dtype=np.int64, count=len(events))
+    mpi = np.fromiter((event["type"] in MPI_TYPES for event in events), dtype=bool, count=len(events))
+
+    active = merge_intervals(ts, ts + dur)
+    waiting = merge_intervals(ts[mpi], ts[mpi] + dur[mpi])
+
+    def busy(times):
+        return covered_time(*active, times) - covered_time(*waiting, times)
+
+    return busy(ends) - busy(starts)
+
+
+def imbalance_matrix(files, intervals):
+    """
+    Inputs:
+        files (dict):           {rank: events file}
+        intervals (dict):       {rank: (starts, ends)} of the iterations of each rank, all of the same length
+
+    Returns:
+        result (dict):          ranks, span of each iteration, busy times (rank x iteration), and per
+                                iteration the imbalance and the slowest rank
+    """
+    ranks = sorted(rank for rank in files if rank in intervals)
+    if len(ranks) == 0:
+        return {"ranks": [], "iterations": [], "busy": [], "imbalance": [], "slowest.rank": []}
+
+    busy = np.array(get_worker_pool().starmap(rank_busy_times, [(files[rank], *intervals[rank]) for rank in ranks]),
+                    dtype=np.int64).reshape(len(ranks), -1)
+    mean = busy.mean(axis=0)
+    imbalance = np.divide(busy.max(axis=0), mean, out=np.ones_like(mean), where=mean > 0) - 1
+
+    starts = np.min([intervals[rank][0] for rank in ranks], axis=0)
+    ends = np.max([intervals[rank][1] for rank in ranks], axis=0)
+    return {
+        "ranks": ranks,
+        "iterations": np.stack([starts, ends], axis=1).tolist(),
+        "busy": busy.tolist(),
+        "imbalance": imbalance.tolist(),
+        "slowest.rank": [ranks[i] for i in np.argmax(busy, axis=0)]
+    }
+
+
+def slice_intervals(slices, ranks):
+    """The time slices, as the intervals of every rank."""
+    bounds = np.array(slices, dtype=np.int64).reshape(-1, 2)
+    return {rank: (bounds[:, 0], bounds[:, 1]) for rank in ranks}
+
+
+def iteration_intervals(iterations):
+    """The iterations of every rank that has some, cut to the number of iterations every one of them has."""
+    ranks = {int(rank): rank_iterations for rank, rank_iterations in iterations["ranks"].items()
+             if len(rank_iterations["boundaries"]) > 0}
+    if len(ranks) == 0:
+        return {}
+    count = min(len(rank_iterations["boundaries"]) for rank_iterations in ranks.values())
+    intervals = {}
+    for rank, rank_iterations in ranks.items():
+        starts = np.array(rank_iterations["boundaries"][:count], dtype=np.int64)
+        intervals[rank] = (starts, starts + np.array(rank_iterations["durations"][:count], dtype=np.int64))
+    return intervals
+
+
+@log_timed()
+def analyze_imbalance(files_dir):
+    files = read_rank_files(files_dir, "events", "events")
+
+    analysis_dir = os.path.join(files_dir, "analysis")
+    with open(os.path.join(analysis_dir, "slices.json"), "rb") as f:
+        slices = orjson.loads(f.read())["slices"]
+    with open(os.path.join(analysis_dir, "iterations.json"), "rb") as f:
+        iterations = orjson.loads(f.read())
+
+    imbalance = {
+        "slices": imbalance_matrix(files, slice_intervals(slices, files.keys())),
+        "iterations": imbalance_matrix(files, iteration_intervals(iterations))
+    }
+    write_json(os.path.join(analysis_dir, "imbalance.json"), imbalance)
+    return imbalance
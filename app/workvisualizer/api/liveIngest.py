@@ -0,0 +1,207 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+
+from logging_utils.logging_utils import log_timed
+from cali2events import CaliTraceEventConverter, RANK_OUTPUT_DIRS
+
+"""
+Follow mode: convert .cali files while the application is still writing them.
+
+Every file in the watched directory is tailed by its own converter. New complete lines are fed to the
+converter's stream reader as they appear, so records go through CaliTraceEventConverter._process_record
+exactly once, in file order (like the memory-budget conversion), and begin/end pairs are matched across
+polls. Only the events that were closed so far are published; open regions show up once they end.
+
+This needs Caliper to flush its trace buffers while the run is going (e.g. CALI_TRACE_BUFFER_POLICY=flush);
+by default, snapshots are only written when the program ends.
+
+Snapshots are written to a staging directory and moved into the files directory one file at a time, after
+which the publish callback (normally the pipeline up to aggregation) brings the metadata up to date; both
+happen within one write of the pipeline, so they make up a single generation of the artifacts. A
+snapshot is published at most every snapshot_interval seconds, so the data served lags the files on disk
+by about snapshot_interval plus the time it takes to publish.
+"""
+
+LIVE_CONVERTER_CONFIG = {
+    "pretty_print": True,
+    "counters": {},
+    "tid_attributes": [],
+    "pid_attributes": [],
+    "verbose": False
+}
+
+
+class CaliFileTail:
+    """Follows one growing .cali file."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.reset()
+
+    def reset(self):
+        self.converter = CaliTraceEventConverter(dict(LIVE_CONVERTER_CONFIG))
+        self.offset = 0
+        self.partial = b""
+        self.published_events = 0
+
+    def poll(self):
+        """Processes the lines appended since the last poll; returns the number of bytes read."""
+        size = os.path.getsize(self.filepath)
+        if size < self.offset:
+            # The file was truncated or replaced; start over
+            self.reset()
+        if size == self.offset:
+            return 0
+
+        with open(self.filepath, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+
+        # A line that is still being written is kept for the next poll
+        data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        if end > 0:
+            self.converter.read(data[:end].decode().splitlines(keepends=True))
+        return len(data)
+
+    @property
+    def num_events(self):
+        return len(self.converter.events) + len(self.converter.records)
+
+    def has_new_events(self):
+        # Nothing can be written before the first event is closed (e.g. only records were read so far)
+        return len(self.converter.events) > 0 and self.num_events > self.published_events
+
+    def write(self, files_dir):
+        """Writes the outputs of everything converted so far; returns their paths."""
+        outputs = self.converter.write(files_dir)
+        self.published_events = self.num_events
+        return outputs
+
+
+class LiveIngest:
+    """
+    Tails the .cali files of a running application and periodically publishes them to files_dir.
+
+    Inputs:
+        watch_dir (str):            Directory the application writes its .cali files to
+        files_dir (str):            WorkVisualizer files directory the snapshots are published to
+        publish (callable):         Called with files_dir after every snapshot (e.g. to re-run the pipeline)
+        writing (callable):         Context manager held while a snapshot is published (e.g. Pipeline.writing)
+        poll_interval (float):      Seconds between two reads of the watched files
+        snapshot_interval (float):  Minimum number of seconds between two snapshots
+    """
+
+    def __init__(self, watch_dir, files_dir, publish=None, writing=contextlib.nullcontext, poll_interval=1.0,
+                 snapshot_interval=10.0):
+        self.watch_dir = watch_dir
+        self.files_dir = files_dir
+        self.publish = publish
+        self.writing = writing
+        self.poll_interval = poll_interval
+        self.snapshot_interval = snapshot_interval
+
+        self.tails = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # Status
+        self.started = None
+        self.snapshots = 0
+        self.bytes_read = 0
+        self.last_read = None
+        self.last_snapshot = None
+        self.error = None
+
+    def discover(self):
+        for filename in sorted(os.listdir(self.watch_dir)):
+            filepath = os.path.join(self.watch_dir, filename)
+            if filename.endswith(".cali") and filepath not in self.tails:
+                self.tails[filepath] = CaliFileTail(filepath)
+
+    def poll(self):
+        """Reads whatever was appended to the watched files; returns the number of bytes read."""
+        self.discover()
+        bytes_read = 0
+        for tail in self.tails.values():
+            bytes_read += tail.poll()
+        if bytes_read > 0:
+            self.bytes_read += bytes_read
+            self.last_read = time.time()
+        return bytes_read
+
+    @log_timed()
+    def snapshot(self):
+        """Publishes the files that have new events; returns False if there was nothing to publish."""
+        tails = [tail for tail in self.tails.values() if tail.has_new_events()]
+        if len(tails) == 0:
+            return False
+
+        # Write next to the files directory and move the finished files in, so that no reader ever sees
+        # a half-written file
+        staging_dir = tempfile.mkdtemp(prefix="live-", dir=self.files_dir)
+        try:
+            for subdir in RANK_OUTPUT_DIRS + [os.path.join("metadata", "procs")]:
+                os.makedirs(os.path.join(staging_dir, subdir))
+            outputs = [output for tail in tails for output in tail.write(staging_dir)]
+
+            with self.writing():
+                for output in outputs:
+                    os.replace(output, os.path.join(self.files_dir, os.path.relpath(output, staging_dir)))
+                if self.publish is not None:
+                    self.publish(self.files_dir)
+        finally:
+            shutil.rmtree(staging_dir)
+
+        self.snapshots += 1
+        self.last_snapshot = time.time()
+        return True
+
+    def run(self):
+        next_snapshot = 0
+        try:
+            while not self.stop_event.is_set():
+                self.poll()
+                if time.time() >= next_snapshot and self.snapshot():
+                    next_snapshot = time.time() + self.snapshot_interval
+                self.stop_event.wait(self.poll_interval)
+
+            # Publish whatever arrived since the last snapshot
+            self.poll()
+            self.snapshot()
+        except Exception as e:
+            self.error = str(e)
+            raise
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, name="live-ingest", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def status(self):
+        pending = any(tail.has_new_events() for tail in self.tails.values())
+        return {
+            "running": self.is_running(),
+            "directory": self.watch_dir,
+            "files": len(self.tails),
+            "ranks": sorted(rank for tail in self.tails.values() for rank in tail.converter.known_ranks),
+            "bytes_read": self.bytes_read,
+            "snapshots": self.snapshots,
+            # Seconds the published data is behind what was read, if it is behind
+            "lag": time.time() - (self.last_snapshot or self.started) if pending else 0.0,
+            "error": self.error
+        }
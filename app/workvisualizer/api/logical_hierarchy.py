@@ -36,6 +36,8 @@
 import os
 import json
 
+from atomic_io import write_json
+
 class LogicalHierarchy:
 
     def __init__(self, events_file, ftn_id: int = -1, maximum_depth: int = -1):
@@ -124,5 +126,4 @@ def generate_logical_hierarchy_from_root(events_file, output_file, ftn_id: int =
     logical_dir = os.path.dirname(output_file)
     os.makedirs(logical_dir, exist_ok=True)
 
-    with open(output_file, "w") as out_json:
-        json.dump(hierarchy, out_json, indent=1)
+    write_json(output_file, hierarchy, indent=1)
@@ -33,10 +33,28 @@
 # ************************************************************************
 #
 from logging_utils.logging_utils import log_timed, set_log_level
-from cali2events import convert_cali_to_json
+from cali2events import convert_cali_to_json, rank_output_files, PARALLEL_PARSE_MIN_BYTES, RANK_OUTPUT_DIRS
 from sliceAnalysis import run_slice_analysis
-from aggregateMetadata import aggregate_metadata
+from aggregateMetadata import aggregate_metadata, CALLTYPES
+from clockSkew import correct_clock_skew
+from periodicity import detect_periodicity, detect_rank_periodicity, boundaries_to_slices
+from tandemRepeats import detect_iterations
+from imbalance import analyze_imbalance
+from collectiveWait import analyze_collective_wait, collective_matrices
+from commMatrix import build_comm_matrix, block_matrix
+from counterSeries import build_counter_series, select_window
+from liveIngest import LiveIngest
+from rankSampling import PREVIEW_SAMPLE_SIZE, select_preview_files, refinement_batches
 from logical_hierarchy import generate_logical_hierarchy_from_root
+from pipeline import Stage, Pipeline
+from atomic_io import write_json
+from rank_files import read_rank_files
+from singleflight import SingleFlight
+from worker_pool import get_worker_pool, shutdown_worker_pool
+from time_units import events_to_seconds, hierarchy_to_seconds, metadata_to_seconds, slice_stats_to_seconds, \
+    timeslices_to_seconds, periodicity_to_seconds, iterations_to_seconds, \
+    imbalance_to_seconds, collectives_to_seconds, comm_matrix_to_seconds, \
+    counter_window_to_seconds, seconds_to_ns
 import representativeRank
 import timeSlice
 
@@ -45,7 +63,10 @@ import aiofiles
 import os
 import sys
 import re
+import shutil
+import threading
 from typing import List
+from contextlib import asynccontextmanager
 import concurrent.futures
 
 import numpy as np
@@ -60,7 +81,18 @@ from fastapi.responses import JSONResponse
 ####################################
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the shared worker pool with the server and stop it with the server
+    get_worker_pool().warm()
+    # The default dataset is always there, so that the dashboard works before anything is uploaded
+    get_workspace(DEFAULT_DATASET, create=True)
+    yield
+    for workspace in list(workspaces.values()):
+        workspace.stop()
+    shutdown_worker_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -70,7 +102,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-files_dir = os.path.join(os.getcwd(), "files")
+# Every dataset has its own artifact tree in files/<dataset>
+files_root = os.path.join(os.getcwd(), "files")
+DEFAULT_DATASET = "default"
+
+# Optional bound on the converter's memory (in MB); above it, events are spilled to disk
+conversion_memory_budget = None
+if "WV_CONVERSION_MEMORY_BUDGET_MB" in os.environ:
+    conversion_memory_budget = int(os.environ["WV_CONVERSION_MEMORY_BUDGET_MB"]) * 1024 * 1024
+
+# Workspaces that were used since the server started, by dataset name
+workspaces = {}
+workspaces_lock = threading.Lock()
+
+# Concurrent requests for the same analysis of the same dataset share one computation
+analysis_flights = SingleFlight()
 
 
 ####################################
@@ -102,6 +148,12 @@ def create_files_directory(files_directory):
     unique_dir = os.path.join(files_directory, "unique-events")
     os.makedirs(unique_dir, exist_ok=True)
 
+    messages_dir = os.path.join(files_directory, "messages")
+    os.makedirs(messages_dir, exist_ok=True)
+
+    counters_dir = os.path.join(files_directory, "counters")
+    os.makedirs(counters_dir, exist_ok=True)
+
     metadata_dir = os.path.join(files_directory, "metadata")
     os.makedirs(metadata_dir, exist_ok=True)
 
@@ -109,9 +161,10 @@ def create_files_directory(files_directory):
     os.makedirs(metadata_proc_dir, exist_ok=True)
 
 @app.post("/api/clear")
-async def clear_files_dir():
-    remove_existing_files(files_dir)
-    create_files_directory(files_dir)
+@log_timed()
+def clear_files_dir(dataset: str = DEFAULT_DATASET):
+    """Not async: clearing waits for the pipeline lock, which would block the event loop."""
+    get_workspace(dataset).clear()
 
 @log_timed()
 def get_data_from_json(filepath, depth=-1):
@@ -149,6 +202,115 @@ def get_available_viz_componenents():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/util/workerpool")
+def get_worker_pool_metrics():
+    return get_worker_pool().metrics()
+
+@app.get("/api/util/singleflight")
+def get_single_flight_metrics():
+    return analysis_flights.metrics()
+
+
+###################################
+###          Datasets           ###
+###################################
+
+
+class Workspace:
+    """
+    One dataset: its artifact tree, its pipeline (whose manifest caches the results of every stage)
+    and the background work running on it. Workspaces stay resident once used, so switching between
+    datasets does not convert anything again, and each one has its own pipeline lock, so different
+    datasets can be converted concurrently.
+    """
+
+    def __init__(self, name, files_dir):
+        self.name = name
+        self.files_dir = files_dir
+        create_files_directory(files_dir)
+        self.pipeline = build_pipeline(files_dir)
+
+        # Follows the .cali files of a running application (see /api/live/start)
+        self.live_ingest = None
+
+        # Converts the files that were left out of a preview (see /api/unpack?preview=true)
+        self.preview_refinement = None
+        self.preview_error = None
+
+    def clear(self):
+        """Removes every file of the dataset; readers see the next generation once it is empty."""
+        with self.pipeline.writing():
+            remove_existing_files(self.files_dir)
+            create_files_directory(self.files_dir)
+
+    def stop(self):
+        if self.live_ingest is not None:
+            self.live_ingest.stop()
+        if self.preview_refinement is not None:
+            self.preview_refinement.join()
+
+def run_analysis(workspace, analysis, fn, *args, params=()):
+    """
+    Runs fn(*args) unless the same analysis (with the same parameters) of the same dataset is already
+    running, in which case its result is awaited instead. The callers read the results from disk.
+    """
+    return analysis_flights.do((workspace.name, analysis, tuple(params)), fn, *args)
+
+def run_stage(workspace, stage):
+    """Brings the given pipeline stage of a dataset up to date, sharing the run with concurrent requests."""
+    return run_analysis(workspace, stage, workspace.pipeline.run, [stage])
+
+def get_workspace(dataset, create=False):
+    """
+    Returns the workspace of the given dataset, loading it on first use. Datasets are only created on disk
+    when create is set (uploads and live ingestion); otherwise an unknown dataset is a 404.
+    """
+    if re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_.-]*', dataset) is None:
+        raise HTTPException(status_code=400, detail=f"Invalid dataset name: {dataset}")
+    with workspaces_lock:
+        if dataset not in workspaces:
+            files_dir = os.path.join(files_root, dataset)
+            if not create and not os.path.isdir(files_dir):
+                raise HTTPException(status_code=404, detail=f"Dataset {dataset} was not found.")
+            workspaces[dataset] = Workspace(dataset, files_dir)
+        return workspaces[dataset]
+
+def get_generation(files_dir):
+    """Generation marker of a dataset (see pipeline); it changes whenever its artifacts change."""
+    filepath = os.path.join(files_dir, Pipeline.generation_filename)
+    return get_data_from_json(filepath) if os.path.isfile(filepath) else {"generation": 0, "writing": False}
+
+@app.get("/api/datasets")
+@log_timed()
+def get_datasets():
+    """Lists the datasets on disk and whether each one has been converted."""
+    os.makedirs(files_root, exist_ok=True)
+    datasets = {}
+    for dataset in sorted(os.listdir(files_root)):
+        files_dir = os.path.join(files_root, dataset)
+        if os.path.isdir(files_dir):
+            datasets[dataset] = {
+                "files": len(os.listdir(os.path.join(files_dir, "cali"))) if os.path.isdir(os.path.join(files_dir, "cali")) else 0,
+                "converted": os.path.isfile(os.path.join(files_dir, "metadata", "metadata.json")),
+                "generation": get_generation(files_dir),
+                "resident": dataset in workspaces
+            }
+    return datasets
+
+@app.delete("/api/datasets/{dataset}")
+@log_timed()
+def remove_dataset(dataset: str):
+    """Stops whatever runs on the dataset and deletes its files."""
+    workspace = get_workspace(dataset)
+    workspace.stop()
+    # Wait for the pipeline run in progress (if any); later runs find the directory gone (see Pipeline.run)
+    with workspace.pipeline.lock:
+        with workspaces_lock:
+            workspaces.pop(dataset, None)
+        shutil.rmtree(workspace.files_dir, ignore_errors=True)
+    return {"message": f"Removed dataset {dataset}."}
+
+
 ###################################
 ###           Logging           ###
 ###################################
@@ -169,44 +331,189 @@ def set_log_level_endpoint(log_level: str):
 ###################################
 
 
-def chunk_list(lst, chunk_size):
-    """Divide the given list into a set of chunks with size chunk_size."""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i:i + chunk_size]
+def get_conversions_filepath(files_dir):
+    return os.path.join(files_dir, "metadata", "conversions.json")
+
+def read_conversions(files_dir):
+    """Returns {cali filename: {"signature", "ranks", "outputs"}} for every converted file."""
+    filepath = get_conversions_filepath(files_dir)
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath) as f:
+        return json.load(f)
+
+def write_conversions(files_dir, conversions):
+    write_json(get_conversions_filepath(files_dir), conversions, indent=4)
+
+def get_file_signature(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def has_conversion_outputs(files_dir, conversion):
+    """
+    Whether every output of a converted file is there: the ones that were recorded, and every per-rank
+    output of its ranks (a file converted by an older converter may not have all of them).
+    """
+    expected_outputs = [os.path.join(files_dir, output) for output in conversion["outputs"]] + \
+        [output for rank in conversion["ranks"] for output in rank_output_files(files_dir, rank)]
+    return all(os.path.isfile(output) for output in expected_outputs)
+
+def conversions_complete(files_dir):
+    """Whether every converted file still has all of its outputs (see has_conversion_outputs)."""
+    conversions = read_conversions(files_dir) or {}
+    return all(has_conversion_outputs(files_dir, conversion) for conversion in conversions.values())
+
+def convert_stage(files_dir, filenames=None):
+    """
+    Converts the files in the cali directory that are new or changed since the last conversion.
+
+    Every converted file is recorded with its size, modification time, ranks and outputs, so that a
+    re-uploaded file only replaces its own ranks and a deleted file only takes its own outputs away.
+    The aggregate stage then merges the per-rank files again.
+
+    If filenames is given, only those files are converted (e.g. the sample of a preview).
+    """
+    cali_dir = os.path.join(files_dir, "cali")
+    signatures = {filename: get_file_signature(os.path.join(cali_dir, filename)) for filename in os.listdir(cali_dir)}
+
+    conversions = read_conversions(files_dir)
+    if conversions is None:
+        # Nothing is known about the outputs that are there; start over
+        conversions = {}
+        for output_dir in RANK_OUTPUT_DIRS + [os.path.join("metadata", "procs")]:
+            remove_existing_files(os.path.join(files_dir, output_dir))
+
+    # Outputs of removed or changed files must not survive the conversion. Files with missing outputs
+    # (deleted, or from an older converter that did not write them) are converted again as well.
+    for filename in list(conversions.keys()):
+        if signatures.get(filename) != conversions[filename]["signature"] or \
+                not has_conversion_outputs(files_dir, conversions[filename]):
+            for output in conversions.pop(filename)["outputs"]:
+                output_path = os.path.join(files_dir, output)
+                if os.path.isfile(output_path):
+                    os.remove(output_path)
+
+    input_files = [os.path.join(cali_dir, filename) for filename in signatures
+                   if filename not in conversions and (filenames is None or filename in filenames)]
+
+    # Submit one task per file, largest first (longest-processing-time first scheduling), so that
+    # the big ranks start early and the small ones fill in the gaps at the end. The per-file
+    # outputs are merged by the aggregate stage.
+    input_files.sort(key=os.path.getsize, reverse=True)
+
+    # With fewer files than workers, the spare cores are used to parse the big files in parallel. Those
+    # are converted from threads of this process, which split them into byte ranges that are decoded on
+    # the shared pool (a pool worker cannot submit to the pool itself).
+    pool = get_worker_pool()
+    parse_workers = max(1, pool.max_workers // max(1, len(input_files)))
+    split_files = [input_file for input_file in input_files
+                   if parse_workers > 1 and os.path.getsize(input_file) >= PARALLEL_PARSE_MIN_BYTES]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(split_files))) as threads:
+        futures = {}
+        for input_file in input_files:
+            if input_file in split_files:
+                future = threads.submit(convert_cali_to_json, [input_file], files_dir, conversion_memory_budget,
+                                        parse_workers)
+            else:
+                future = pool.submit(convert_cali_to_json, [input_file], files_dir, conversion_memory_budget)
+            futures[future] = os.path.basename(input_file)
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                ranks, outputs = future.result()
+                filename = futures[future]
+                conversions[filename] = {
+                    "signature": signatures[filename],
+                    "ranks": ranks,
+                    "outputs": [os.path.relpath(output, files_dir) for output in outputs]
+                }
+        finally:
+            # Keep track of whatever was converted, even if another file failed
+            write_conversions(files_dir, conversions)
 
 @app.post("/api/unpack")
-def unpack_cali():
+def unpack_cali(dataset: str = DEFAULT_DATASET, preview: bool = False, sample_size: int = PREVIEW_SAMPLE_SIZE):
     """
     Called from the FileUploadButton; reads all of the files in the cali
     directory and converts them to JSON.
-    """
-    cali_dir = os.path.join(files_dir, "cali")
-    input_files = [os.path.join(cali_dir, filename) for filename in os.listdir(cali_dir)]
 
-    if len(input_files) == 0:
+    With preview, only a sample of the files is converted before returning;
+    the others are converted in the background (see unpack_preview).
+    """
+    workspace = get_workspace(dataset)
+    if preview and sample_size < 1:
+        raise HTTPException(status_code=400, detail=f"Invalid sample size: {sample_size}")
+    cali_dir = os.path.join(workspace.files_dir, "cali")
+    if len(os.listdir(cali_dir)) == 0:
         return {"message": "No input .cali file was found."}
 
-    # Determine the number of CPU cores
-    num_cores = os.cpu_count()
-    chunk_size = max(1, len(input_files) // num_cores)  # Adjust chunk size based on the number of CPU cores
+    if preview:
+        return unpack_preview(workspace, sample_size)
+    workspace.pipeline.run(["aggregate"])
 
-    chunks = list(chunk_list(input_files, chunk_size))
+@log_timed()
+def unpack_preview(workspace, sample_size):
+    """
+    Converts a stratified sample of the files (see rankSampling), publishes the metadata and the
+    representative rank of the sample, and starts converting the remaining files in the background.
+    """
+    if workspace.preview_refinement is not None and workspace.preview_refinement.is_alive():
+        raise HTTPException(status_code=409, detail="The previous preview is still being refined.")
+
+    cali_dir = os.path.join(workspace.files_dir, "cali")
+    sizes = {filename: os.path.getsize(os.path.join(cali_dir, filename)) for filename in os.listdir(cali_dir)}
+    sample = select_preview_files(sizes, sample_size=sample_size)
+
+    with workspace.pipeline.writing():
+        convert_stage(workspace.files_dir, filenames=sample)
+        workspace.pipeline.run(["aggregate", "representative_rank"], skip=["convert"])
+
+    # Largest first, like the convert stage
+    remaining = sorted((filename for filename in sizes if filename not in sample), key=sizes.get, reverse=True)
+    workspace.preview_error = None
+    workspace.preview_refinement = threading.Thread(
+        target=refine_preview, args=(workspace, refinement_batches(remaining, len(sample))),
+        name=f"preview-refinement-{workspace.name}", daemon=True
+    )
+    workspace.preview_refinement.start()
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [executor.submit(convert_cali_to_json, chunk, files_dir) for chunk in chunks]
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
+    return {"message": f"Converted {len(sample)} of {len(sizes)} files.", "sample": sample,
+            "remaining": len(remaining)}
 
-    aggregate_metadata(files_dir)
-    remove_existing_files(os.path.join(files_dir, "metadata", "procs"))
+@log_timed()
+def refine_preview(workspace, batches):
+    """Converts the remaining files batch by batch, aggregating the metadata again after each batch."""
+    pipeline = workspace.pipeline
+    try:
+        for batch in batches:
+            # Other pipeline runs wait for the batch instead of converting the same files
+            with pipeline.writing():
+                convert_stage(workspace.files_dir, filenames=batch)
+                pipeline.run(["aggregate"], skip=["convert"])
+        pipeline.run(["representative_rank"])
+    except Exception as e:
+        workspace.preview_error = str(e)
+        raise
+
+@app.get("/api/preview")
+def get_preview_status(dataset: str = DEFAULT_DATASET):
+    """How far the conversion of the files left out of the preview has come."""
+    workspace = get_workspace(dataset)
+    conversions = read_conversions(workspace.files_dir) or {}
+    return {
+        "refining": workspace.preview_refinement is not None and workspace.preview_refinement.is_alive(),
+        "converted": len(conversions),
+        "total": len(os.listdir(os.path.join(workspace.files_dir, "cali"))),
+        "error": workspace.preview_error
+    }
 
 @app.post("/api/upload")
-async def upload_cali_files(files: List[UploadFile] = File(...)):
+async def upload_cali_files(files: List[UploadFile] = File(...), dataset: str = DEFAULT_DATASET):
     """
     Called from the FileUploadButton; takes in the full list of .cali files
-    and writes them to the local cali directory.
+    and writes them to the cali directory of the dataset.
     """
-    cali_dir = os.path.join(files_dir, "cali")
+    cali_dir = os.path.join(get_workspace(dataset, create=True).files_dir, "cali")
     for file in files:
         try:
             contents = await file.read()
@@ -219,6 +526,88 @@ async def upload_cali_files(files: List[UploadFile] = File(...)):
     return {"message": "Successfully uploaded files."}
 
 
+@app.get("/api/ranks")
+@log_timed()
+def get_converted_ranks(dataset: str = DEFAULT_DATASET):
+    """Lists the ranks that were converted from each uploaded file."""
+    conversions = read_conversions(get_workspace(dataset).files_dir) or {}
+    return {filename: conversion["ranks"] for filename, conversion in conversions.items()}
+
+@app.delete("/api/ranks/{rank}")
+@log_timed()
+def remove_rank(rank: int, dataset: str = DEFAULT_DATASET):
+    """
+    Removes the file(s) that the given rank was converted from, along with its outputs.
+
+    Uploading a file with the same name replaces its ranks instead; either way, only the affected
+    files are converted again and only the stages whose inputs changed are re-run.
+    """
+    workspace = get_workspace(dataset)
+    files_dir = workspace.files_dir
+    conversions = read_conversions(files_dir) or {}
+    filenames = [filename for filename, conversion in conversions.items() if rank in conversion["ranks"]]
+    if len(filenames) == 0:
+        raise HTTPException(status_code=404, detail=f"Rank {rank} was not found.")
+
+    for filename in filenames:
+        os.remove(os.path.join(files_dir, "cali", filename))
+
+    if len(os.listdir(os.path.join(files_dir, "cali"))) > 0:
+        workspace.pipeline.run(["aggregate"])
+    else:
+        # That was the last file; nothing is left to show
+        workspace.clear()
+    return {"message": f"Removed {', '.join(filenames)}."}
+
+
+@app.post("/api/live/start")
+@log_timed()
+def start_live_ingest(directory: str, dataset: str = DEFAULT_DATASET, poll_interval: float = 1.0,
+                      snapshot_interval: float = 10.0):
+    """
+    Starts following the .cali files that a running application writes to the given directory.
+
+    The dataset is replaced; a snapshot of everything converted so far is published (and
+    aggregated) at most every snapshot_interval seconds until /api/live/stop is called.
+    """
+    if not os.path.isdir(directory):
+        raise HTTPException(status_code=404, detail=f"Directory {directory} was not found.")
+    workspace = get_workspace(dataset, create=True)
+    files_dir = workspace.files_dir
+    if workspace.live_ingest is not None and workspace.live_ingest.is_running():
+        raise HTTPException(status_code=409, detail=f"Already following {workspace.live_ingest.watch_dir}.")
+
+    with workspace.pipeline.writing():
+        workspace.clear()
+        # The live outputs are not converted from the cali directory; an empty record keeps the convert
+        # stage from clearing them
+        write_conversions(files_dir, {})
+
+    workspace.live_ingest = LiveIngest(directory, files_dir,
+                                       publish=lambda files_dir: workspace.pipeline.run(["aggregate"]),
+                                       writing=workspace.pipeline.writing,
+                                       poll_interval=poll_interval, snapshot_interval=snapshot_interval)
+    workspace.live_ingest.start()
+    return workspace.live_ingest.status()
+
+@app.post("/api/live/stop")
+@log_timed()
+def stop_live_ingest(dataset: str = DEFAULT_DATASET):
+    """Stops following the application, after publishing what was read last."""
+    live_ingest = get_workspace(dataset).live_ingest
+    if live_ingest is None:
+        raise HTTPException(status_code=404, detail="Live ingestion was not started.")
+    live_ingest.stop()
+    return live_ingest.status()
+
+@app.get("/api/live/status")
+def get_live_ingest_status(dataset: str = DEFAULT_DATASET):
+    live_ingest = get_workspace(dataset).live_ingest
+    if live_ingest is None:
+        return {"running": False}
+    return live_ingest.status()
+
+
 ###################################
 ###      Viz API Endpoints      ###
 ###################################
@@ -227,49 +616,68 @@ async def upload_cali_files(files: List[UploadFile] = File(...)):
 # Summary Table
 @app.get("/api/metadata/{depth}/{rank}")
 @log_timed()
-def get_metadata():
-    metadata_dir = os.path.join(files_dir, "metadata")
+def get_metadata(dataset: str = DEFAULT_DATASET):
+    metadata_dir = os.path.join(get_workspace(dataset).files_dir, "metadata")
     filename = f"metadata.json"
     filepath = os.path.join(metadata_dir, filename)
-    return get_data_from_json(filepath)
+    return metadata_to_seconds(get_data_from_json(filepath))
 
 # Events Plot
 @app.get("/api/eventsplot/{depth}/{rank}")
 @log_timed()
-def get_eventsplot_data(depth, rank):
-    events_dir = os.path.join(files_dir, "events")
+def get_eventsplot_data(depth, rank, dataset: str = DEFAULT_DATASET):
+    events_dir = os.path.join(get_workspace(dataset).files_dir, "events")
     filename = f"events-{rank}.json"
     filepath = os.path.join(events_dir, filename)
-    return get_data_from_json(filepath, depth=int(depth))
+    return events_to_seconds(get_data_from_json(filepath, depth=int(depth)))
 
 # Analysis Viewer
 @app.get("/api/analysisviewer/{depth}/{rank}")
 @log_timed()
-def get_analysisviewer_data():
-    analysis_dir = os.path.join(files_dir, "analysis")
+def get_analysisviewer_data(dataset: str = DEFAULT_DATASET):
+    analysis_dir = os.path.join(get_workspace(dataset).files_dir, "analysis")
     filename = f"all_ranks_analyzed.json"
     filepath = os.path.join(analysis_dir, filename)
     if not os.path.isfile(filepath):
         return None
-    return get_data_from_json(filepath)
+    return slice_stats_to_seconds(get_data_from_json(filepath))
 
 # Proportion Analyzer and Call Tree
-@app.get("/api/logical_hierarchy/{ftn_id}/{depth}/{rank}")
+def get_logical_hierarchy_filepath(files_dir, ftn_id, depth, rank):
+    logical_dir = os.path.join(files_dir, "logical_hierarchy")
+    root_desc = "root" if str(ftn_id) == "-1" else f"root_{ftn_id}"
+    depth_desc = "depth_full" if str(depth) == "-1" else f"depth_{depth}"
+    filename = f"logical_hierarchy_rank_{rank}_root_{root_desc}_{depth_desc}.json"
+    return os.path.join(logical_dir, filename)
+
 @log_timed()
-def get_logical_hierarchy_data(ftn_id, depth, rank):
-    unique_dir = os.path.join(files_dir, "unique-events")
+def generate_default_logical_hierarchies(files_dir, default_depth=5):
+    """Generates the hierarchy requested by the dashboard (full tree, default depth) for every rank."""
     logical_dir = os.path.join(files_dir, "logical_hierarchy")
 
-    root_desc = "root" if ftn_id == "-1" else f"root_{ftn_id}"
-    depth_desc = "depth_full" if depth == "-1" else f"depth_{depth}"
-    filename = f"logical_hierarchy_rank_{rank}_root_{root_desc}_{depth_desc}.json"
-    filepath = os.path.join(logical_dir, filename)
+    # Hierarchies generated on demand from older unique events are stale now
+    remove_existing_files(logical_dir)
 
-    unique_events_file = os.path.join(unique_dir, f"unique-events-{rank}.json")
-    if not os.path.isfile(filepath):
-        generate_logical_hierarchy_from_root(unique_events_file, filepath, ftn_id=int(ftn_id), depth=int(depth))
+    for rank, unique_events_file in read_rank_files(files_dir, "unique-events", "unique-events").items():
+        filepath = get_logical_hierarchy_filepath(files_dir, -1, default_depth, rank)
+        generate_logical_hierarchy_from_root(unique_events_file, filepath, depth=default_depth)
 
-    return get_data_from_json(filepath)
+@app.get("/api/logical_hierarchy/{ftn_id}/{depth}/{rank}")
+@log_timed()
+def get_logical_hierarchy_data(ftn_id, depth, rank, dataset: str = DEFAULT_DATASET):
+    workspace = get_workspace(dataset)
+    files_dir = workspace.files_dir
+    filepath = get_logical_hierarchy_filepath(files_dir, ftn_id, depth, rank)
+
+    def generate():
+        workspace.pipeline.run(["logical_hierarchies"])
+        unique_events_file = os.path.join(files_dir, "unique-events", f"unique-events-{rank}.json")
+        if not os.path.isfile(filepath):
+            generate_logical_hierarchy_from_root(unique_events_file, filepath, ftn_id=int(ftn_id), depth=int(depth))
+
+    run_analysis(workspace, "logical_hierarchy", generate, params=(str(ftn_id), str(depth), str(rank)))
+
+    return hierarchy_to_seconds(get_data_from_json(filepath))
 
 
 ####################################
@@ -277,17 +685,68 @@ def get_logical_hierarchy_data(ftn_id, depth, rank):
 ####################################
 
 
+def parse_call_types(call_type):
+    """Splits a comma-separated list of call types (e.g. "mpi_p2p,mpi_collective"); None selects all."""
+    if call_type is None:
+        return None
+    call_types = sorted(set(call_type.split(",")))
+    unknown = [name for name in call_types if name not in CALLTYPES]
+    if len(unknown) > 0:
+        raise HTTPException(status_code=400, detail=f"Unknown call type(s) {', '.join(unknown)}; expected {', '.join(CALLTYPES)}.")
+    return call_types
+
+def get_representative_rank_filepaths(files_dir, depth=-1, call_types=None):
+    """Result files (representative rank, rank clusters) of one parameter set; the stage writes the default one."""
+    analysis_dir = os.path.join(files_dir, "analysis")
+    if depth == -1 and call_types is None:
+        params_desc = ""
+    else:
+        depth_desc = "full" if depth == -1 else depth
+        type_desc = "all" if call_types is None else "-".join(sorted(call_types))
+        params_desc = f"_depth_{depth_desc}_type_{type_desc}"
+    return os.path.join(analysis_dir, f"representative_rank{params_desc}.json"), \
+        os.path.join(analysis_dir, f"rank_clusters{params_desc}.json")
+
+def compute_representative_rank(workspace, depth=-1, call_types=None):
+    """
+    Brings the representative rank of the given parameter set up to date and returns its result files.
+
+    The default analysis is a pipeline stage; every other parameter set is computed on demand and cached
+    until the stage runs again on new events.
+    """
+    filepaths = get_representative_rank_filepaths(workspace.files_dir, depth, call_types)
+
+    def is_cached():
+        return all(os.path.isfile(filepath) for filepath in filepaths)
+
+    # A cached result of up to date events neither waits for the lock nor moves the dataset to a new generation
+    if is_cached() and workspace.pipeline.is_up_to_date(["representative_rank"]):
+        return filepaths
+
+    run_stage(workspace, "representative_rank")
+
+    def analyze():
+        # Not while the stage is removing the results of the previous events, which may also have
+        # happened while this caller was waiting for the lock
+        with workspace.pipeline.writing():
+            if not is_cached():
+                analyze_representative_rank(workspace.files_dir, depth=depth, call_types=call_types)
+
+    if not is_cached():
+        run_analysis(workspace, "representative_rank", analyze, params=(depth, tuple(call_types or ["all"])))
+    return filepaths
+
 @app.get("/api/analysis/representativerank")
 @log_timed()
-def get_representative_rank():
+def get_representative_rank(dataset: str = DEFAULT_DATASET, depth: int = -1, call_type: str = None):
+    """
+    Clusters the ranks over the events above depth (-1 for all) of the given call types
+    (comma-separated, e.g. "kokkos"; all types by default) and returns the representative rank.
+    """
+    workspace = get_workspace(dataset)
+    call_types = parse_call_types(call_type)
     try:
-        # this is quite barebones; this will need to handle depth selection,
-        # and function type selection (ie cluster based on kokkos, mpi, user, etc. functions)
-        analysis_dir = os.path.join(files_dir, "analysis")
-        filename = f"representative_rank.json"
-        filepath = os.path.join(analysis_dir, filename)
-        if not os.path.isfile(filepath):
-            analyze_representative_rank()
+        filepath, _ = compute_representative_rank(workspace, depth, call_types)
         return get_data_from_json(filepath)
 
     except Exception as e:
@@ -295,42 +754,49 @@ def get_representative_rank():
 
 @app.get("/api/analysis/rankclusters")
 @log_timed()
-def get_rank_clusters():
+def get_rank_clusters(dataset: str = DEFAULT_DATASET, depth: int = -1, call_type: str = None):
+    """Same parameters as /api/analysis/representativerank; returns the ranks in each cluster."""
+    workspace = get_workspace(dataset)
+    call_types = parse_call_types(call_type)
     try:
-        # this is quite barebones; this will need to handle depth selection,
-        # and function type selection (ie cluster based on kokkos, mpi, user, etc. functions)
-        analysis_dir = os.path.join(files_dir, "analysis")
-        filename = f"rank_clusters.json"
-        filepath = os.path.join(analysis_dir, filename)
-        if not os.path.isfile(filepath):
-            analyze_representative_rank()
+        _, filepath = compute_representative_rank(workspace, depth, call_types)
         return get_data_from_json(filepath)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @log_timed()
-def analyze_representative_rank():
+def analyze_default_representative_rank(files_dir):
+    """The representative_rank stage; the results cached for other parameter sets are outdated as well."""
+    analysis_dir = os.path.join(files_dir, "analysis")
+    if os.path.isdir(analysis_dir):
+        for filename in os.listdir(analysis_dir):
+            if re.fullmatch(r'(representative_rank|rank_clusters)_depth_.+\.json', filename):
+                os.remove(os.path.join(analysis_dir, filename))
+
+    analyze_representative_rank(files_dir)
+
+@log_timed()
+def analyze_representative_rank(files_dir, depth=-1, call_types=None):
     events_dir = os.path.join(files_dir, "events")
-    files = os.listdir(events_dir)
-    abs_files = [os.path.abspath(os.path.join(events_dir, file)) for file in files]
-    print(f"files: {files}")
-    unique_function_names = representativeRank.get_unique_function_names(abs_files)
+    files = read_rank_files(files_dir, "events", "events")
+    ranks = sorted(files.keys())
+    abs_files = [os.path.abspath(files[rank]) for rank in ranks]
+    print(f"files: {abs_files}")
+    unique_function_names = representativeRank.get_unique_function_names(abs_files, depth=depth,
+                                                                          call_types=call_types)
     print(unique_function_names)
+    if len(unique_function_names) == 0:
+        raise ValueError(f"No events at depth < {depth} of type {call_types}.")
 
-    def extract_rank(s):
-        match = re.search(r'events-(\d+).json', s)
-        if match:
-            return int(match.group(1))
-        return None
-
-    ranks = [extract_rank(filename) for filename in files]
     file_name_template = str(
         os.path.abspath(os.path.join(events_dir, "events-{}.json")))
     feature_df = representativeRank.create_feature_dataframe(
         file_name_template=file_name_template,
         ranks=ranks,
-        function_names=unique_function_names
+        function_names=unique_function_names,
+        depth=depth,
+        call_types=call_types
     )
     print(feature_df)
     scaled_df = representativeRank.scale_dataframe(feature_df)
@@ -371,55 +837,182 @@ def analyze_representative_rank():
     # Create json for clusters
     # cluster_json = {cluster_id: {"ranks": []} for cluster_id in range(n_clusters)}
     print()
-    analysis_dir = os.path.join(files_dir, "analysis")
-    os.makedirs(analysis_dir, exist_ok=True)
+    filepath, clusters_filepath = get_representative_rank_filepaths(files_dir, depth, call_types)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
     cluster_json = df.groupby('cluster').apply(lambda x: x.index.tolist()).to_dict()
-    filename = f"rank_clusters.json"
-    clusters_filepath = os.path.join(analysis_dir, filename)
-    with open(clusters_filepath, 'w', encoding='utf-8') as f:
-        json.dump(cluster_json, f, ensure_ascii=False, indent=4)
+    write_json(clusters_filepath, cluster_json, ensure_ascii=False, indent=4)
     print()
 
-    filename = f"representative_rank.json"
-    filepath = os.path.join(analysis_dir, filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(json_response, f, ensure_ascii=False, indent=4)
+    write_json(filepath, json_response, ensure_ascii=False, indent=4)
 
 @app.get("/api/analysis/timeslices")
 @log_timed()
-def get_timeslices():
+def get_timeslices(dataset: str = DEFAULT_DATASET):
+    workspace = get_workspace(dataset)
     try:
-        analysis_dir = os.path.join(files_dir, "analysis")
-        filename = f"timeslices.json"
-        filepath = os.path.join(analysis_dir, filename)
-        if not os.path.isfile(filepath):
-            analyze_timeslices()
+        run_stage(workspace, "slice_analysis")
+        filepath = os.path.join(workspace.files_dir, "analysis", "timeslices.json")
+        return timeslices_to_seconds(get_data_from_json(filepath))
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analysis/periodicity")
+@log_timed()
+def get_periodicity(dataset: str = DEFAULT_DATASET):
+    """Iteration period of the run and, per rank, its period and iteration boundaries."""
+    workspace = get_workspace(dataset)
+    try:
+        run_stage(workspace, "periodicity")
+        filepath = os.path.join(workspace.files_dir, "analysis", "periodicity.json")
+        return periodicity_to_seconds(get_data_from_json(filepath))
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analysis/iterations")
+@log_timed()
+def get_iterations(dataset: str = DEFAULT_DATASET):
+    """Per rank, the repeating pattern of top-level calls and the start and duration of its iterations."""
+    workspace = get_workspace(dataset)
+    try:
+        run_stage(workspace, "iterations")
+        filepath = os.path.join(workspace.files_dir, "analysis", "iterations.json")
+        return iterations_to_seconds(get_data_from_json(filepath))
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analysis/imbalance")
+@log_timed()
+def get_imbalance(dataset: str = DEFAULT_DATASET, boundaries: str = "slices"):
+    """
+    Busy time of every rank in every iteration (ranks x iterations) and the imbalance of each iteration;
+    the iterations are the time slices ("slices") or the repeats of top-level calls ("iterations").
+    """
+    workspace = get_workspace(dataset)
+    if boundaries not in ["slices", "iterations"]:
+        raise HTTPException(status_code=400, detail=f"Unknown boundaries: {boundaries}")
+    try:
+        run_stage(workspace, "imbalance")
+        filepath = os.path.join(workspace.files_dir, "analysis", "imbalance.json")
+        return imbalance_to_seconds(get_data_from_json(filepath)[boundaries])
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analysis/collectives")
+@log_timed()
+def get_collective_wait(dataset: str = DEFAULT_DATASET, start: int = 0, count: int = 100):
+    """
+    Arrival and exit of every rank (ranks x instances) in count collective instances from start on, with the
+    wait time and the last arriver of each instance and the total wait of each rank.
+    """
+    workspace = get_workspace(dataset)
+    try:
+        run_stage(workspace, "collectives")
+        filepath = os.path.join(workspace.files_dir, "analysis", "collectives.json")
+        return collectives_to_seconds(collective_matrices(get_data_from_json(filepath), start, count))
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analysis/commmatrix")
+@log_timed()
+def get_comm_matrix(dataset: str = DEFAULT_DATASET, block_size: int = 1):
+    """
+    Sparse point-to-point communication matrix (bytes, messages, send and receive time per (src, dst) pair),
+    optionally summed over blocks of block_size consecutive ranks.
+    """
+    workspace = get_workspace(dataset)
+    if block_size < 1:
+        raise HTTPException(status_code=400, detail=f"Invalid block size: {block_size}")
+    try:
+        run_stage(workspace, "comm_matrix")
+        filepath = os.path.join(workspace.files_dir, "analysis", "comm_matrix.json")
+        return comm_matrix_to_seconds(block_matrix(get_data_from_json(filepath), block_size))
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/counters")
+@log_timed()
+def get_counters(dataset: str = DEFAULT_DATASET):
+    """The counters that were sampled, with the ranks that have them and their range of values."""
+    workspace = get_workspace(dataset)
+    try:
+        run_stage(workspace, "counters")
+        filepath = os.path.join(workspace.files_dir, "analysis", "counters.json")
         return get_data_from_json(filepath)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/counters/series")
 @log_timed()
-def analyze_timeslices():
+def get_counter_series(counter: str, rank: int, start: float = None, end: float = None, max_points: int = 1000,
+                       dataset: str = DEFAULT_DATASET):
+    """
+    Minimum and maximum of a counter of a rank over the window from start to end (in seconds; the whole
+    run by default), at the finest level of detail with at most max_points points.
+    """
+    workspace = get_workspace(dataset)
+    if max_points < 1:
+        raise HTTPException(status_code=400, detail=f"Invalid number of points: {max_points}")
+    try:
+        run_stage(workspace, "counters")
+        filepath = os.path.join(workspace.files_dir, "analysis", "counters", f"counters-{rank}.json")
+        pyramids = get_data_from_json(filepath) if os.path.isfile(filepath) else {}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if counter not in pyramids:
+        raise HTTPException(status_code=404, detail=f"Counter {counter} was not found on rank {rank}.")
+
+    level, window = select_window(pyramids[counter]["levels"],
+                                  None if start is None else seconds_to_ns(start),
+                                  None if end is None else seconds_to_ns(end), max_points)
+    return counter_window_to_seconds({"counter": counter, "rank": rank, "level": level, **window})
+
+@log_timed()
+def analyze_timeslices(files_dir):
+    """
+    Finds the time slices on the representative rank; without collectives to cluster, its iteration
+    boundaries (see periodicity) are used instead.
+    """
     events_dir = os.path.join(files_dir, "events")
     file_name_template = str(
         os.path.abspath(os.path.join(events_dir, "events-{}.json")))
 
-    representative_rank = get_representative_rank()
+    analysis_dir = os.path.join(files_dir, "analysis")
+    representative_rank = get_data_from_json(os.path.join(analysis_dir, "representative_rank.json"))
 
     # extract rank number out of representative_rank string that is of form "rank 0"
     representative_rank = representative_rank['representative rank']
 
     allreduce_df = timeSlice.prepare_data_for_rank(file_name_template, representative_rank)
-    clustered_df = timeSlice.cluster_collectives(allreduce_df)
-    metadata_dir = os.path.join(files_dir, "metadata")
-    # file is whatever file in metadata_dir that starts with metadata
-    filename = [file for file in os.listdir(metadata_dir) if file.startswith("metadata")][0]
-    filepath = os.path.join(metadata_dir, filename)
-    metadata = get_data_from_json(filepath)
+    metadata = get_data_from_json(os.path.join(files_dir, "metadata", "metadata.json"))
+    # Slices are on the timeline of the events, which starts at program.start (see clockSkew)
+    program_start, program_end = metadata['program.start'], metadata['program.end']
+    if len(allreduce_df) > 0:
+        clustered_df = timeSlice.cluster_collectives(allreduce_df)
+        slices = timeSlice.define_slices(clustered_df, program_start, program_end)
+    else:
+        boundaries = detect_rank_periodicity(file_name_template.format(representative_rank))["boundaries"]
+        slices = boundaries_to_slices(boundaries, program_start, program_end)
+
+    filepath = os.path.join(analysis_dir, "slices.json")
+    write_json(filepath, {"representative rank": representative_rank, "slices": slices}, ensure_ascii=False, indent=4)
+
+@log_timed()
+def analyze_slice_time_lost(files_dir):
+    """Compares every rank to the representative rank in each time slice."""
+    analysis_dir = os.path.join(files_dir, "analysis")
+    slices_data = get_data_from_json(os.path.join(analysis_dir, "slices.json"))
+    representative_rank = slices_data["representative rank"]
+    slices = [tuple(slice_data) for slice_data in slices_data["slices"]]
+
+    metadata = get_data_from_json(os.path.join(files_dir, "metadata", "metadata.json"))
     program_runtime = metadata['program.runtime']
-    num_ranks = int(metadata['mpi.world.size'])
-    slices = timeSlice.define_slices(clustered_df, total_runtime=program_runtime)
 
     rank_slice_time_lost, slice_time_lost = run_slice_analysis(files_dir, representative_rank, slices)
 
@@ -453,10 +1046,72 @@ def analyze_timeslices():
             "statistics": threshold_ranks[i] if i in threshold_ranks else {}
         }
 
-    analysis_dir = os.path.join(files_dir, "analysis")
-    # create the analysis directory if it does not exist
-    # os.makedirs(analysis_dir, exist_ok=True)
     filename = f"timeslices.json"
     filepath = os.path.join(analysis_dir, filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(modified_slices, f, ensure_ascii=False, indent=4)
+    write_json(filepath, modified_slices, ensure_ascii=False, indent=4)
+
+
+####################################
+###           Pipeline           ###
+####################################
+
+
+def build_pipeline(files_directory):
+    """Declares the stages used to go from uploaded .cali files to the analysis results."""
+    stages = [
+        Stage("convert", convert_stage,
+              inputs=["cali/*"],
+              outputs=["events/events-*.json", "unique-events/unique-events-*.json", "messages/messages-*.json",
+                       "counters/counters-*.json", "metadata/procs/metadata-*.json", "metadata/conversions.json"],
+              is_complete=conversions_complete),
+        Stage("clock_skew", correct_clock_skew,
+              inputs=["events/events-*.json"],
+              outputs=["metadata/clock_skew.json"],
+              depends_on=["convert"]),
+        Stage("aggregate", aggregate_metadata,
+              inputs=["metadata/procs/metadata-*.json", "metadata/clock_skew.json",
+                      "unique-events/unique-events-[0-9]*.json"],
+              outputs=["metadata/metadata.json", "unique-events/unique-events-all.json"],
+              depends_on=["clock_skew"]),
+        Stage("representative_rank", analyze_default_representative_rank,
+              inputs=["events/events-*.json"],
+              outputs=["analysis/representative_rank.json", "analysis/rank_clusters.json"],
+              depends_on=["aggregate"]),
+        Stage("logical_hierarchies", generate_default_logical_hierarchies,
+              inputs=["unique-events/unique-events-*.json"],
+              outputs=["logical_hierarchy/*.json"],
+              depends_on=["aggregate"]),
+        Stage("periodicity", detect_periodicity,
+              inputs=["events/events-*.json"],
+              outputs=["analysis/periodicity.json"],
+              depends_on=["aggregate"]),
+        Stage("iterations", detect_iterations,
+              inputs=["events/events-*.json"],
+              outputs=["analysis/iterations.json"],
+              depends_on=["aggregate"]),
+        Stage("collectives", analyze_collective_wait,
+              inputs=["events/events-*.json"],
+              outputs=["analysis/collectives.json"],
+              depends_on=["aggregate"]),
+        Stage("comm_matrix", build_comm_matrix,
+              inputs=["messages/messages-*.json"],
+              outputs=["analysis/comm_matrix.json"],
+              depends_on=["convert"]),
+        Stage("counters", build_counter_series,
+              inputs=["counters/counters-*.json", "metadata/clock_skew.json"],
+              outputs=["analysis/counters.json", "analysis/counters/counters-*.json"],
+              depends_on=["clock_skew"]),
+        Stage("time_slices", analyze_timeslices,
+              inputs=["analysis/representative_rank.json", "metadata/metadata.json", "events/events-*.json"],
+              outputs=["analysis/slices.json"],
+              depends_on=["representative_rank"]),
+        Stage("slice_analysis", analyze_slice_time_lost,
+              inputs=["analysis/slices.json", "metadata/metadata.json", "events/events-*.json"],
+              outputs=["analysis/timeslices.json", "analysis/all_ranks_analyzed.json"],
+              depends_on=["time_slices"]),
+        Stage("imbalance", analyze_imbalance,
+              inputs=["analysis/slices.json", "analysis/iterations.json", "events/events-*.json"],
+              outputs=["analysis/imbalance.json"],
+              depends_on=["time_slices", "iterations"]),
+    ]
+    return Pipeline(files_directory, stages)
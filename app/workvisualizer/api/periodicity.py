@@ -0,0 +1,175 @@
+import os
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+
+"""
+Detect the iteration period (timestep) of an application from the rhythm of its events.
+
+The start times of the events of a rank are binned into an event-rate signal. Its autocorrelation,
+computed with an FFT in O(n log n), peaks at multiples of the iteration period; the period is the
+highest peak, or the shortest peak it is a multiple of (so that two iterations are not mistaken for
+one), refined to sub-bin precision. The iteration boundaries are then placed where the signal, folded
+onto one period, is the quietest.
+
+Applications often repeat at several scales (e.g. timesteps within output intervals); each rank reports
+its dominant one, and the period of the run is the median over the ranks.
+
+Unlike the time slices, which are found by clustering MPI_Allreduce calls, this needs no collectives.
+
+Output:
+
+    files/analysis/periodicity.json: the median period over all ranks and, per rank, its period, how
+        periodic it is (autocorrelation at the period, from 0 to 1) and its iteration boundaries
+"""
+
+# Bins per event, on average: the periods are many bins long, but bins are not mostly empty (which would
+# drown the autocorrelation in noise)
+BINS_PER_EVENT = 1
+MAX_BINS = 1 << 22
+
+# Shorter peaks within this fraction of the highest one may be the fundamental of the highest one
+PEAK_TOLERANCE = 0.8
+
+# How close (relatively) a peak must be to a multiple of a shorter one to be taken as its harmonic
+HARMONIC_TOLERANCE = 0.05
+
+# Below this autocorrelation, a rank is not considered periodic
+MIN_STRENGTH = 0.2
+
+
+def read_event_starts(filepath):
+    with open(filepath, "rb") as f:
+        events = orjson.loads(f.read())
+    return np.sort(np.fromiter((event["ts"] for event in events), dtype=np.int64, count=len(events)))
+
+
+def bin_size(starts):
+    """Width (ns) of the bins of the event-rate signal of sorted start times."""
+    num_bins = min(MAX_BINS, BINS_PER_EVENT * len(starts))
+    return max(1, int((starts[-1] - starts[0]) // num_bins))
+
+
+def event_rate_signal(starts, bin_ns):
+    """Number of events starting in each bin of bin_ns nanoseconds, from the first start on."""
+    return np.bincount((starts - starts[0]) // bin_ns)
+
+
+def autocorrelation(signal):
+    """Normalized, unbiased autocorrelation of the signal (for lags 0 to len - 1), using an FFT."""
+    n = len(signal)
+    centered = signal - signal.mean()
+    # Zero padding to 2n avoids the circular wrap-around
+    nfft = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(centered, nfft)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), nfft)[:n]
+    if acf[0] <= 0:
+        return np.zeros(n)
+    acf /= np.arange(n, 0, -1)
+    return acf / acf[0]
+
+
+def refine_peak(acf, lag):
+    """Sub-bin position of a peak, by parabolic interpolation."""
+    left, center, right = acf[lag - 1], acf[lag], acf[lag + 1]
+    curvature = left - 2 * center + right
+    return lag + (0.5 * (left - right) / curvature if curvature != 0 else 0.)
+
+
+def find_period(acf):
+    """
+    Returns (lag, strength) of the fundamental period in an autocorrelation, or (None, 0.) if it has
+    no peak. The lag is a float (in bins); only lags up to half the signal are considered, so that at
+    least two iterations are seen.
+
+    Each stretch of positive autocorrelation contributes one peak (its maximum), so that noise does not
+    split a peak in several. The highest peak is the period unless it is (close to) a multiple of a
+    shorter peak that is almost as high, in which case the shorter one is (and its lag is that of the
+    highest peak over the multiple).
+    """
+    max_lag = len(acf) // 2
+    positive = acf[:max_lag] > 0
+    # Boundaries of the stretches of positive autocorrelation, after the initial decay
+    edges = np.flatnonzero(np.diff(positive.astype(np.int8)))
+    if len(edges) == 0:
+        return None, 0.
+    starts = edges[~positive[edges]] + 1
+    ends = np.append(edges[positive[edges]][1:] + 1, max_lag)[:len(starts)]
+    peaks = np.array([start + np.argmax(acf[start:end]) for start, end in zip(starts, ends)], dtype=np.int64)
+    peaks = peaks[(peaks > 0) & (peaks < max_lag - 1)]
+    if len(peaks) == 0:
+        return None, 0.
+
+    best = peaks[np.argmax(acf[peaks])]
+    best_lag = refine_peak(acf, best)
+    for peak in peaks[(peaks < best) & (acf[peaks] >= PEAK_TOLERANCE * acf[best])]:
+        lag = refine_peak(acf, peak)
+        multiple = max(1, round(best_lag / lag))
+        if abs(best_lag / (multiple * lag) - 1) <= HARMONIC_TOLERANCE:
+            # The position of the multiple, divided, is more precise than that of the shorter peak
+            return best_lag / multiple, float(acf[peak])
+    return best_lag, float(acf[best])
+
+
+def iteration_boundaries(signal, period_bins, start, end, bin_ns):
+    """Timestamps (ns) of the iteration boundaries, at the quietest phase of the folded signal."""
+    num_phases = max(1, int(round(period_bins)))
+    phases = (np.arange(len(signal)) % period_bins).astype(np.int64) % num_phases
+    counts = np.maximum(np.bincount(phases, minlength=num_phases), 1)
+    folded = np.bincount(phases, weights=signal, minlength=num_phases) / counts
+    first = start + int(np.argmin(folded)) * bin_ns
+
+    period_ns = period_bins * bin_ns
+    return [int(round(first + k * period_ns)) for k in range(int((end - first) // period_ns) + 1)]
+
+
+def detect_rank_periodicity(filepath):
+    """Period (ns), strength and iteration boundaries of the events in one events file."""
+    starts = read_event_starts(filepath)
+    result = {"period": None, "strength": 0., "boundaries": []}
+    if len(starts) < 2 or starts[-1] == starts[0]:
+        return result
+
+    bin_ns = bin_size(starts)
+    signal = event_rate_signal(starts, bin_ns).astype(np.float64)
+
+    period_bins, strength = find_period(autocorrelation(signal))
+    result["strength"] = strength
+    if period_bins is None or strength < MIN_STRENGTH:
+        return result
+
+    result["period"] = int(round(period_bins * bin_ns))
+    result["boundaries"] = iteration_boundaries(signal, period_bins, int(starts[0]), int(starts[-1]), bin_ns)
+    return result
+
+
+def boundaries_to_slices(boundaries, program_start, program_end):
+    """Slices between consecutive boundaries, like timeSlice.define_slices (from program_start to program_end)."""
+    edges = [program_start] + [boundary for boundary in boundaries if program_start < boundary < program_end] + \
+        [program_end]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+@log_timed()
+def detect_periodicity(files_dir):
+    files = read_rank_files(files_dir, "events", "events")
+
+    ranks = sorted(files.keys())
+    results = dict(zip(ranks, get_worker_pool().map(detect_rank_periodicity, [files[rank] for rank in ranks])))
+
+    periods = [result["period"] for result in results.values() if result["period"] is not None]
+    periodicity = {
+        "period": int(np.median(periods)) if len(periods) > 0 else None,
+        "periodic.ranks": len(periods),
+        "ranks": results
+    }
+
+    analysis_dir = os.path.join(files_dir, "analysis")
+    os.makedirs(analysis_dir, exist_ok=True)
+    write_json(os.path.join(analysis_dir, "periodicity.json"), periodicity, indent=4)
+    return periodicity
@@ -0,0 +1,247 @@
+"""
+Explicit stage graph for the WorkVisualizer processing pipeline.
+
+Each stage declares the stages it depends on, the files it reads (as glob patterns relative to
+the files directory) and the files it writes. A stage is only re-run when the fingerprint of its
+inputs differs from the one recorded the last time it completed, or when one of its outputs is
+missing. Stages whose dependencies are satisfied are run concurrently.
+
+Every artifact is written atomically (see atomic_io), and metadata/generation.json tells readers
+which version of the artifacts they see: "writing" is set while the files directory is being
+modified and the generation is incremented once it is consistent again. The dataset listing
+reports it, and is_up_to_date does not take results that are being written (or that changed
+while they were checked) as up to date.
+"""
+import os
+import glob
+import json
+import hashlib
+import threading
+import concurrent.futures
+from contextlib import ExitStack, contextmanager
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+
+
+class Stage:
+
+    def __init__(self, name, function, inputs=(), outputs=(), depends_on=(), is_complete=None):
+        """
+        Inputs:
+            name (str):         Unique name of the stage
+            function:           Callable taking the files directory; does the actual work
+            inputs (list):      Glob patterns (relative to the files directory) read by the stage
+            outputs (list):     Glob patterns (relative to the files directory) written by the stage
+            depends_on (list):  Names of the stages that must be up to date before this one runs
+            is_complete:        Optional callable taking the files directory; False if some of the outputs
+                                are missing even though every pattern matches (e.g. those of one rank)
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.depends_on = list(depends_on)
+        self.is_complete = is_complete
+
+    def fingerprint(self, files_dir):
+        """Hash the name, size and modification time of every input file."""
+        hasher = hashlib.sha1(self.name.encode())
+        for pattern in self.inputs:
+            for filepath in sorted(glob.glob(os.path.join(files_dir, pattern))):
+                if not os.path.isfile(filepath):
+                    continue
+                stat = os.stat(filepath)
+                hasher.update(f"{os.path.relpath(filepath, files_dir)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return hasher.hexdigest()
+
+    def has_outputs(self, files_dir):
+        if not all(len(glob.glob(os.path.join(files_dir, pattern))) > 0 for pattern in self.outputs):
+            return False
+        return self.is_complete is None or self.is_complete(files_dir)
+
+
+class Pipeline:
+
+    manifest_filename = "pipeline.json"
+    generation_filename = os.path.join("metadata", "generation.json")
+
+    def __init__(self, files_dir, stages, max_workers=None):
+        self.files_dir = files_dir
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+        # Re-entrant, so that a caller can hold it around a run (e.g. while it adds inputs in steps)
+        self.lock = threading.RLock()
+        self.writers = 0
+        self.generation = 0
+
+        # Make sure the graph is well formed before anything runs
+        for stage in stages:
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dependency}")
+        self.topological_order(list(self.stages.keys()))
+
+    @property
+    def manifest_file(self):
+        return os.path.join(self.files_dir, self.manifest_filename)
+
+    def read_manifest(self):
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+        os.makedirs(self.files_dir, exist_ok=True)
+        write_json(self.manifest_file, manifest, indent=4)
+
+    @property
+    def generation_file(self):
+        return os.path.join(self.files_dir, self.generation_filename)
+
+    def read_generation(self):
+        """Returns {"generation": int, "writing": bool}."""
+        if not os.path.isfile(self.generation_file):
+            return {"generation": 0, "writing": False}
+        with open(self.generation_file) as f:
+            return json.load(f)
+
+    def write_generation(self, generation, writing):
+        os.makedirs(os.path.dirname(self.generation_file), exist_ok=True)
+        write_json(self.generation_file, {"generation": generation, "writing": writing}, indent=4)
+
+    @contextmanager
+    def writing(self):
+        """
+        Holds the lock while the files directory is modified, inside or outside of a run (e.g. a
+        partial conversion); nested uses count as one write. The generation marker is set to writing
+        on entry and moves to the next generation on exit.
+        """
+        with self.lock:
+            self.writers += 1
+            if self.writers == 1:
+                self.generation = self.read_generation()["generation"]
+                self.write_generation(self.generation, writing=True)
+            try:
+                yield
+            finally:
+                self.writers -= 1
+                if self.writers == 0:
+                    # Written even if the files directory was cleared in the meantime
+                    self.write_generation(self.generation + 1, writing=False)
+
+    def topological_order(self, targets):
+        """Return the targets and all of their (transitive) dependencies, dependencies first."""
+        order = []
+        state = {}
+
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Cycle in pipeline detected at stage {name}")
+            state[name] = "visiting"
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            state[name] = "done"
+            order.append(name)
+
+        for target in targets:
+            if target not in self.stages:
+                raise KeyError(f"Unknown pipeline stage: {target}")
+            visit(target)
+
+        return order
+
+    def is_stale(self, name, manifest):
+        stage = self.stages[name]
+        return manifest.get(name) != stage.fingerprint(self.files_dir) or not stage.has_outputs(self.files_dir)
+
+    def is_up_to_date(self, targets):
+        """
+        Whether none of the given stages (or their dependencies) would run. The lock is not taken, so that
+        readers of up to date results do not wait for a run in progress; results that are being written
+        count as out of date.
+        """
+        generation = self.read_generation()
+        if generation["writing"]:
+            return False
+        manifest = self.read_manifest()
+        if any(self.is_stale(name, manifest) for name in self.topological_order(targets)):
+            return False
+        # Nothing was written while the stages were checked
+        return self.read_generation() == generation
+
+    def invalidate(self, names=None):
+        """Forget the recorded fingerprints so that the given stages (default: all) are re-run."""
+        with self.lock:
+            manifest = self.read_manifest()
+            for name in (names if names is not None else list(manifest.keys())):
+                manifest.pop(name, None)
+            self.write_manifest(manifest)
+
+    @log_timed()
+    def run(self, targets=None, skip=()):
+        """
+        Bring the requested stages (default: all stages) up to date.
+
+        A stage is re-run if it is stale, i.e. only if re-running its dependencies actually changed its
+        inputs (or its outputs are missing). Stages are submitted as soon as all of their dependencies
+        have finished, so independent stages run concurrently. The generation is only incremented if
+        a stage actually runs.
+
+        Stages listed in skip are taken as they are, without running them or recording them as up to
+        date (e.g. a partial conversion in preview mode); they are brought up to date by a later run.
+
+        Returns:
+            ran (list): Names of the stages that were actually executed, in completion order
+        """
+        targets = list(self.stages.keys()) if targets is None else targets
+
+        with self.lock, ExitStack() as writing:
+            # The dataset was deleted while this caller was waiting for the lock
+            if not os.path.isdir(self.files_dir):
+                raise FileNotFoundError(f"{self.files_dir} no longer exists")
+            order = self.topological_order(targets)
+            manifest = self.read_manifest()
+
+            pending = list(order)
+            finished = set()
+            ran = []
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                running = {}
+                while pending or running:
+                    # Submit every stage whose dependencies are all finished
+                    for name in list(pending):
+                        stage = self.stages[name]
+                        if not all(dependency in finished for dependency in stage.depends_on):
+                            continue
+                        pending.remove(name)
+                        if name not in skip and self.is_stale(name, manifest):
+                            if self.writers == 0:
+                                writing.enter_context(self.writing())
+                            running[executor.submit(stage.function, self.files_dir)] = name
+                        else:
+                            finished.add(name)
+
+                    if not running:
+                        continue
+
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        try:
+                            future.result()
+                        except Exception:
+                            # Record what did complete, then let the caller see the failure
+                            self.write_manifest(manifest)
+                            raise
+                        manifest[name] = self.stages[name].fingerprint(self.files_dir)
+                        finished.add(name)
+                        ran.append(name)
+
+            self.write_manifest(manifest)
+
+        return ran
@@ -0,0 +1,59 @@
+import re
+import random
+
+"""
+Choice of the .cali files that are converted first in preview mode.
+
+A preview converts a stratified sample of the files: the file holding rank 0 (which usually does extra
+work), the largest files (the likely stragglers, which dominate the imbalance) and a random subset of
+the others (what a typical rank looks like). Metadata and the representative rank are estimated from
+the sample; the remaining files are then converted in batches that double in size, so the estimates
+are refined often at first and cheaply later on.
+"""
+
+PREVIEW_SAMPLE_SIZE = 16
+PREVIEW_NUM_LARGEST = 4
+
+
+def get_file_rank(filename):
+    """The rank a .cali file name refers to (e.g. data-12.cali -> 12), or None if it has no number."""
+    match = re.search(r'(\d+)\D*$', filename)
+    return int(match.group(1)) if match is not None else None
+
+
+def select_preview_files(sizes, sample_size=PREVIEW_SAMPLE_SIZE, num_largest=PREVIEW_NUM_LARGEST, seed=0):
+    """
+    Inputs:
+        sizes (dict):       {filename: size in bytes} of the files to choose from
+        sample_size (int):  Number of files to choose
+        num_largest (int):  How many of them are the largest files (at most sample_size - 1, after rank 0)
+        seed (int):         Seed of the random subset, so that the same upload gives the same preview
+
+    Returns:
+        sample (list):      Chosen filenames, in the order above (rank 0, largest, random)
+    """
+    filenames = sorted(sizes.keys())
+    if len(filenames) <= sample_size:
+        return filenames
+
+    num_largest = max(0, min(num_largest, sample_size - 1))
+    rank_zero = [filename for filename in filenames if get_file_rank(filename) == 0][:1] or filenames[:1]
+    largest = [filename for filename in sorted(filenames, key=lambda filename: sizes[filename], reverse=True)
+               if filename not in rank_zero][:num_largest]
+    chosen = set(rank_zero + largest)
+    others = [filename for filename in filenames if filename not in chosen]
+    subset = random.Random(seed).sample(others, sample_size - len(chosen))
+
+    return rank_zero + largest + sorted(subset)
+
+
+def refinement_batches(filenames, first_batch_size):
+    """Splits the remaining files into batches that double in size, starting at first_batch_size."""
+    batches = []
+    begin = 0
+    batch_size = max(1, first_batch_size)
+    while begin < len(filenames):
+        batches.append(filenames[begin:begin + batch_size])
+        begin += batch_size
+        batch_size *= 2
+    return batches
@@ -0,0 +1,32 @@
+"""
+Per-rank files of the files directory.
+
+The converter writes one file per rank into each of its output directories, named
+<prefix>-<rank>.json (e.g. events/events-3.json, messages/messages-3.json). Only names that match
+exactly are taken, so the hidden temporary files of atomic writes and anything else that ends up in
+those directories are left out.
+"""
+import os
+import re
+
+
+def read_rank_files(files_dir, subdir, prefix):
+    """
+    Inputs:
+        files_dir (str):    Files directory of a dataset
+        subdir (str):       Directory of the files, relative to files_dir (e.g. "events")
+        prefix (str):       Name of the files up to the rank (e.g. "events" for events-<rank>.json)
+
+    Returns:
+        files (dict):       {rank: path} of every file of the directory; empty if it does not exist
+    """
+    directory = os.path.join(files_dir, subdir)
+    if not os.path.isdir(directory):
+        return {}
+    pattern = re.compile(rf'{re.escape(prefix)}-(\d+)\.json')
+    files = {}
+    for filename in os.listdir(directory):
+        match = pattern.fullmatch(filename)
+        if match is not None:
+            files[int(match.group(1))] = os.path.join(directory, filename)
+    return files
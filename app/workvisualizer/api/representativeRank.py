@@ -1,4 +1,5 @@
 from logging_utils.logging_utils import log_timed
+from worker_pool import get_worker_pool
 
 import json
 import mmap
@@ -33,19 +34,23 @@ def get_data_from_json(filepath):
         sys.exit(f"Could not find {filepath}")
 
 
-def extract_function_names(file):
-    rank_data_df = pd.read_json(file)
-    return np.unique(rank_data_df['name'].to_numpy())
+def select_events(events, depth: int = -1, call_types: List[str] = None):
+    """Events above the given depth (-1 for all depths) whose type is one of call_types (None for all)."""
+    return [event for event in events
+            if (depth == -1 or event['depth'] < depth) and (call_types is None or event['type'] in call_types)]
+
+
+def extract_function_names(file, depth: int = -1, call_types: List[str] = None):
+    return np.unique([event['name'] for event in select_events(get_data_from_json(file), depth, call_types)])
 
 
 @log_timed()
 def get_unique_function_names(files: List[str], function_pattern_to_keep: str = None,
-                              function_pattern_to_drop: str = None):
+                              function_pattern_to_drop: str = None, depth: int = -1, call_types: List[str] = None):
     function_names = set()
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = executor.map(extract_function_names, files, chunksize=10)
-        for result in results:
-            function_names.update(result)
+    results = get_worker_pool().map(extract_function_names, files, [depth] * len(files), [call_types] * len(files))
+    for result in results:
+        function_names.update(result)
 
     if function_pattern_to_keep is not None:
         function_names = {name for name in function_names if function_pattern_to_keep in name}
@@ -57,19 +62,22 @@ def get_unique_function_names(files: List[str], function_pattern_to_keep: str =
     return function_names
 
 
-def load_rank_data(file_name_template, rank):
-    return rank, get_data_from_json(file_name_template.format(rank))
+def load_rank_data(file_name_template, rank, depth=-1, call_types=None):
+    return rank, select_events(get_data_from_json(file_name_template.format(rank)), depth, call_types)
 
 
 @log_timed()
-def create_feature_dataframe(file_name_template: str, ranks: List[int], function_names: List[str]):
+def create_feature_dataframe(file_name_template: str, ranks: List[int], function_names: List[str], depth: int = -1,
+                             call_types: List[str] = None):
+    """Features are only computed over the events selected by depth and call_types (see select_events)."""
     columns = [f'{name}_{stat}' for name in function_names for stat in
                ['duration_min', 'duration_q1', 'duration_q2', 'duration_avg', 'duration_sum', 'duration_q3', 'duration_max', 'n_calls']]
 
     data = {f'rank {rank}': {col: 0.0 for col in columns} for rank in ranks}
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
-        rank_data_futures = {executor.submit(load_rank_data, file_name_template, rank): rank for rank in ranks}
+        rank_data_futures = {executor.submit(load_rank_data, file_name_template, rank, depth, call_types): rank
+                             for rank in ranks}
         for future in concurrent.futures.as_completed(rank_data_futures):
             rank, rank_data = future.result()
             for function_name in function_names:
@@ -0,0 +1,52 @@
+"""
+Request coalescing for expensive computations.
+
+The dashboard fetches several endpoints that depend on the same analysis at once (e.g. the
+representative rank and the rank clusters), and several tabs may be open on the same dataset. A
+SingleFlight runs one computation per key at a time: callers that ask for a key that is already
+being computed wait for that computation and share its result (or its exception) instead of
+starting their own.
+"""
+import threading
+import concurrent.futures
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        # Metrics
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """Returns fn(*args, **kwargs), or the result of the call with the same key that is in flight."""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = concurrent.futures.Future()
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def metrics(self):
+        with self.lock:
+            return {"in_flight": len(self.calls), "executed": self.executed, "shared": self.shared}
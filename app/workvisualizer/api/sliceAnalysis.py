@@ -1,7 +1,9 @@
 import os
 import math
 import json
-import multiprocessing
+
+from worker_pool import get_worker_pool
+from atomic_io import write_json
 
 """
 Determine time lost among ranks and slices.
@@ -12,7 +14,7 @@ Output:
 
         - rank: the rank ID
         - slice: the slice ID
-        - time_lost: Time spent in Allreduce (for that slice, on that rank) minus the same stat for the representative rank
+        - time_lost: Time (in ns) spent in Allreduce (for that slice, on that rank) minus the same stat for the representative rank
         - num_events: Total number of function calls that occurred in that slice
         - type_counts: Total number of function calls of each type that occurred in that slice
         - type_times: Total time spent in each function type in that slice
@@ -51,7 +53,7 @@ def calculate_slice_stats(rank_slices):
     slice_stats = {}
     for slice_id, events in rank_slices.items():
         type_counter = {"mpi_collective": 0, "mpi_p2p": 0, "kokkos": 0, "other": 0}
-        type_timer = {"mpi_collective": 0.0, "mpi_p2p": 0.0, "kokkos": 0.0, "other": 0.0, "MPI_Allreduce": 0.0}
+        type_timer = {"mpi_collective": 0, "mpi_p2p": 0, "kokkos": 0, "other": 0, "MPI_Allreduce": 0}
         for event in events:
             type_counter[event["type"]] += 1
             type_timer[event["type"]] += event["dur"]
@@ -226,12 +228,11 @@ def analyze_slices(events_dir: str, rank: int, slices: list):
     # Then determine the number of slices and define the imbalance threshold
     num_slices = len(slices)
 
-    # Loop through all ranks' events files with multiprocessing
-    with multiprocessing.Pool() as pool:
-        results = pool.starmap(
-            process_file,
-            [(os.path.join(events_dir, filename), repr_slice_stats, num_slices, slices) for filename in other_filenames]
-        )
+    # Loop through all ranks' events files in the shared worker pool
+    results = get_worker_pool().starmap(
+        process_file,
+        [(os.path.join(events_dir, filename), repr_slice_stats, num_slices, slices) for filename in other_filenames]
+    )
 
     # Combine results from all processes and sort by slice
     all_slices_stats = []
@@ -259,22 +260,19 @@ def run_slice_analysis(files_dir, representative_rank, representative_slices):
     os.makedirs(analysis_dir, exist_ok=True)
 
     # Write out the data for all ranks
-    with open(os.path.join(analysis_dir, "all_ranks_analyzed.json"), "w") as all_ranks_json:
-        json.dump(all_slices, all_ranks_json, indent=4)
+    write_json(os.path.join(analysis_dir, "all_ranks_analyzed.json"), all_slices, indent=4)
 
     # Write out the data for time-losing ranks
-    with open(os.path.join(analysis_dir, "time_lost_ranks.json"), "w") as ranks_json:
-        json.dump(time_losing_rank_slices, ranks_json, indent=4)
+    write_json(os.path.join(analysis_dir, "time_lost_ranks.json"), time_losing_rank_slices, indent=4)
 
     # Write results for time-losing slices
-    with open(os.path.join(analysis_dir, "time_lost.json"), "w") as slices_json:
-        json.dump(time_losing_slices, slices_json, indent=4)
+    write_json(os.path.join(analysis_dir, "time_lost.json"), time_losing_slices, indent=4)
 
     return time_losing_rank_slices, time_losing_slices
 
 def main():
     # Define slices and representative rank
-    representative_slices = [(0, 0.01178184), (0.01178184, 0.34445776100000003), (0.34445776100000003, 0.923146926), (0.923146926, 1.5214891480000001), (1.5214891480000001, 2.130170211), (2.130170211, 2.730077892), (2.730077892, 3.106437574), (3.106437574, 3.106765707)]
+    representative_slices = [(0, 11781840), (11781840, 344457761), (344457761, 923146926), (923146926, 1521489148), (1521489148, 2130170211), (2130170211, 2730077892), (2730077892, 3106437574), (3106437574, 3106765707)]
 
     representative_rank = 0
 
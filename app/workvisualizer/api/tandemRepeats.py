@@ -0,0 +1,203 @@
+import os
+
+import numpy as np
+import orjson
+
+from logging_utils.logging_utils import log_timed
+from atomic_io import write_json
+from worker_pool import get_worker_pool
+from rank_files import read_rank_files
+
+"""
+Find the iterations of an application as the repeating pattern of its top-level calls.
+
+The top-level calls of a rank, in order, make a sequence of ftn_ids such as [A E A C D E F A D A B E D A B E D
+A B E D A C E], in which [A B E D] repeats back to back (a tandem repeat). The suffix array of the sequence
+is built by prefix doubling and the longest common prefixes (LCP) of neighboring suffixes are found from the
+ranks of every doubling round, all with numpy in O(n log n). Two suffixes that start d calls apart and share
+at least d calls are a square (a word repeated twice) of period d. Squares are taken from neighboring suffixes
+and from the next repeat of every 2**k calls (ranks of round k), and the shortest period whose pattern covers
+enough of the calls is the pattern. Multiples of it (several iterations at once) can have more squares, e.g.
+when every fourth iteration makes an extra call, but they are not what an iteration is.
+
+The pattern is rotated to start after the longest idle time of the longest repeat (e.g. the iteration starts
+with A rather than D), and its occurrences, read off the suffix array, are the iterations.
+
+Output:
+
+    files/analysis/iterations.json: per rank, the pattern (ftn_ids), its length in calls, the fraction of
+        the calls that are in an iteration, and the start and duration of every iteration
+"""
+
+# Fewer repetitions than this do not make iterations
+MIN_REPEATS = 2
+
+# Patterns that make up less than this fraction of the calls are chance repeats (e.g. [A A])
+MIN_COVERAGE = 0.2
+
+
+def suffix_array(symbols):
+    """
+    Inputs:
+        symbols (np.ndarray):   Sequence of non-negative integers
+
+    Returns:
+        sa (np.ndarray):        Start positions of the suffixes, in lexicographic order
+        ranks (list):           For each doubling round k, the rank of the first 2**k symbols of every suffix
+                                (equal ranks mean equal prefixes)
+    """
+    n = len(symbols)
+    rank = np.unique(symbols, return_inverse=True)[1].astype(np.int32)
+    sa = np.argsort(rank, kind="stable")
+    ranks = [rank]
+    length = 1
+    while length < n and rank[sa[-1]] < n - 1:
+        # Sort by (rank of the first half, rank of the second half); suffixes with no second half come first
+        second = np.full(n, -1, dtype=np.int32)
+        second[:n - length] = rank[length:]
+        sa = np.lexsort((second, rank))
+        changes = (rank[sa][1:] != rank[sa][:-1]) | (second[sa][1:] != second[sa][:-1])
+        rank = np.empty(n, dtype=np.int32)
+        rank[sa] = np.concatenate(([0], np.cumsum(changes)))
+        ranks.append(rank)
+        length *= 2
+    return sa, ranks
+
+
+def adjacent_lcp(sa, ranks):
+    """Length of the longest common prefix of every two neighboring suffixes in the suffix array."""
+    n = len(sa)
+    left, right = sa[:-1], sa[1:]
+    lcp = np.zeros(n - 1, dtype=np.int64)
+    for k in reversed(range(len(ranks))):
+        i, j = left + lcp, right + lcp
+        same = (i < n) & (j < n)
+        same[same] = ranks[k][i[same]] == ranks[k][j[same]]
+        lcp[same] += 1 << k
+    return lcp
+
+
+def square_periods(sa, lcp, ranks):
+    """
+    The periods of the squares among neighboring suffixes, and between every 2**k calls and their next repeat
+    if it is at most 2**k calls later, shortest first.
+    """
+    distances = np.abs(sa[1:] - sa[:-1])
+    periods = [distances[lcp >= distances]]
+    for k, rank in enumerate(ranks):
+        # The positions of every 2**k calls, in order
+        positions = np.argsort(rank, kind="stable")
+        repeats = rank[positions[1:]] == rank[positions[:-1]]
+        distances = (positions[1:] - positions[:-1])[repeats]
+        periods.append(distances[distances <= 1 << k])
+    return [int(period) for period in np.unique(np.concatenate(periods))]
+
+
+def longest_run(symbols, period):
+    """(start, length) of the longest stretch of the sequence that repeats with the period."""
+    repeats = np.concatenate(([False], symbols[:-period] == symbols[period:], [False]))
+    edges = np.flatnonzero(np.diff(repeats.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    longest = np.argmax(ends - starts)
+    return int(starts[longest]), int(ends[longest] - starts[longest] + period)
+
+
+def pattern_start(symbols, period, gaps=None):
+    """
+    Position of the first occurrence of the pattern, in the longest repeat, rotated so that it starts after
+    the longest total idle time (gaps[i] is the idle time before call i); without gaps, the repeat's start.
+    """
+    start, length = longest_run(symbols, period)
+    if gaps is None:
+        return start
+    phases = np.arange(length) % period
+    idle = np.bincount(phases, weights=gaps[start:start + length], minlength=period)
+    return start + int(np.argmax(idle))
+
+
+def occurrences(sa, lcp, start, period):
+    """Sorted, non-overlapping positions of the occurrences of the period calls that begin at start."""
+    position = int(np.flatnonzero(sa == start)[0])
+    # The suffixes starting with the pattern are the interval of the suffix array around position where
+    # neighbors share at least period calls
+    shorter = np.flatnonzero(lcp < period)
+    before = shorter[shorter < position]
+    after = shorter[shorter >= position]
+    low = before[-1] + 1 if len(before) > 0 else 0
+    high = after[0] if len(after) > 0 else len(sa) - 1
+
+    positions = []
+    for position in np.sort(sa[low:high + 1]):
+        if len(positions) == 0 or position >= positions[-1] + period:
+            positions.append(int(position))
+    return positions
+
+
+def find_tandem_repeat(symbols, gaps=None):
+    """
+    Inputs:
+        symbols (np.ndarray):   Sequence of calls, as integers
+        gaps (np.ndarray):      Idle time before every call, to choose where the pattern starts (optional)
+
+    Returns:
+        period (int):           Number of calls in the pattern (0 if no pattern repeats enough)
+        positions (list):       Positions of the non-overlapping occurrences of the pattern
+    """
+    if len(symbols) < 2:
+        return 0, []
+    sa, ranks = suffix_array(symbols)
+    lcp = adjacent_lcp(sa, ranks)
+    # The shortest period that makes iterations is primitive: a multiple of it would only reach the coverage
+    # if it did as well
+    for period in square_periods(sa, lcp, ranks):
+        positions = occurrences(sa, lcp, pattern_start(symbols, period, gaps), period)
+        if len(positions) >= MIN_REPEATS and period * len(positions) >= MIN_COVERAGE * len(symbols):
+            return period, positions
+    return 0, []
+
+
+def read_top_level_calls(filepath):
+    """ftn_ids, start times and durations of the top-level calls of an events file, in order."""
+    with open(filepath, "rb") as f:
+        events = orjson.loads(f.read())
+    calls = sorted((event["ts"], event["dur"], event["ftn_id"]) for event in events
+                   if event.get("depth") == 0 and "dur" in event)
+    if len(calls) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts, durations, ftn_ids = (np.array(column, dtype=np.int64) for column in zip(*calls))
+    return ftn_ids, starts, durations
+
+
+def detect_rank_iterations(filepath):
+    """Pattern and iterations (start and duration, in ns) of the top-level calls in one events file."""
+    ftn_ids, starts, durations = read_top_level_calls(filepath)
+    result = {"pattern": [], "period": 0, "coverage": 0., "boundaries": [], "durations": []}
+
+    ends = starts + durations
+    gaps = np.concatenate(([0], starts[1:] - ends[:-1])) if len(starts) > 0 else starts
+    period, positions = find_tandem_repeat(ftn_ids, gaps)
+    if period == 0:
+        return result
+    result["coverage"] = period * len(positions) / len(ftn_ids)
+
+    positions = np.array(positions, dtype=np.int64)
+    last_calls = positions + period - 1
+    result["pattern"] = ftn_ids[positions[0]:positions[0] + period].tolist()
+    result["period"] = period
+    result["boundaries"] = starts[positions].tolist()
+    result["durations"] = (ends[last_calls] - starts[positions]).tolist()
+    return result
+
+
+@log_timed()
+def detect_iterations(files_dir):
+    files = read_rank_files(files_dir, "events", "events")
+
+    ranks = sorted(files.keys())
+    iterations = {"ranks": dict(zip(ranks, get_worker_pool().map(detect_rank_iterations,
+                                                                 [files[rank] for rank in ranks])))}
+
+    analysis_dir = os.path.join(files_dir, "analysis")
+    os.makedirs(analysis_dir, exist_ok=True)
+    write_json(os.path.join(analysis_dir, "iterations.json"), iterations, indent=4)
+    return iterations
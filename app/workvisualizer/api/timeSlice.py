@@ -47,10 +47,10 @@ def cluster_collectives(df: pd.DataFrame):
     return df
 
 @log_timed()
-def define_slices(df: pd.DataFrame, total_runtime: float):
+def define_slices(df: pd.DataFrame, program_start: int, program_end: int):
     # Initialize variables
     slices = []
-    start_time = 0
+    start_time = program_start
 
     # Ensure the DataFrame is sorted by timestamp
     df = df.sort_values(by='ts')
@@ -59,7 +59,7 @@ def define_slices(df: pd.DataFrame, total_runtime: float):
     unique_clusters = df['cluster'].unique()
 
     # Previous end time
-    previous_end_time = 0.0
+    previous_end_time = program_start
 
     # Iterate through clusters
     for cluster in unique_clusters:
@@ -67,9 +67,9 @@ def define_slices(df: pd.DataFrame, total_runtime: float):
         cluster_df = df[df['cluster'] == cluster]
 
         # Define the end time for the current slice
-        end_time = cluster_df['ts'].max()
+        end_time = cluster_df['ts'].max().item()
 
-        if end_time > previous_end_time:
+        if previous_end_time < end_time < program_end:
             # Append the slice to the list
             slices.append((start_time, end_time))
 
@@ -80,8 +80,6 @@ def define_slices(df: pd.DataFrame, total_runtime: float):
             previous_end_time = end_time
 
     # Handle the final slice
-    slices.append((start_time, total_runtime))
-
-    slices[0] = (0, slices[1][0])
+    slices.append((start_time, program_end))
 
     return slices
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+Time units used by the pipeline.
+
+Everything written to the files directory (events, unique events, metadata, analysis results) keeps
+timestamps and durations as integer nanoseconds; they are only converted to seconds when they are
+served to the dashboard.
+"""
+
+NS_PER_SECOND = 1_000_000_000
+
+
+def ns_to_seconds(ns):
+    return ns / NS_PER_SECOND
+
+
+def seconds_to_ns(seconds):
+    return int(round(seconds * NS_PER_SECOND))
+
+
+def events_to_seconds(events):
+    """Convert the "ts" and "dur" of a list of events (in place)."""
+    for event in events:
+        if "ts" in event:
+            event["ts"] = ns_to_seconds(event["ts"])
+        if "dur" in event:
+            event["dur"] = ns_to_seconds(event["dur"])
+    return events
+
+
+def hierarchy_to_seconds(node):
+    """Convert the times of a logical hierarchy (unique events nested under "children") in place."""
+    events_to_seconds([node])
+    for rank_info in node.get("rank_info", {}).values():
+        rank_info["dur"] = ns_to_seconds(rank_info["dur"])
+    for child in node.get("children", []):
+        hierarchy_to_seconds(child)
+    return node
+
+
+def metadata_to_seconds(metadata):
+    """Convert the program bounds and the biggest calls of the global metadata in place."""
+    for key in ("program.start", "program.end", "program.runtime"):
+        if key in metadata:
+            metadata[key] = ns_to_seconds(metadata[key])
+    for key in ("biggest.calls", "biggest.calls.total"):
+        if key in metadata:
+            metadata[key] = {name: ns_to_seconds(dur) for name, dur in metadata[key].items()}
+    return metadata
+
+
+def slice_stats_to_seconds(all_slices):
+    """Convert the per rank, per slice statistics written by the slice analysis in place."""
+    for entry in all_slices:
+        entry["time_lost"] = ns_to_seconds(entry["time_lost"])
+        entry["type_times"] = {call_type: ns_to_seconds(time) for call_type, time in entry["type_times"].items()}
+    return all_slices
+
+
+def periodicity_to_seconds(periodicity):
+    """Convert the periods and the iteration boundaries of periodicity.json in place."""
+    if periodicity["period"] is not None:
+        periodicity["period"] = ns_to_seconds(periodicity["period"])
+    for rank_periodicity in periodicity["ranks"].values():
+        if rank_periodicity["period"] is not None:
+            rank_periodicity["period"] = ns_to_seconds(rank_periodicity["period"])
+        rank_periodicity["boundaries"] = [ns_to_seconds(ts) for ts in rank_periodicity["boundaries"]]
+    return periodicity
+
+
+def iterations_to_seconds(iterations):
+    """Convert the iteration boundaries and durations of iterations.json in place."""
+    for rank_iterations in iterations["ranks"].values():
+        rank_iterations["boundaries"] = [ns_to_seconds(ts) for ts in rank_iterations["boundaries"]]
+        rank_iterations["durations"] = [ns_to_seconds(dur) for dur in rank_iterations["durations"]]
+    return iterations
+
+
+def imbalance_to_seconds(imbalance):
+    """Convert the iteration spans and busy times of one entry of imbalance.json in place."""
+    imbalance["iterations"] = [[ns_to_seconds(ts) for ts in span] for span in imbalance["iterations"]]
+    imbalance["busy"] = [[ns_to_seconds(busy) for busy in row] for row in imbalance["busy"]]
+    return imbalance
+
+
+def collectives_to_seconds(collectives):
+    """Convert the wait times, arrivals and exits of the collective_matrices output in place."""
+    collectives["rank.wait"] = [ns_to_seconds(wait) for wait in collectives["rank.wait"]]
+    instances = collectives["instances"]
+    for key in ["first.arrival", "last.arrival", "wait", "max.wait"]:
+        instances[key] = [ns_to_seconds(ts) for ts in instances[key]]
+    for key in ["arrival", "exit"]:
+        collectives[key] = [[None if ts is None else ns_to_seconds(ts) for ts in row] for row in collectives[key]]
+    return collectives
+
+
+def comm_matrix_to_seconds(matrix):
+    """Convert the send and receive times of comm_matrix.json in place."""
+    for key in ["send.time", "recv.time"]:
+        matrix[key] = [ns_to_seconds(time) for time in matrix[key]]
+    return matrix
+
+
+def counter_window_to_seconds(window):
+    """Convert the timestamps of a window of a counter's pyramid in place."""
+    window["ts"] = [ns_to_seconds(ts) for ts in window["ts"]]
+    return window
+
+
+def timeslices_to_seconds(timeslices):
+    """Convert the slice bounds and time lost of timeslices.json in place."""
+    for slice_data in timeslices.values():
+        slice_data["ts"] = [ns_to_seconds(ts) for ts in slice_data["ts"]]
+        slice_data["time_lost"] = f'{ns_to_seconds(float(slice_data["time_lost"]))}'
+        if isinstance(slice_data["statistics"], list):
+            for entry in slice_data["statistics"]:
+                entry["time_lost"] = ns_to_seconds(entry["time_lost"])
+    return timeslices
@@ -0,0 +1,30 @@
+"""
+Streaming top-K selection.
+
+A TopK keeps the k largest (score, key) pairs pushed into it in a min-heap of size k, so selecting
+the biggest calls costs O(n log k) and never sorts the full list. The result is exact as long as each
+key's score is final when it is pushed (e.g. the durations were summed over all ranks beforehand).
+"""
+import heapq
+
+
+class TopK:
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, score, key, value=None):
+        """Offer an item; keys must be unique (and comparable, to break ties between equal scores)."""
+        entry = (score, key, value)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        """The kept (score, key, value) entries, largest score first."""
+        return sorted(self.heap, key=lambda entry: entry[:2], reverse=True)
@@ -0,0 +1,143 @@
+"""
+Long-lived process pool shared by all CPU-bound stages of the API server.
+
+Creating a new pool per request means paying for process start-up and for re-importing numpy,
+pandas, sklearn and caliperreader in every worker each time. Instead, one pool is created (and
+warmed up) when the server starts and every stage submits its work to it.
+"""
+import os
+import sys
+import atexit
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+from logging_utils.logging_utils import log_timed
+
+
+def _import_dependencies():
+    """Worker initializer; pays the import cost once per worker instead of once per task."""
+    import numpy
+    import pandas
+    import sklearn
+    import caliperreader
+    import orjson
+
+
+def _ping():
+    return os.getpid()
+
+
+def get_default_pool_size():
+    """Number of CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class WorkerPool:
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers if max_workers is not None else get_default_pool_size()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.executor = self._create_executor()
+        self.pending = set()
+
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                      initializer=_import_dependencies)
+
+    def _task_done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for using too much memory); start over with a fresh pool
+            with self.lock:
+                self.executor = self._create_executor()
+            future = self.executor.submit(fn, *args, **kwargs)
+
+        with self.lock:
+            self.submitted += 1
+            self.pending.add(future)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def map(self, fn, *iterables):
+        """Like Executor.map, but returns the list of results (in order)."""
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def starmap(self, fn, iterable):
+        futures = [self.submit(fn, *args) for args in iterable]
+        return [future.result() for future in futures]
+
+    @log_timed()
+    def warm(self):
+        """Start all of the workers now rather than on the first request."""
+        futures = [self.submit(_ping) for _ in range(self.max_workers)]
+        return sorted(set(future.result() for future in futures))
+
+    def metrics(self):
+        """
+        Task counts; in_flight are the tasks that were submitted and are not done, whether they are running
+        or still waiting for a worker (the executor hands tasks to its workers ahead of time, so the two
+        cannot be told apart).
+        """
+        with self.lock:
+            return {
+                "workers": self.max_workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "in_flight": len(self.pending)
+            }
+
+    def shutdown(self, wait=True):
+        if sys.version_info >= (3, 9):
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+            return
+        # Executor.shutdown has no cancel_futures before Python 3.9; cancel the tasks that have not started
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+        self.executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the shared pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        # A forked child must not reuse its parent's pool
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = WorkerPool()
+        return _pool
+
+
+def shutdown_worker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.shutdown()
+        _pool = None
+
+
+atexit.register(shutdown_worker_pool)
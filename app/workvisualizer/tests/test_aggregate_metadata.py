@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.aggregateMetadata import aggregate_all_proc_metadata, aggregate_unique_events, compute_imbalance, \
+    count_unique_functions, find_biggest_calls, function_statistics, read_in_proc_metadata_files
+
+def write_rank_unique_events(directory, rank, events):
+    filepath = os.path.join(directory, f"unique-events-{rank}.json")
+    with open(filepath, "w") as f:
+        json.dump([dict(path="", depth=0, type="other", ts=0, **event) for event in events], f)
+    return filepath
+
+def write_proc_metadata(directory, ranks, counts, start, end):
+    filepath = os.path.join(directory, f"metadata-{ranks[0]}.json")
+    total_counts = {rank: dict(counts, other=0) for rank in ranks}
+    total_counts["average"] = dict(total_counts[ranks[0]])
+    with open(filepath, "w") as f:
+        json.dump({"cali.caliper.version": "2.12.0", "mpi.world.size": "4", "cali.channel": "default",
+                   "known.ranks": ranks, "known.depths": [0, 1], "program.start": start, "program.end": end,
+                   "total.counts": total_counts}, f)
+    return filepath
+
+class TestAggregateMetadata(unittest.TestCase):
+    def test_proc_metadata_of_two_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = [
+                write_proc_metadata(tmp_dir, [0, 1], {"kokkos": 3, "mpi_p2p": 2, "mpi_collective": 1}, 10, 500),
+                write_proc_metadata(tmp_dir, [2, 3], {"kokkos": 5, "mpi_p2p": 0, "mpi_collective": 1}, 0, 400),
+            ]
+            global_metadata = aggregate_all_proc_metadata(files)
+
+        # The per-file average is not counted as one more rank
+        assert global_metadata["total.counts"] == {"kokkos": 16, "mpi_p2p": 4, "mpi_collective": 4, "other": 0}
+        assert global_metadata["average.counts"]["kokkos"] == 4
+        assert global_metadata["known.ranks"] == [0, 1, 2, 3] and global_metadata["program.runtime"] == 500
+
+    def test_proc_metadata_files_being_written_are_left_out(self):
+        with tempfile.TemporaryDirectory() as files_dir:
+            procs_dir = os.path.join(files_dir, "metadata", "procs")
+            os.makedirs(procs_dir)
+            files = [write_proc_metadata(procs_dir, [0, 1], {"kokkos": 1, "mpi_p2p": 0, "mpi_collective": 0}, 0, 10),
+                     write_proc_metadata(procs_dir, [12], {"kokkos": 1, "mpi_p2p": 0, "mpi_collective": 0}, 0, 20)]
+            # A temporary file of an atomic write (see atomic_io)
+            with open(os.path.join(procs_dir, ".kx3r1a.tmp"), "w") as f:
+                f.write("{")
+            assert sorted(read_in_proc_metadata_files(files_dir)) == sorted(files)
+
+    def test_no_proc_metadata(self):
+        global_metadata = aggregate_all_proc_metadata([])
+        assert global_metadata["known.ranks"] == [] and global_metadata["maximum.depth"] is None
+        assert global_metadata["program.runtime"] == 0 and global_metadata["average.counts"]["kokkos"] == 0
+
+    def test_unique_counts_match_functions_by_name(self):
+        # The same function has a different ftn_id in each file
+        unique_events = [{"name": "solve", "ftn_id": 0, "type": "kokkos"}, {"name": "solve", "ftn_id": 3, "type": "kokkos"},
+                         {"name": "MPI_Send", "ftn_id": 3, "type": "mpi_p2p"}]
+        assert count_unique_functions(unique_events) == {"kokkos": 1, "mpi_p2p": 1, "mpi_collective": 0, "other": 0}
+
+    def test_function_imbalance_over_two_ranks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The converters of the two ranks numbered the functions differently
+            files = {
+                0: write_rank_unique_events(tmp_dir, 0, [{"name": "solve", "ftn_id": 0, "dur": 100, "count": 1},
+                                                         {"name": "init", "ftn_id": 1, "dur": 40, "count": 1}]),
+                1: write_rank_unique_events(tmp_dir, 1, [{"name": "init", "ftn_id": 0, "dur": 40, "count": 2},
+                                                         {"name": "solve", "ftn_id": 1, "dur": 300, "count": 1}]),
+            }
+            unique_events, flagged_ranks = aggregate_unique_events(files)
+
+        names = [event["name"] for event in unique_events]
+        solve, init = names.index("solve"), names.index("init")
+        assert unique_events[solve]["dur"] == 400 and unique_events[init]["count"] == 3 and flagged_ranks == set()
+
+        # solve: mean (100 + 300) / 2 = 200, std sqrt((100^2 + 100^2) / 2) = 100; init: 40 and 0
+        _, _, _, mean, std = function_statistics(unique_events)
+        assert np.allclose(mean[[solve, init]], [200, 40]) and np.allclose(std[[solve, init]], [100, 0])
+
+        # Rank 1 is above 200 + 0.5 * 100 in solve, by (300 - 200) / 200
+        assert compute_imbalance(unique_events, threshold=0.5) == [(solve, 1, 0.5)]
+        assert compute_imbalance(unique_events) == []
+
+    def test_biggest_calls_over_all_ranks(self):
+        # "exchange" is never the biggest call of a rank, but it is the biggest in total
+        unique_events = [
+            {"name": "solve", "path": "", "dur": 100, "rank_info": {0: {"dur": 100}}},
+            {"name": "exchange", "path": "", "dur": 150, "rank_info": {0: {"dur": 50}, 1: {"dur": 50}, 2: {"dur": 50}}},
+            {"name": "init", "path": "", "dur": 60, "rank_info": {1: {"dur": 60}}},
+            {"name": "init", "path": "main", "dur": 20, "rank_info": {2: {"dur": 20}}},
+        ]
+        by_mean, by_total = find_biggest_calls(unique_events, k=2)
+        assert list(by_total.items()) == [("exchange", 150), ("solve", 100)]
+        # Mean over the calling ranks; both init events are one function
+        assert list(by_mean.items()) == [("solve", 100.), ("exchange", 50.)]
+        assert find_biggest_calls(unique_events, k=3)[0]["init"] == 40.
+
+
+if __name__ == "__main__":
+    unittest.main()
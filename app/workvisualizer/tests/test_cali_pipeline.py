@@ -1,13 +1,15 @@
 import os
 import sys
 import shutil
+import tempfile
 import unittest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
 
 from api.main import create_files_directory
-from api.cali2events import convert_cali_to_json
+from api.cali2events import convert_cali_to_json, CaliTraceEventConverter
+from api.liveIngest import CaliFileTail, LiveIngest
 from api.aggregateMetadata import aggregate_metadata
 from api.logical_hierarchy import generate_logical_hierarchy_from_root
 
@@ -43,11 +45,137 @@ class TestConfig(unittest.TestCase):
         # Run generation script
         generate_logical_hierarchy_from_root(unique_events_file, output_file)
 
-        # We should have five total data directories
+        # We should have seven total data directories
         updated_data_dir_contents = os.listdir(self.data_dir)
-        assert len(updated_data_dir_contents) == 5 and \
+        assert len(updated_data_dir_contents) == 7 and \
                "logical_hierarchy" in updated_data_dir_contents
 
+    def test_spilled_conversion_matches(self):
+        cali_files = sorted(os.path.join(self.cali_dir, filename) for filename in os.listdir(self.cali_dir) if
+                            filename.endswith(".cali"))
+
+        # Convert once in memory and once with a budget small enough to force many spill runs
+        outputs = []
+        for memory_budget in [None, 64 * 1024]:
+            files_dir = tempfile.mkdtemp()
+            create_files_directory(files_dir)
+            convert_cali_to_json(cali_files, files_dir, memory_budget=memory_budget)
+            events_dir = os.path.join(files_dir, "events")
+            outputs.append({filename: open(os.path.join(events_dir, filename)).read()
+                            for filename in os.listdir(events_dir)})
+
+            # The spill files must be cleaned up
+            assert not any(name.startswith("spill-") for name in os.listdir(files_dir))
+            shutil.rmtree(files_dir)
+
+        assert outputs[0] == outputs[1]
+
+    def test_failed_conversion_removes_spill_files(self):
+        files_dir = tempfile.mkdtemp()
+        create_files_directory(files_dir)
+        with self.assertRaises(OSError):
+            convert_cali_to_json([os.path.join(files_dir, "missing.cali")], files_dir, memory_budget=64 * 1024)
+        assert not any(name.startswith("spill-") for name in os.listdir(files_dir))
+        shutil.rmtree(files_dir)
+
+    def test_parallel_parsing_matches(self):
+        cali_file = os.path.join(self.cali_dir, sorted(os.listdir(self.cali_dir))[0])
+        cfg = {"pretty_print": False, "counters": {}, "tid_attributes": [], "pid_attributes": [], "verbose": False}
+
+        serial = CaliTraceEventConverter(cfg)
+        with open(cali_file) as f:
+            serial.read_and_sort(f)
+
+        parallel = CaliTraceEventConverter(cfg)
+        parallel.read_parallel(cali_file, 3)
+
+        assert parallel.reader.globals == serial.reader.globals
+        assert parallel.records == serial.records
+
+    def test_collectives_have_communicator(self):
+        cali_file = os.path.join(self.cali_dir, sorted(os.listdir(self.cali_dir))[0])
+        cfg = {"pretty_print": False, "counters": {}, "tid_attributes": [], "pid_attributes": [], "verbose": False}
+
+        converter = CaliTraceEventConverter(cfg)
+        with open(cali_file) as f:
+            converter.read_and_sort(f)
+
+        events = [converter.events.get(i) for i in range(len(converter.events))]
+        collectives = [event for event in events if event["type"] == "mpi_collective"]
+        assert len(collectives) > 0 and all("comm" in event and "coll_type" in event for event in collectives)
+        assert not any("comm" in event for event in converter.unique_events_dict.values())
+
+        # The point-to-point messages are kept with their peer and size
+        table = converter.messages.rank_table(converter.known_ranks[0])
+        assert len(table["eid"]) > 0 and all(size >= 0 for size in table["size"])
+
+    def test_counters_are_sampled(self):
+        cali_file = os.path.join(self.cali_dir, sorted(os.listdir(self.cali_dir))[0])
+        cfg = {"pretty_print": False, "counters": {"messages": ["mpi.msg.size"]}, "tid_attributes": [],
+               "pid_attributes": [], "verbose": False}
+
+        converter = CaliTraceEventConverter(cfg)
+        with open(cali_file) as f:
+            converter.read_and_sort(f)
+
+        # The samples of a configured counter are kept as a time series, not as trace records
+        series = converter.counter_samples.rank_series(converter.known_ranks[0])
+        assert list(series.keys()) == ["mpi.msg.size"]
+        assert len(series["mpi.msg.size"]["ts"]) == len(series["mpi.msg.size"]["value"]) > 0
+        assert not any(record.get("ph") == "C" for record in converter.records)
+
+    def test_tailing_matches(self):
+        cali_file = os.path.join(self.cali_dir, sorted(os.listdir(self.cali_dir))[0])
+        cfg = {"pretty_print": False, "counters": {}, "tid_attributes": [], "pid_attributes": [], "verbose": False}
+
+        serial = CaliTraceEventConverter(cfg)
+        with open(cali_file) as f:
+            serial.read(f)
+
+        # Grow a copy of the file in chunks that end in the middle of lines
+        with open(cali_file, "rb") as f:
+            data = f.read()
+        growing_file = os.path.join(tempfile.mkdtemp(), "data-0.cali")
+        tail = CaliFileTail(growing_file)
+        with open(growing_file, "wb") as f:
+            for begin in range(0, len(data), 100_003):
+                f.write(data[begin:begin + 100_003])
+                f.flush()
+                tail.poll()
+        shutil.rmtree(os.path.dirname(growing_file))
+
+        events = tail.converter.events
+        assert len(events) == len(serial.events)
+        assert [events.get(i) for i in range(len(events))] == [serial.events.get(i) for i in range(len(events))]
+        assert tail.converter.reader.globals == serial.reader.globals
+
+    def test_snapshot_waits_for_first_event(self):
+        cali_file = os.path.join(self.cali_dir, sorted(os.listdir(self.cali_dir))[0])
+        with open(cali_file, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+
+        watch_dir = tempfile.mkdtemp()
+        files_dir = tempfile.mkdtemp()
+        create_files_directory(files_dir)
+        live = LiveIngest(watch_dir, files_dir)
+
+        # The metadata has been written, and a record that is not an event, but no event was closed yet
+        with open(os.path.join(watch_dir, "data-0.cali"), "wb") as f:
+            f.writelines(lines[:40])
+        live.poll()
+        tail = list(live.tails.values())[0]
+        tail.converter.records.append(dict(ph="X", name="kernel", pid=0, tid=0, ts=0, dur=1, rank=0))
+        assert not live.snapshot()
+
+        with open(os.path.join(watch_dir, "data-0.cali"), "ab") as f:
+            f.writelines(lines[40:])
+        live.poll()
+        assert live.snapshot()
+        assert os.listdir(os.path.join(files_dir, "events")) == ["events-0.json"]
+
+        shutil.rmtree(watch_dir)
+        shutil.rmtree(files_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.clockSkew import align_collectives, correct_events_file, fit_clock_skew
+
+class TestClockSkew(unittest.TestCase):
+    def test_recovers_offset_and_drift(self):
+        true_exits = np.arange(1, 21, dtype=np.int64) * 1_000_000
+        skews = [(0, 0.0), (-5_000, 1e-4), (250_000, -2e-4)]
+
+        # Rank clocks read (true - offset) / (1 + drift); rank 1 made one extra barrier
+        rank_exits = {}
+        for rank, (offset, drift) in enumerate(skews):
+            local = np.rint((true_exits - offset) / (1 + drift)).astype(np.int64)
+            rank_exits[rank] = {"MPI_Allreduce": local, "MPI_Barrier": np.array([5] * (rank == 1), dtype=np.int64)}
+
+        ranks, exits = align_collectives(rank_exits)
+        assert ranks == [0, 1, 2] and exits.shape == (3, 20)
+
+        offsets, drifts = fit_clock_skew(exits)
+        corrected = exits + offsets[:, None] + drifts[:, None] * exits
+        assert np.abs(corrected - corrected[0]).max() < 2
+        assert offsets.min() == 0
+
+    def test_pinned_reference_keeps_timestamps_positive(self):
+        # Rank 1 is 50 ns ahead of the pinned reference (within the tolerance) and has an event at 0
+        exits = np.array([[1_000, 2_000, 3_000], [1_050, 2_050, 3_050]], dtype=np.int64)
+        offsets, drifts = fit_clock_skew(exits, fit_drift=False, pin_reference=True, bounds=[[10, 3_000], [0, 3_050]])
+        assert offsets[0] == 50 and offsets[1] == 0
+
+    def test_events_file_is_corrected(self):
+        events = [{"name": "a", "ts": 1_000, "dur": 500_000}, {"name": "b", "ts": 2_000_000, "dur": 0}]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "events-1.json")
+            with open(filepath, "w") as f:
+                json.dump(events, f)
+
+            bounds = correct_events_file(filepath, 100.0, 1e-3)
+            with open(filepath) as f:
+                corrected = json.load(f)
+
+        # Both the start and the end move, so durations are scaled by the drift
+        assert [event["ts"] for event in corrected] == [1_101, 2_002_100]
+        assert [event["dur"] for event in corrected] == [500_500, 0]
+        assert bounds == (1_101, 2_002_100)
+
+
+if __name__ == "__main__":
+    unittest.main()
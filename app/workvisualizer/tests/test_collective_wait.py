@@ -0,0 +1,38 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.collectiveWait import align_collectives, collective_matrices
+
+def rank_calls(comms, arrivals, exits):
+    return {"comm": np.array(comms, dtype=np.int64), "name": ["MPI_Allreduce"] * len(comms),
+            "arrival": np.array(arrivals, dtype=np.int64), "exit": np.array(exits, dtype=np.int64)}
+
+class TestCollectiveWait(unittest.TestCase):
+    def test_aligns_instances_per_communicator(self):
+        # Ranks 0 and 1 share communicator 2; rank 1 also uses communicator 5 with rank 2, in between
+        collectives = align_collectives({
+            0: rank_calls([2, 2], [0, 100], [50, 130]),
+            1: rank_calls([2, 5, 2], [40, 60, 120], [50, 80, 130]),
+            2: rank_calls([5], [75], [80]),
+        })
+
+        instances = collectives["instances"]
+        assert instances["comm"] == [2, 2, 5] and instances["sequence"] == [0, 1, 0]
+        assert instances["participants"] == [2, 2, 2]
+        assert instances["last.arriver"] == [1, 1, 2]
+        assert instances["wait"] == [40, 20, 15] and instances["max.wait"] == [40, 20, 15]
+        assert collectives["rank.wait"] == [60, 15, 0]
+
+        matrices = collective_matrices(collectives, start=1, count=2)
+        assert matrices["arrival"] == [[0, None], [20, 0], [None, 15]]
+        assert matrices["exit"] == [[30, None], [30, 20], [None, 20]]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.commMatrix import block_matrix, merge_rank_messages, read_rank_messages
+
+class TestCommMatrix(unittest.TestCase):
+    def test_sparse_matrix_counts_each_message_once(self):
+        tables = {
+            # Rank 0 sends 100 bytes twice to rank 2 and receives from rank 1 on a sub-communicator
+            0: {"eid": [1, 2, 3], "send": [1, 1, 0], "peer": [2, 2, 0], "tag": [7, 7, 7], "size": [100, 100, 8],
+                "comm": [2, 2, 3], "world": [1, 1, 0], "dur": [10, 20, 5]},
+            # Rank 2 receives them, and sends to a peer that is not a rank (MPI_PROC_NULL)
+            2: {"eid": [5, 6, 7], "send": [0, 0, 1], "peer": [0, 0, -2], "tag": [7, 7, 7], "size": [100, 100, 4],
+                "comm": [2, 2, 2], "world": [1, 1, 1], "dur": [30, 40, 1]},
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rank_messages = []
+            for rank, table in tables.items():
+                filepath = os.path.join(tmp_dir, f"messages-{rank}.json")
+                with open(filepath, "w") as f:
+                    json.dump(table, f)
+                rank_messages.append(read_rank_messages(filepath))
+
+        (src, dst, values), unmapped = merge_rank_messages(rank_messages)
+        assert src.tolist() == [0] and dst.tolist() == [2] and unmapped == 2
+        assert values["bytes"].tolist() == [200] and values["count"].tolist() == [2]
+        assert values["send.time"].tolist() == [30] and values["recv.time"].tolist() == [70]
+
+    def test_block_matrix(self):
+        matrix = {"ranks": 5, "block.size": 1, "blocks": 5, "unmapped": 0, "src": [0, 1, 4], "dst": [1, 3, 0],
+                  "bytes": [1, 2, 4], "count": [1, 1, 1], "send.time": [0, 0, 0], "recv.time": [0, 0, 0]}
+        blocked = block_matrix(matrix, 2)
+        assert blocked["blocks"] == 3
+        assert list(zip(blocked["src"], blocked["dst"], blocked["bytes"])) == [(0, 0, 1), (0, 1, 2), (2, 0, 4)]
+
+
+if __name__ == "__main__":
+    unittest.main()
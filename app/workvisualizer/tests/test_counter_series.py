@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.counterSeries import MIN_LEVEL_POINTS, PYRAMID_FACTOR, build_counter_series, build_pyramid, select_window
+
+class TestCounterSeries(unittest.TestCase):
+    def test_pyramid_keeps_extremes(self):
+        ts = np.arange(10_000, dtype=np.int64) * 1000
+        values = np.zeros(10_000)
+        values[4321] = 5.
+        levels = build_pyramid(ts, values)
+
+        assert len(levels[-1]["ts"]) <= MIN_LEVEL_POINTS
+        for below, level in zip(levels, levels[1:]):
+            assert len(level["ts"]) == -(-len(below["ts"]) // PYRAMID_FACTOR)
+            # The spike shows at every level
+            assert level["max"].max() == 5. and level["min"].min() == 0.
+
+    def test_window_uses_finest_level_that_fits(self):
+        ts = np.arange(10_000, dtype=np.int64) * 1000
+        levels = build_pyramid(ts, ts.astype(np.float64))
+
+        level, window = select_window(levels, 2_000_000, 2_099_999, max_points=100)
+        assert level == 0 and window["ts"][0] == 2_000_000 and len(window["ts"]) == 100
+
+        level, window = select_window(levels, None, None, max_points=1000)
+        assert level == 2 and len(window["ts"]) == 625
+        # The entry that covers the start of the window is included
+        level, window = select_window(levels, 2_001_000, None, max_points=2000)
+        assert level == 1 and window["ts"][0] == 2_000_000
+
+    def test_counters_are_moved_to_common_timeline(self):
+        with tempfile.TemporaryDirectory() as files_dir:
+            os.makedirs(os.path.join(files_dir, "counters"))
+            os.makedirs(os.path.join(files_dir, "metadata"))
+            for rank in [0, 1]:
+                with open(os.path.join(files_dir, "counters", f"counters-{rank}.json"), "w") as f:
+                    json.dump({"papi.PAPI_TOT_CYC": {"ts": [100, 200, 300], "value": [rank, 2., 3.]}}, f)
+            with open(os.path.join(files_dir, "metadata", "clock_skew.json"), "w") as f:
+                json.dump({"offsets": {"0": 0.0, "1": 50.0}, "drifts": {"0": 0.0, "1": 0.0}}, f)
+
+            index = build_counter_series(files_dir)
+            assert index["counters"]["papi.PAPI_TOT_CYC"] == {"ranks": [0, 1], "samples": 6, "min": 0., "max": 3.}
+            with open(os.path.join(files_dir, "analysis", "counters", "counters-1.json")) as f:
+                levels = json.load(f)["papi.PAPI_TOT_CYC"]["levels"]
+            assert levels == [{"ts": [150, 250, 350], "min": [1., 2., 3.], "max": [1., 2., 3.]}]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.imbalance import covered_time, merge_intervals, rank_busy_times
+
+class TestImbalance(unittest.TestCase):
+    def test_covered_time(self):
+        starts, ends = merge_intervals(np.array([10, 0, 12, 30]), np.array([20, 5, 15, 40]))
+        assert starts.tolist() == [0, 10, 30] and ends.tolist() == [5, 20, 40]
+        assert covered_time(starts, ends, [0, 3, 7, 15, 25, 35, 50]).tolist() == [0, 3, 5, 10, 15, 20, 25]
+
+    def test_busy_times_split_at_boundaries(self):
+        # A region of 0-100 with an MPI call of 40-60 inside, and a call of 150-250 after it
+        events = [
+            {"ts": 0, "dur": 100, "type": "other"},
+            {"ts": 40, "dur": 20, "type": "mpi_collective"},
+            {"ts": 150, "dur": 100, "type": "kokkos"},
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "events-0.json")
+            with open(filepath, "w") as f:
+                json.dump(events, f)
+            busy = rank_busy_times(filepath, np.array([0, 50, 200]), np.array([50, 200, 300]))
+
+        assert busy.tolist() == [40, 90, 50]
+
+
+if __name__ == "__main__":
+    unittest.main()
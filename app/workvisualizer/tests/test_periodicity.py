@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.periodicity import autocorrelation, bin_size, boundaries_to_slices, event_rate_signal, find_period, \
+    iteration_boundaries
+
+class TestPeriodicity(unittest.TestCase):
+    def test_recovers_iteration_period(self):
+        rng = np.random.default_rng(0)
+        period = 2_500_000
+
+        # 40 iterations of a burst of 30 events followed by a quiet phase, with some jitter
+        starts = np.sort(np.concatenate([
+            iteration * period + rng.integers(0, period // 2, size=30) for iteration in range(40)
+        ])).astype(np.int64)
+
+        bin_ns = bin_size(starts)
+        signal = event_rate_signal(starts, bin_ns).astype(np.float64)
+        period_bins, strength = find_period(autocorrelation(signal))
+
+        assert abs(period_bins * bin_ns - period) < 0.02 * period
+        assert strength > 0.3
+
+        # The boundaries fall in the quiet phase of each iteration
+        boundaries = np.array(iteration_boundaries(signal, period_bins, int(starts[0]), int(starts[-1]), bin_ns))
+        phases = (boundaries - starts[0]) % period
+        assert len(boundaries) >= 38 and np.all(phases >= period // 2 - bin_ns)
+
+    def test_slices_between_program_start_and_end(self):
+        # Boundaries outside of the program are dropped
+        assert boundaries_to_slices([50, 200, 300, 500], 100, 400) == [(100, 200), (200, 300), (300, 400)]
+        assert boundaries_to_slices([], 100, 400) == [(100, 400)]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.pipeline import Stage, Pipeline
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.files_dir = tempfile.mkdtemp()
+        self.calls = []
+        with open(os.path.join(self.files_dir, "input.txt"), "w") as f:
+            f.write("first")
+
+    def tearDown(self):
+        shutil.rmtree(self.files_dir)
+
+    def make_stage(self, name, inputs, output, depends_on=()):
+        def run(files_dir):
+            self.calls.append(name)
+            with open(os.path.join(files_dir, output), "w") as f:
+                f.write(name)
+        return Stage(name, run, inputs=inputs, outputs=[output], depends_on=depends_on)
+
+    def make_pipeline(self):
+        return Pipeline(self.files_dir, [
+            self.make_stage("a", ["input.txt"], "a.txt"),
+            self.make_stage("b", ["a.txt"], "b.txt", depends_on=["a"]),
+            self.make_stage("c", ["a.txt"], "c.txt", depends_on=["a"]),
+        ])
+
+    def test_runs_dependencies_once(self):
+        pipeline = self.make_pipeline()
+        pipeline.run(["b"])
+        assert self.calls == ["a", "b"]
+
+        # Everything is up to date now
+        assert pipeline.run(["b"]) == []
+
+    def test_input_change_invalidates_downstream(self):
+        pipeline = self.make_pipeline()
+        pipeline.run()
+        assert sorted(self.calls) == ["a", "b", "c"]
+
+        with open(os.path.join(self.files_dir, "input.txt"), "w") as f:
+            f.write("second, longer input")
+        assert sorted(pipeline.run()) == ["a", "b", "c"]
+
+    def test_missing_output_is_stale(self):
+        pipeline = self.make_pipeline()
+        pipeline.run()
+        os.remove(os.path.join(self.files_dir, "c.txt"))
+        assert pipeline.run() == ["c"]
+
+    def test_incomplete_outputs_are_stale(self):
+        complete = [True]
+        stage = self.make_stage("a", ["input.txt"], "a.txt")
+        stage.is_complete = lambda files_dir: complete[0]
+        pipeline = Pipeline(self.files_dir, [stage])
+        pipeline.run()
+
+        # Every output pattern still matches, but the stage knows that one of its outputs is gone
+        complete[0] = False
+        assert pipeline.run() == ["a"]
+
+    def test_up_to_date_without_the_lock(self):
+        pipeline = self.make_pipeline()
+        assert not pipeline.is_up_to_date(["b"])
+        pipeline.run(["b"])
+        assert pipeline.is_up_to_date(["b"]) and not pipeline.is_up_to_date(["c"])
+
+        with open(os.path.join(self.files_dir, "input.txt"), "w") as f:
+            f.write("second, longer input")
+        assert not pipeline.is_up_to_date(["b"])
+        pipeline.run(["b"])
+
+        # Results that are being written are not up to date yet
+        with pipeline.writing():
+            assert not pipeline.is_up_to_date(["b"])
+        assert pipeline.is_up_to_date(["b"])
+
+    def test_cycle_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Pipeline(self.files_dir, [
+                self.make_stage("a", [], "a.txt", depends_on=["b"]),
+                self.make_stage("b", [], "b.txt", depends_on=["a"]),
+            ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.rank_files import read_rank_files
+
+class TestRankFiles(unittest.TestCase):
+    def setUp(self):
+        self.files_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.files_dir)
+
+    def test_only_rank_files_are_read(self):
+        events_dir = os.path.join(self.files_dir, "events")
+        os.makedirs(events_dir)
+        # Temporary files of atomic writes and files of other outputs are left out
+        for filename in ["events-0.json", "events-12.json", ".events-3.json.tmp", "unique-events-1.json",
+                         "events-2.jsonl", "eventsx5.json"]:
+            open(os.path.join(events_dir, filename), "w").close()
+
+        files = read_rank_files(self.files_dir, "events", "events")
+        assert files == {0: os.path.join(events_dir, "events-0.json"), 12: os.path.join(events_dir, "events-12.json")}
+
+    def test_missing_directory_has_no_files(self):
+        assert read_rank_files(self.files_dir, "counters", "counters") == {}
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.rankSampling import refinement_batches, select_preview_files
+
+class TestRankSampling(unittest.TestCase):
+    def setUp(self):
+        # data-5 and data-9 are the stragglers
+        self.sizes = {f"data-{rank}.cali": 100 + 1000 * (rank in (5, 9)) + rank for rank in range(20)}
+
+    def test_stratified_sample(self):
+        sample = select_preview_files(self.sizes, sample_size=6, num_largest=2)
+        assert sample[:3] == ["data-0.cali", "data-9.cali", "data-5.cali"]
+        assert len(sample) == len(set(sample)) == 6
+        # The same upload gives the same preview
+        assert select_preview_files(self.sizes, sample_size=6, num_largest=2) == sample
+
+    def test_small_samples(self):
+        assert select_preview_files(self.sizes, sample_size=1) == ["data-0.cali"]
+        assert select_preview_files(self.sizes, sample_size=3) == ["data-0.cali", "data-9.cali", "data-5.cali"]
+        assert select_preview_files(self.sizes, sample_size=20) == sorted(self.sizes.keys())
+
+    def test_refinement_batches_double(self):
+        batches = refinement_batches(list(range(20)), 3)
+        assert [len(batch) for batch in batches] == [3, 6, 11]
+        assert [filename for batch in batches for filename in batch] == list(range(20))
+        assert refinement_batches([], 3) == []
+
+
+if __name__ == "__main__":
+    unittest.main()
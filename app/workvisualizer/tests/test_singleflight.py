@@ -0,0 +1,90 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.singleflight import SingleFlight
+
+class NotifyingLock(threading.Condition):
+    """Lock for a SingleFlight that wakes up waiters whenever it is released, e.g. after a caller joined."""
+
+    def __exit__(self, *args):
+        self.notify_all()
+        return super().__exit__(*args)
+
+def wait_for_followers(flights, count):
+    with flights.lock:
+        flights.lock.wait_for(lambda: flights.shared >= count)
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_run(self):
+        flights = SingleFlight()
+        flights.lock = NotifyingLock()
+        started = threading.Event()
+        release = threading.Event()
+        runs = []
+
+        def analysis():
+            runs.append(1)
+            started.set()
+            release.wait()
+            return len(runs)
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do(("default", "analysis"), analysis)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flights.do(("default", "analysis"), analysis)))
+                     for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        wait_for_followers(flights, 4)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        assert runs == [1] and results == [1] * 5
+
+        # Once it is done, the next call runs again
+        assert flights.do(("default", "analysis"), analysis) == 2
+
+    def test_exception_is_shared(self):
+        flights = SingleFlight()
+        flights.lock = NotifyingLock()
+        started = threading.Event()
+        release = threading.Event()
+        runs = []
+
+        def analysis():
+            runs.append(1)
+            started.set()
+            release.wait()
+            return int("not a number")
+
+        errors = []
+
+        def call():
+            try:
+                flights.do("key", analysis)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        wait_for_followers(flights, 1)
+        release.set()
+        leader.join()
+        follower.join()
+
+        # Both callers see the exception of the one run
+        assert runs == [1] and len(errors) == 2 and errors[0] is errors[1]
+        assert flights.metrics()["in_flight"] == 0
+
+if __name__ == "__main__":
+    unittest.main()
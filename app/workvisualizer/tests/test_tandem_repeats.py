@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.tandemRepeats import adjacent_lcp, find_tandem_repeat, suffix_array
+
+class TestTandemRepeats(unittest.TestCase):
+    def test_suffix_array_and_lcp(self):
+        rng = np.random.default_rng(0)
+        symbols = rng.integers(0, 3, size=200)
+        sa, ranks = suffix_array(symbols)
+        lcp = adjacent_lcp(sa, ranks)
+
+        suffixes = [tuple(symbols[i:]) for i in range(len(symbols))]
+        assert sa.tolist() == sorted(range(len(symbols)), key=lambda i: suffixes[i])
+        for k in range(len(sa) - 1):
+            a, b = suffixes[sa[k]], suffixes[sa[k + 1]]
+            expected = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+            assert lcp[k] == expected
+
+    def test_finds_iteration_pattern(self):
+        # The example of misc/scripts/anomaly_detector.py; every A follows some idle time
+        symbols = np.array([ord(call) for call in "AEACDEFADABEDABEDABEDACE"])
+        gaps = np.where(symbols == ord("A"), 1.0, 0.0)
+        period, positions = find_tandem_repeat(symbols, gaps)
+
+        assert period == 4
+        assert positions == [9, 13, 17]
+        assert "".join(chr(symbols[i]) for i in range(positions[0], positions[0] + period)) == "ABED"
+
+    def test_perturbed_iterations_keep_the_shortest_period(self):
+        pattern = [10, 11, 12, 13, 14, 15]
+
+        def iterations(perturb):
+            symbols = []
+            for iteration in range(60):
+                calls = list(pattern)
+                perturb(iteration, calls)
+                symbols += calls
+            return np.array(symbols)
+
+        rng = np.random.default_rng(1)
+
+        def every_fourth(iteration, calls):
+            # e.g. a checkpoint; four iterations repeat exactly, one only most of the time
+            if iteration % 4 == 3:
+                calls.insert(2, 21)
+
+        def at_random(iteration, calls):
+            if rng.random() < 0.5:
+                calls.insert(int(rng.integers(0, len(calls))), 20 + int(rng.integers(0, 2)))
+
+        for perturb in [every_fourth, at_random]:
+            symbols = iterations(perturb)
+            period, positions = find_tandem_repeat(symbols, np.where(symbols == 10, 1.0, 0.0))
+            assert period == len(pattern)
+            assert symbols[positions[0]:positions[0] + period].tolist() == pattern
+            assert period * len(positions) >= 0.4 * len(symbols)
+
+if __name__ == "__main__":
+    unittest.main()
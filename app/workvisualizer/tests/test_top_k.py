@@ -0,0 +1,33 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api.top_k import TopK
+
+class TestTopK(unittest.TestCase):
+    def test_matches_sorting(self):
+        rng = random.Random(7)
+        scores = {f"function-{i}": rng.randint(0, 50) for i in range(1000)}
+
+        top = TopK(10)
+        for key, score in scores.items():
+            top.push(score, key, score * 2)
+
+        # Ties on the score are broken by the key
+        expected = sorted(((score, key) for key, score in scores.items()), reverse=True)[:10]
+        assert [(score, key) for score, key, _ in top.items()] == expected
+        assert all(value == score * 2 for score, _, value in top.items())
+
+    def test_fewer_items_than_k(self):
+        top = TopK(5)
+        top.push(1, "a")
+        top.push(3, "b")
+        assert len(top) == 2 and [key for _, key, _ in top.items()] == ["b", "a"]
+
+
+if __name__ == "__main__":
+    unittest.main()
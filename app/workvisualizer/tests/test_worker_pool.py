@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api import worker_pool
+from api.worker_pool import WorkerPool
+
+class TestWorkerPool(unittest.TestCase):
+    def test_shutdown_cancels_queued_tasks_before_python_39(self):
+        pool = WorkerPool(max_workers=1)
+        futures = [pool.submit(time.sleep, 0.2) for _ in range(6)]
+
+        # Executor.shutdown has no cancel_futures argument on Python 3.8
+        with mock.patch.object(worker_pool, "sys", types.SimpleNamespace(version_info=(3, 8, 18))):
+            pool.shutdown()
+
+        assert futures[0].result() is None
+        assert futures[-1].cancelled()
+        assert len(pool.pending) == 0
+
+    def test_in_flight_tasks(self):
+        pool = WorkerPool(max_workers=1)
+        futures = [pool.submit(time.sleep, 0.2) for _ in range(3)]
+        # Running or waiting for the worker
+        assert pool.metrics()["in_flight"] == 3
+
+        # Once the pool is shut down, every finished task has run its done callback
+        for future in futures:
+            future.result()
+        pool.shutdown()
+        metrics = pool.metrics()
+        assert metrics["in_flight"] == 0 and metrics["completed"] == 3
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import shutil
+import inspect
+import tempfile
+import threading
+import unittest
+
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'api')))
+
+from api import main
+
+class TestWorkspaces(unittest.TestCase):
+    def setUp(self):
+        self.cali_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "cali")
+        self.files_root = tempfile.mkdtemp()
+        self.previous_files_root = main.files_root
+        main.files_root = self.files_root
+
+        self.workspace = main.get_workspace("test", create=True)
+        for filename in os.listdir(self.cali_dir):
+            shutil.copy(os.path.join(self.cali_dir, filename), os.path.join(self.workspace.files_dir, "cali"))
+
+    def tearDown(self):
+        main.workspaces.clear()
+        main.files_root = self.previous_files_root
+        shutil.rmtree(self.files_root)
+
+    def output_times(self):
+        """Modification time of every per-rank output."""
+        times = {}
+        for rank in [0, 1]:
+            for output in main.rank_output_files(self.workspace.files_dir, rank):
+                times[output] = os.stat(output).st_mtime_ns if os.path.isfile(output) else None
+        return times
+
+    def test_only_changed_or_incomplete_files_are_converted(self):
+        files_dir = self.workspace.files_dir
+        self.workspace.pipeline.run(["convert"])
+        converted = self.output_times()
+        assert None not in converted.values()
+
+        # Nothing changed: nothing is converted again
+        self.workspace.pipeline.run(["convert"])
+        assert self.output_times() == converted
+
+        # An output of rank 1 is gone (e.g. the dataset was converted before that output existed)
+        os.remove(os.path.join(files_dir, "counters", "counters-1.json"))
+        conversions = main.read_conversions(files_dir)
+        for conversion in conversions.values():
+            conversion["outputs"] = [output for output in conversion["outputs"] if not output.startswith("counters")]
+        main.write_conversions(files_dir, conversions)
+
+        self.workspace.pipeline.run(["convert"])
+        reconverted = self.output_times()
+        assert None not in reconverted.values()
+        for output, mtime in reconverted.items():
+            assert (mtime == converted[output]) == ("-0.json" in output)
+
+    def test_rank_added_after_clock_skew_correction(self):
+        files_dir = self.workspace.files_dir
+        os.remove(os.path.join(files_dir, "cali", "sample_md_1.cali"))
+        self.workspace.pipeline.run(["clock_skew"])
+        # A single rank has nothing to align with
+        assert main.get_data_from_json(os.path.join(files_dir, "metadata", "clock_skew.json"))["offsets"] == {}
+
+        shutil.copy(os.path.join(self.cali_dir, "sample_md_1.cali"), os.path.join(files_dir, "cali"))
+        self.workspace.pipeline.run(["clock_skew"])
+        skew = main.get_data_from_json(os.path.join(files_dir, "metadata", "clock_skew.json"))
+        assert sorted(skew["signatures"].keys()) == ["0", "1"]
+        assert skew["aligned.collectives"] > 0 and sorted(skew["offsets"].keys()) == ["0", "1"]
+
+    def test_slices_cover_the_program(self):
+        files_dir = self.workspace.files_dir
+        self.workspace.pipeline.run(["aggregate"])
+        os.makedirs(os.path.join(files_dir, "analysis"), exist_ok=True)
+        main.write_json(os.path.join(files_dir, "analysis", "representative_rank.json"), {"representative rank": 0})
+
+        main.analyze_timeslices(files_dir)
+        slices = main.get_data_from_json(os.path.join(files_dir, "analysis", "slices.json"))["slices"]
+        metadata = main.get_data_from_json(os.path.join(files_dir, "metadata", "metadata.json"))
+        # The events (and so the program) do not start at 0 once the clock skew is corrected
+        assert slices[0][0] == metadata["program.start"] > 0 and slices[-1][1] == metadata["program.end"]
+        assert all(start < end for start, end in slices)
+        assert all(previous[1] == following[0] for previous, following in zip(slices, slices[1:]))
+
+    def test_remove_rank(self):
+        files_dir = self.workspace.files_dir
+        self.workspace.pipeline.run(["aggregate"])
+
+        main.remove_rank(1, "test")
+        assert main.get_converted_ranks("test") == {"sample_md_0.cali": [0]}
+        assert all(os.path.isfile(output) for output in main.rank_output_files(files_dir, 0))
+        assert not any(os.path.isfile(output) for output in main.rank_output_files(files_dir, 1))
+        assert main.get_data_from_json(os.path.join(files_dir, "metadata", "metadata.json"))["known.ranks"] == [0]
+
+        with self.assertRaises(HTTPException) as context:
+            main.remove_rank(1, "test")
+        assert context.exception.status_code == 404
+
+    def test_cached_representative_rank_does_not_wait_for_the_pipeline(self):
+        files_dir = self.workspace.files_dir
+        computed = []
+
+        # The clustering needs more ranks than the sample has; the stages themselves run as they are
+        def analyze_representative_rank(files_dir, depth=-1, call_types=None):
+            computed.append(depth)
+            os.makedirs(os.path.join(files_dir, "analysis"), exist_ok=True)
+            for filepath in main.get_representative_rank_filepaths(files_dir, depth, call_types):
+                main.write_json(filepath, {"representative rank": 0})
+
+        analyze = main.analyze_representative_rank
+        main.analyze_representative_rank = analyze_representative_rank
+        try:
+            filepaths = main.compute_representative_rank(self.workspace, depth=2)
+            assert computed == [-1, 2]
+            generation = main.get_generation(files_dir)
+
+            # Another request holds the pipeline while the cached result is read
+            held, release = threading.Event(), threading.Event()
+
+            def hold():
+                with self.workspace.pipeline.lock:
+                    held.set()
+                    release.wait()
+
+            holder = threading.Thread(target=hold)
+            holder.start()
+            held.wait()
+            results = []
+            reader = threading.Thread(target=lambda: results.append(
+                main.compute_representative_rank(self.workspace, depth=2)))
+            reader.start()
+            reader.join(5)
+            served_while_held = not reader.is_alive()
+            release.set()
+            holder.join()
+            reader.join()
+
+            assert served_while_held and results == [filepaths] and computed == [-1, 2]
+            assert main.get_generation(files_dir) == generation
+        finally:
+            main.analyze_representative_rank = analyze
+
+    def test_clear_runs_in_the_threadpool(self):
+        files_dir = self.workspace.files_dir
+        self.workspace.pipeline.run(["convert"])
+        generation = main.get_generation(files_dir)["generation"]
+
+        # A plain function, so that waiting for the pipeline lock does not block the event loop
+        assert not inspect.iscoroutinefunction(main.clear_files_dir)
+        main.clear_files_dir("test")
+        assert os.listdir(os.path.join(files_dir, "cali")) == []
+        assert main.read_conversions(files_dir) is None
+        assert main.get_generation(files_dir)["generation"] == generation + 1
+
+    def test_invalid_preview_sample_size(self):
+        with self.assertRaises(HTTPException) as context:
+            main.unpack_cali("test", preview=True, sample_size=0)
+        assert context.exception.status_code == 400
+
+    def test_unknown_dataset_is_not_created(self):
+        for request in [lambda: main.get_converted_ranks("typo"), lambda: main.remove_dataset("typo")]:
+            with self.assertRaises(HTTPException) as context:
+                request()
+            assert context.exception.status_code == 404
+        assert list(main.get_datasets().keys()) == ["test"]
+
+    def test_remove_dataset_waits_for_pipeline(self):
+        files_dir = self.workspace.files_dir
+        with self.workspace.pipeline.lock:
+            remover = threading.Thread(target=main.remove_dataset, args=("test",))
+            remover.start()
+            remover.join(0.2)
+            # The files are still there while the pipeline holds its lock
+            assert remover.is_alive() and os.path.isdir(files_dir)
+        remover.join()
+
+        assert not os.path.isdir(files_dir) and "test" not in main.workspaces
+        with self.assertRaises(FileNotFoundError):
+            self.workspace.pipeline.run(["convert"])
+
+
+if __name__ == "__main__":
+    unittest.main()